@@ -0,0 +1,180 @@
+"""
+Module for aerobic decoupling (cardiac drift) of every activity.
+The efficiency factor (speed / heart rate) of the first half of the moving time
+is compared with the one of the second half. Streams are decoded once per
+activity in a single ordered pass and the results are stored in the
+aerobic_decoupling table for trend plots.
+"""
+
+import numpy as np
+from specific_activity_analysis import iter_activity_streams, resample_stream, RESAMPLING_STEP
+from instrumentation import profiled
+from database import connection, register_schema
+from lazy_imports import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+DECOUPLING_STREAMS = ['time', 'heartrate', 'velocity_smooth']
+
+# Shortest moving time (s) for a meaningful decoupling
+MIN_MOVING_TIME = 1200
+
+# Heart rate below which samples are sensor drop-outs (bpm)
+MIN_HEARTRATE = 60
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS aerobic_decoupling (
+    id INTEGER PRIMARY KEY,
+    moving_time REAL,
+    first_half_efficiency REAL,
+    second_half_efficiency REAL,
+    decoupling REAL,
+    FOREIGN KEY (id) REFERENCES activity(id)
+);
+""")
+
+
+# ============================================================================
+# METRIC
+# ============================================================================
+
+def aerobic_decoupling(time, heartrate, velocity, grid_step=RESAMPLING_STEP):
+    """
+    Aerobic decoupling of one activity on moving time.
+    Streams are resampled on a uniform grid, pauses are removed and the
+    remaining samples are split in two halves of equal moving time.
+
+    Args:
+        time: Time stream (s)
+        heartrate: Heart rate stream (bpm)
+        velocity: Speed stream (m/s)
+        grid_step: Resampling grid spacing (s)
+
+    Returns:
+        Tuple of (moving_time, first_half_efficiency, second_half_efficiency, decoupling %)
+        with None values when the activity has no usable streams.
+        Efficiencies are in m/heartbeat, a positive decoupling is a drift of the
+        heart rate at constant speed.
+    """
+    if len(time) < 2 or len(heartrate) != len(time) or len(velocity) != len(time):
+        return 0.0, None, None, None
+
+    _, grid_heartrate, pause_mask = resample_stream(time, heartrate, grid_step)
+    _, grid_velocity, _ = resample_stream(time, velocity, grid_step)
+    moving = ~pause_mask & (grid_heartrate >= MIN_HEARTRATE)
+    grid_heartrate = grid_heartrate[moving]
+    grid_velocity = grid_velocity[moving]
+
+    moving_time = len(grid_heartrate) * grid_step
+    half = len(grid_heartrate) // 2
+    if half == 0:
+        return moving_time, None, None, None
+
+    # Sum of speed over sum of heart rate = distance per heartbeat on each half
+    efficiency = [grid_velocity[:half].sum() / grid_heartrate[:half].sum() * 60,
+                  grid_velocity[half:].sum() / grid_heartrate[half:].sum() * 60]
+    if efficiency[0] <= 0:
+        # No distance covered in the first half (e.g. stationary activity)
+        return moving_time, efficiency[0], efficiency[1], None
+    decoupling = (efficiency[0] - efficiency[1]) / efficiency[0] * 100
+    return moving_time, efficiency[0], efficiency[1], decoupling
+
+
+@profiled()
+def update_aerobic_decoupling(activity_ids=None):
+    """
+    Compute and store the aerobic decoupling of the activities not processed yet.
+
+    Args:
+        activity_ids: Activities to (re)compute, defaults to the new ones
+
+    Returns:
+        Number of processed activities
+    """
+    if activity_ids is None:
+        activity_ids = [row[0] for row in cursor.execute("""
+            SELECT DISTINCT s.id FROM streams s
+            WHERE s.stream_type = 'time'
+            AND NOT EXISTS (SELECT 1 FROM aerobic_decoupling d WHERE d.id = s.id);
+        """).fetchall()]
+    if not activity_ids:
+        return 0
+
+    rows = []
+    empty = np.array([])
+    for activity_id, streams in iter_activity_streams(activity_ids, DECOUPLING_STREAMS,
+                                                      require_all=False):
+        values = aerobic_decoupling(streams.get('time', empty),
+                                    streams.get('heartrate', empty),
+                                    streams.get('velocity_smooth', empty))
+        rows.append((activity_id,) + tuple(None if value is None else float(value)
+                                           for value in values))
+    cursor.executemany("""
+        INSERT OR REPLACE INTO aerobic_decoupling
+        (id, moving_time, first_half_efficiency, second_half_efficiency, decoupling)
+        VALUES (?, ?, ?, ?, ?);
+    """, rows)
+    conn.commit()
+    return len(rows)
+
+
+# ============================================================================
+# TREND
+# ============================================================================
+
+def decoupling_history(min_moving_time=MIN_MOVING_TIME):
+    """
+    Stored decoupling of the activities long enough, by date.
+
+    Args:
+        min_moving_time: Shortest moving time (s)
+
+    Returns:
+        Tuple of (dates, decoupling %) arrays
+    """
+    result = cursor.execute("""
+        SELECT date(a.start_date), d.decoupling
+        FROM aerobic_decoupling d JOIN activity a ON a.id = d.id
+        WHERE d.decoupling IS NOT NULL AND d.moving_time >= ?
+        ORDER BY a.start_date;
+    """, (min_moving_time,)).fetchall()
+    dates = np.array([row[0] for row in result], dtype='datetime64[D]')
+    decoupling = np.array([row[1] for row in result], dtype=float)
+    return dates, decoupling
+
+
+def plot_decoupling_trend(min_moving_time=MIN_MOVING_TIME, rolling_window=10, save=False):
+    """Decoupling of every activity with its rolling median"""
+    dates, decoupling = decoupling_history(min_moving_time)
+    plt.scatter(dates, decoupling, s=10, color='gray', alpha=0.6, label='Activity')
+    if len(decoupling) >= rolling_window:
+        windows = np.lib.stride_tricks.sliding_window_view(decoupling, rolling_window)
+        plt.plot(dates[rolling_window - 1:], np.median(windows, axis=1), color='#FC4C02',
+                 label=f'Rolling median ({rolling_window} activities)')
+    plt.axhline(5, color='black', linestyle='--', linewidth=0.8)
+    plt.xlabel("Date")
+    plt.ylabel("Aerobic decoupling (%)")
+    plt.title("Aerobic decoupling (first vs second half efficiency)")
+    plt.grid(True, alpha=0.3)
+    plt.legend()
+    if save:
+        plt.savefig("./Results/aerobic_decoupling_trend.png", dpi=300)
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"Processed activities: {update_aerobic_decoupling()}")
+    plt.figure()
+    plot_decoupling_trend(save=True)
+    plt.show()
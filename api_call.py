@@ -1,59 +1,168 @@
+import contextlib
 import json
+import tempfile
+import threading
 import time
 import os
 import warnings
 warnings.filterwarnings('ignore', message='No rates present in response headers')
 from stravalib import Client
+try:
+    import fcntl
+except ImportError:  # Windows: the lock only covers the threads of this process
+    fcntl = None
 
 
 os.environ['SILENCE_TOKEN_WARNINGS'] = 'True'
 
-# Initialize Strava client
-client = Client()
-
 # File to store tokens (access, refresh, expiration)
 # Tokens are given with your strava application
 TOKEN_FILE = "tokens.json"
 
+# The access token is refreshed this many seconds before it expires (Strava only
+# gives a new token in the last hour), so a long sync never uses an expired one
+REFRESH_MARGIN = 30 * 60
+
+# {absolute token file: TokenManager}
+_managers = {}
+_managers_lock = threading.Lock()
+
 # Load tokens from json file
 # Store it
-# Refresh it when the acces token is expired (every 6 hours)
-def load_tokens():
-    with open(TOKEN_FILE, "r") as f:
+# Refresh it when the acces token expires soon (every 6 hours)
+def load_tokens(token_file=TOKEN_FILE):
+    with open(token_file, "r") as f:
         return json.load(f)
 
-def save_tokens(tokens):
-    with open(TOKEN_FILE, "w") as f:
-        json.dump(tokens, f, indent=4)
-
-def refresh_if_needed(tokens):
-    """Refresh access token automatically if expired."""
-    if time.time() < tokens["expires_at"]:
-        return tokens  # Token still valid
-
-    print("Access token expired — refreshing...")
-    
-
+def save_tokens(tokens, token_file=TOKEN_FILE):
+    """Write the tokens atomically (temporary file renamed over the token file)"""
+    folder = os.path.dirname(os.path.abspath(token_file))
+    descriptor, temporary_file = tempfile.mkstemp(dir=folder, prefix=".tokens-", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as f:
+            json.dump(tokens, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_file, token_file)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_file)
+        raise
+
+@contextlib.contextmanager
+def file_lock(lock_file):
+    """Exclusive lock shared by every process using the same lock file"""
+    with open(lock_file, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class TokenManager:
+    """
+    Tokens of one token file, cached in memory and refreshed ahead of expiry.
+    A refresh holds <token file>.lock and re-reads the file first, so when several
+    threads or processes need a refresh at the same time only the first one calls
+    Strava and the others pick up its tokens (a refresh token can only be used once).
+    before_refresh, if set, is called just before the refresh request (e.g. a rate limiter).
+    """
+
+    def __init__(self, token_file=TOKEN_FILE, refresh_margin=REFRESH_MARGIN, before_refresh=None):
+        self.token_file = token_file
+        self.lock_file = token_file + ".lock"
+        self.refresh_margin = refresh_margin
+        self.before_refresh = before_refresh
+        self._tokens = None
+        self._lock = threading.Lock()
+
+    def expires_soon(self, tokens):
+        return time.time() >= tokens["expires_at"] - self.refresh_margin
+
+    def tokens(self):
+        """Valid tokens, refreshed when they expire within the refresh margin"""
+        with self._lock:
+            if self._tokens is None:
+                self._tokens = load_tokens(self.token_file)
+            if self.expires_soon(self._tokens):
+                with file_lock(self.lock_file):
+                    # Another process may have refreshed them while this one waited
+                    self._tokens = load_tokens(self.token_file)
+                    if self.expires_soon(self._tokens):
+                        self._tokens = self._refresh(self._tokens)
+                        save_tokens(self._tokens, self.token_file)
+            return dict(self._tokens)
+
+    def access_token(self):
+        return self.tokens()["access_token"]
+
+    def _refresh(self, tokens):
+        print("Access token expires soon — refreshing...")
+        if self.before_refresh is not None:
+            self.before_refresh()
+        new_tokens = Client().refresh_access_token(
+            client_id=tokens["client_id"],
+            client_secret=tokens["client_secret"],
+            refresh_token=tokens["refresh_token"]
+        )
+        tokens = dict(tokens)
+        tokens["access_token"] = new_tokens["access_token"]
+        tokens["refresh_token"] = new_tokens["refresh_token"]
+        tokens["expires_at"] = new_tokens["expires_at"]
+        print("Token refreshed")
+        return tokens
+
+
+def token_manager(token_file=TOKEN_FILE):
+    """Shared token manager of a token file"""
+    key = os.path.abspath(token_file)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = TokenManager(token_file)
+        return _managers[key]
+
+
+class ManagedClient:
+    """Strava client proxy setting a valid access token before every API method call"""
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._client = Client(access_token=manager.access_token())
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or not name.startswith('get_'):
+            return attribute
+
+        def managed(*args, **kwargs):
+            access_token = self._manager.access_token()
+            if self._client.access_token != access_token:
+                self._client.access_token = access_token
+            return attribute(*args, **kwargs)
+        return managed
+
+def make_client(token_file=TOKEN_FILE, before_refresh=None):
+    """
+    Strava client authenticated with the tokens of a token file (one per athlete).
+
+    Args:
+        token_file: Token file of the athlete
+        before_refresh: Function called before each token refresh request (e.g. a rate limiter)
+    """
+    manager = token_manager(token_file)
+    if before_refresh is not None:
+        manager.before_refresh = before_refresh
+    return ManagedClient(manager)
 
-    new_tokens = client.refresh_access_token(
-        client_id=tokens["client_id"],
-        client_secret=tokens["client_secret"],
-        refresh_token=tokens["refresh_token"]
-    )
-    tokens["access_token"] = new_tokens["access_token"]
-    tokens["refresh_token"] = new_tokens["refresh_token"]
-    tokens["expires_at"] = new_tokens["expires_at"]
-
-    save_tokens(tokens)
-    print("Token refreshed")
-
-    return tokens
-
-tokens = load_tokens()
-tokens = refresh_if_needed(tokens)
-
-# Re-initialize client with valid access token
 # The client contains now all my running data
-client = Client(access_token=tokens["access_token"])
-
-
+# It is created on first use (from api_call import client), so that modules
+# handling other athletes' token files do not need tokens.json
+def __getattr__(name):
+    if name == "client":
+        global client
+        client = make_client()
+        return client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,268 @@
+"""
+Module for multi-athlete use (e.g. a whole club).
+Each athlete has a folder athletes/<name>/ with its token file and its own
+database, so every table and analysis is unchanged and partitioned by athlete.
+The sync coordinator syncs the athletes in parallel threads, the Strava calls of
+the athletes of one application go through a shared rate limiter (the limits
+are per application, not per athlete).
+
+Usage:
+    python athletes.py --workers 4
+"""
+
+import argparse
+import collections
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from database import use_database
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+ATHLETES_DIR = os.environ.get("STRAVA_ATHLETES_DIR", "athletes")
+TOKEN_FILE_NAME = "tokens.json"
+DATABASE_FILE_NAME = "sqlite_activity_database.db"
+
+# Strava limits of an application: (number of requests, period in s)
+RATE_LIMITS = [(100, 15 * 60), (1000, 24 * 3600)]
+
+# Client methods returning a paged iterator (one request per page, not per call)
+PAGED_METHODS = ('get_activities',)
+
+# {client_id: RateLimiter}
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+# ============================================================================
+# ATHLETES
+# ============================================================================
+
+def list_athletes(athletes_dir=None):
+    """Names of the athletes having a token file"""
+    athletes_dir = athletes_dir or ATHLETES_DIR
+    if not os.path.isdir(athletes_dir):
+        return []
+    return sorted(name for name in os.listdir(athletes_dir)
+                  if os.path.isfile(os.path.join(athletes_dir, name, TOKEN_FILE_NAME)))
+
+
+def athlete_paths(athlete, athletes_dir=None):
+    """Tuple of (token file, database file) of an athlete"""
+    folder = os.path.join(athletes_dir or ATHLETES_DIR, athlete)
+    return os.path.join(folder, TOKEN_FILE_NAME), os.path.join(folder, DATABASE_FILE_NAME)
+
+
+def athlete_database(athlete, athletes_dir=None):
+    """
+    Context manager running the analysis modules on an athlete's database
+    (calling thread only).
+
+    Example:
+        with athlete_database('alice'):
+            plot_time_in_zone()
+    """
+    return use_database(athlete_paths(athlete, athletes_dir)[1])
+
+
+# ============================================================================
+# RATE LIMITING
+# ============================================================================
+
+class RateLimiter:
+    """
+    Sliding-window limiter of the requests of one Strava application, shared by threads.
+    acquire() blocks until a request is allowed by every limit.
+    """
+
+    def __init__(self, limits=RATE_LIMITS):
+        self.limits = limits
+        self.requests = collections.deque()
+        self.lock = threading.Lock()
+
+    def wait_time(self, now):
+        """Seconds before the next request is allowed (0 if allowed now)"""
+        longest_period = max(period for _, period in self.limits)
+        while self.requests and self.requests[0] <= now - longest_period:
+            self.requests.popleft()
+        wait = 0.0
+        for count, period in self.limits:
+            in_period = [request for request in self.requests if request > now - period]
+            if len(in_period) >= count:
+                wait = max(wait, in_period[-count] + period - now)
+        return wait
+
+    def acquire(self):
+        """Wait until a request is allowed and record it"""
+        while True:
+            with self.lock:
+                now = time.time()
+                wait = self.wait_time(now)
+                if wait <= 0:
+                    self.requests.append(now)
+                    return
+            time.sleep(min(wait, 60))
+
+
+def rate_limiter(client_id):
+    """Shared rate limiter of a Strava application"""
+    with _rate_limiters_lock:
+        if client_id not in _rate_limiters:
+            _rate_limiters[client_id] = RateLimiter()
+        return _rate_limiters[client_id]
+
+
+class RateLimitedClient:
+    """
+    Strava client proxy acquiring the rate limiter before every API request:
+    once per method call, once per page for the paged methods.
+    """
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or not name.startswith(('get_', 'refresh_')):
+            return attribute
+
+        if name in PAGED_METHODS:
+            def paged(*args, **kwargs):
+                return self._pages(attribute(*args, **kwargs))
+            return paged
+
+        def limited(*args, **kwargs):
+            self._limiter.acquire()
+            return attribute(*args, **kwargs)
+        return limited
+
+    def _pages(self, results):
+        """Items of a paged iterator, acquiring the limiter before each page is requested"""
+        # The iterator requests a page when its buffer is empty: before the first
+        # item and after every full page (also the last, empty one)
+        per_page = results.per_page
+        self._limiter.acquire()
+        for index, item in enumerate(results, start=1):
+            yield item
+            if index % per_page == 0:
+                self._limiter.acquire()
+
+
+# ============================================================================
+# SYNC COORDINATOR
+# ============================================================================
+
+def sync_athlete(athlete, athletes_dir=None):
+    """
+    Sync one athlete's database with the API (same steps as create_sqlite_database.py).
+
+    Args:
+        athlete: Athlete name (folder of athletes_dir)
+        athletes_dir: Folder of the athletes
+
+    Returns:
+        Number of activities in the athlete's database
+    """
+    from api_call import load_tokens, make_client
+    token_file, _ = athlete_paths(athlete, athletes_dir)
+    limiter = rate_limiter(load_tokens(token_file)["client_id"])
+    client = RateLimitedClient(make_client(token_file, before_refresh=limiter.acquire), limiter)
+
+    with athlete_database(athlete, athletes_dir):
+        # Imported once the athlete's database is selected: the first import
+        # creates the schema on the current database
+        from create_sqlite_database import (insert_activity_data, backfill_locations,
+                                            insert_stream_data, update_derived_tables,
+                                            conn, cursor)
+        try:
+            insert_activity_data(client)
+            backfill_locations(client)
+            insert_stream_data(client)
+            update_derived_tables()
+            return cursor.execute("SELECT COUNT(*) FROM activity;").fetchone()[0]
+        finally:
+            conn.commit()
+            conn.close()
+
+
+def sync_all(athletes=None, workers=4, athletes_dir=None):
+    """
+    Sync several athletes concurrently.
+
+    Args:
+        athletes: Athlete names, defaults to every athlete of athletes_dir
+        workers: Number of athletes synced at the same time
+        athletes_dir: Folder of the athletes
+
+    Returns:
+        Dictionary {athlete: number of activities or the error message}
+    """
+    athletes = athletes if athletes is not None else list_athletes(athletes_dir)
+
+    def sync(athlete):
+        try:
+            return sync_athlete(athlete, athletes_dir)
+        except Exception:
+            return traceback.format_exc()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(athletes, executor.map(sync, athletes)))
+
+
+# ============================================================================
+# ANALYSIS
+# ============================================================================
+
+def per_athlete(function, *args, athletes=None, athletes_dir=None, **kwargs):
+    """
+    Run an analysis function on the database of each athlete.
+
+    Example:
+        per_athlete(lifetime_envelope, 'speed')
+
+    Returns:
+        Dictionary {athlete: result}
+    """
+    athletes = athletes if athletes is not None else list_athletes(athletes_dir)
+    results = {}
+    for athlete in athletes:
+        with athlete_database(athlete, athletes_dir):
+            results[athlete] = function(*args, **kwargs)
+    return results
+
+
+def cohort(function, *args, athletes=None, athletes_dir=None, **kwargs):
+    """
+    Run an analysis function returning an array on every athlete and stack the results.
+
+    Example:
+        features, athlete_index = cohort(collect_window_features)
+
+    Returns:
+        Tuple of (concatenated array, athlete index of each row, athlete names)
+    """
+    results = per_athlete(function, *args, athletes=athletes, athletes_dir=athletes_dir, **kwargs)
+    names = list(results)
+    arrays = [np.asarray(results[name]) for name in names]
+    athlete_index = np.concatenate([np.full(len(array), i) for i, array in enumerate(arrays)])
+    return np.concatenate(arrays), athlete_index, names
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync every athlete of the club")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--athletes", nargs="*", help="athlete names (default: all)")
+    arguments = parser.parse_args()
+
+    for athlete, result in sync_all(arguments.athletes, arguments.workers).items():
+        print(f"{athlete}: {result}")
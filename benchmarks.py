@@ -0,0 +1,245 @@
+"""
+Benchmark suite of the analysis entry points on synthetic databases.
+Each data size is generated in its own directory and benchmarked in a fresh
+process, pointed at it with the STRAVA_DATABASE environment variable.
+Results are appended to a JSON history and compared with the previous run
+to spot regressions. The cold import time of the compute modules is measured
+against a startup budget, and they must not load matplotlib, SciPy or scikit-learn.
+
+Usage:
+    python benchmarks.py --sizes 20 100 400 --duration 3600
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+BENCHMARK_FILE = "./Results/benchmarks.json"
+
+DEFAULT_SIZES = [20, 100, 400]
+
+# A timing slower than REGRESSION_RATIO x the previous run is reported
+REGRESSION_RATIO = 1.2
+
+# Startup budget: cold import time (s) of the compute modules, which must not
+# import the plotting and fitting libraries
+STARTUP_MODULES = ['global_analysis_sql', 'specific_activity_analysis', 'create_sqlite_database']
+STARTUP_BUDGET = 0.5
+HEAVY_MODULES = ['matplotlib', 'scipy', 'sklearn']
+
+
+# ============================================================================
+# ENTRY POINTS
+# ============================================================================
+
+def entry_points():
+    """
+    Public entry points to time, imported in the benchmark process.
+
+    Returns:
+        Dictionary {name: callable without arguments}
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    import global_analysis_sql as global_analysis
+    import specific_activity_analysis as specific_analysis
+
+    def plot_corrcoef_evolution():
+        plt.figure()
+        global_analysis.plot_corrcoef_evolution()
+        plt.close('all')
+
+    return {
+        'show_global_statistics': global_analysis.show_global_statistics,
+        'get_monthly_distance': global_analysis.get_monthly_distance,
+        'plot_corrcoef_evolution': plot_corrcoef_evolution,
+        'global_windowed_average': specific_analysis.global_windowed_average,
+        'efficiency_regression_polynomial':
+            lambda: specific_analysis.efficiency_regression_polynomial(regression_degree=2),
+        'efficiency_regression_spline':
+            lambda: specific_analysis.efficiency_regression_spline(smoothing=1.0),
+        'efficiency_regression_binned_spline': specific_analysis.efficiency_regression_binned_spline,
+    }
+
+
+def time_function(function, repeat=3):
+    """Best wall time (s) of repeat calls"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_worker(repeat):
+    """Time every entry point in the current directory, print the timings as JSON"""
+    import_start = time.perf_counter()
+    functions = entry_points()
+    timings = {'import': time.perf_counter() - import_start}
+
+    for name, function in functions.items():
+        try:
+            timings[name] = time_function(function, repeat)
+        except Exception as error:
+            print(f"{name} failed: {error!r}", file=sys.stderr)
+            timings[name] = None
+    print(json.dumps(timings))
+
+
+# ============================================================================
+# STARTUP
+# ============================================================================
+
+def measure_startup(module, directory, environment):
+    """
+    Cold import of a module in a fresh interpreter.
+
+    Returns:
+        Tuple of (import time in s, heavy modules imported with it)
+    """
+    code = ("import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            f"import {module}\n"
+            "elapsed = time.perf_counter() - start\n"
+            f"print(json.dumps([elapsed, [name for name in {HEAVY_MODULES!r} if name in sys.modules]]))")
+    environment = dict(environment, PYTHONPATH=os.pathsep.join(
+        filter(None, [os.path.dirname(os.path.abspath(__file__)), environment.get('PYTHONPATH')])))
+    output = subprocess.run([sys.executable, "-c", code], cwd=directory, check=True,
+                            capture_output=True, text=True, env=environment)
+    elapsed, heavy_modules = json.loads(output.stdout.strip().splitlines()[-1])
+    return elapsed, heavy_modules
+
+
+def check_startup(directory, environment, modules=STARTUP_MODULES, budget=STARTUP_BUDGET):
+    """
+    Measure the startup of the compute modules and report the ones over budget
+    or importing a heavy module.
+
+    Returns:
+        Dictionary {'import <module>': seconds}
+    """
+    timings = {}
+    for module in modules:
+        elapsed, heavy_modules = measure_startup(module, directory, environment)
+        timings[f"import {module}"] = elapsed
+        if elapsed > budget:
+            print(f"import {module}: {elapsed:.3f} s, over the {budget} s startup budget")
+        if heavy_modules:
+            print(f"import {module} loads {', '.join(heavy_modules)}")
+    return timings
+
+
+# ============================================================================
+# SUITE
+# ============================================================================
+
+def benchmark_size(n_activities, duration, repeat, seed=0):
+    """
+    Generate a database of n_activities and time the entry points on it.
+
+    Returns:
+        Dictionary {name: seconds}
+    """
+    script = os.path.abspath(__file__)
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, MPLBACKEND='Agg',
+                           STRAVA_DATABASE=os.path.join(directory, "sqlite_activity_database.db"))
+        generation_start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(script), "synthetic_database.py"),
+                        "--activities", str(n_activities), "--duration", str(duration),
+                        "--seed", str(seed)],
+                       cwd=directory, check=True, stdout=subprocess.DEVNULL, env=environment)
+        generation_time = time.perf_counter() - generation_start
+        startup_timings = check_startup(directory, environment)
+
+        os.makedirs(os.path.join(directory, "Results"), exist_ok=True)
+        output = subprocess.run([sys.executable, script, "--worker", "--repeat", str(repeat)],
+                                cwd=directory, check=True, capture_output=True,
+                                text=True, env=environment)
+    timings = json.loads(output.stdout.strip().splitlines()[-1])
+    timings['generate_database'] = generation_time
+    timings.update(startup_timings)
+    return timings
+
+
+def run_suite(sizes=DEFAULT_SIZES, duration=3600, repeat=3, filename=BENCHMARK_FILE):
+    """
+    Benchmark every size, record the run and compare it with the previous one.
+
+    Args:
+        sizes: Numbers of activities of the synthetic databases
+        duration: Mean moving time of an activity in seconds
+        repeat: Number of calls per entry point (best time is kept)
+        filename: JSON history of the benchmark runs
+
+    Returns:
+        Dictionary of the run
+    """
+    run = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+           'duration': duration, 'results': {}}
+    for n_activities in sizes:
+        print(f"Benchmarking {n_activities} activities...")
+        run['results'][str(n_activities)] = benchmark_size(n_activities, duration, repeat)
+
+    history = []
+    if os.path.exists(filename):
+        with open(filename, "r") as f:
+            history = json.load(f)
+    previous = history[-1] if history and history[-1]['duration'] == duration else None
+
+    print_run(run, previous)
+
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    history.append(run)
+    with open(filename, "w") as f:
+        json.dump(history, f, indent=4)
+    return run
+
+
+def print_run(run, previous=None):
+    """Print the timings of a run and the ratio to the previous run"""
+    for size, timings in run['results'].items():
+        print(f"\n=== {size} activities ===")
+        previous_timings = previous['results'].get(size, {}) if previous else {}
+        for name, seconds in timings.items():
+            if seconds is None:
+                print(f"{name:<40} failed")
+                continue
+            line = f"{name:<40} {seconds:>9.3f} s"
+            reference = previous_timings.get(name)
+            if reference:
+                ratio = seconds / reference
+                line += f"   x{ratio:.2f}"
+                if ratio > REGRESSION_RATIO:
+                    line += "   REGRESSION"
+            print(line)
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--duration", type=float, default=3600)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=BENCHMARK_FILE)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.repeat)
+    else:
+        run_suite(args.sizes, args.duration, args.repeat, args.output)
@@ -0,0 +1,475 @@
+"""
+Module importing a Strava bulk-export archive (Settings > My Account > Download
+or Delete Your Account > Request your archive) without any API call.
+activities.csv gives the activity rows, the FIT / GPX / TCX files of the
+activities folder are parsed in a process pool into the same streams as
+client.get_activity_streams. Activities already having streams are skipped,
+so the API sync of create_sqlite_database.py takes over afterwards.
+
+FIT files need fitdecode or fitparse (pip install fitdecode), GPX and TCX files
+are read with the standard library.
+
+Usage:
+    python bulk_export_import.py export_12345678.zip --workers 8
+"""
+
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import zipfile
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tqdm import tqdm
+from create_sqlite_database import (encode_stream, store_activity_location, update_derived_tables,
+                                    STREAM_TYPES)
+from instrumentation import profiled
+from database import connection
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Sport types kept, as in insert_activity_data
+SPORT_TYPES = ['Run', 'TrailRun']
+
+# activities.csv column of each activity table column (last column of that name,
+# the export repeats some names and the last ones are in SI units)
+CSV_ACTIVITY_COLUMNS = {'distance': 'Distance',
+                        'moving_time': 'Moving Time',
+                        'total_elevation_gain': 'Elevation Gain',
+                        'average_speed': 'Average Speed',
+                        'max_speed': 'Max Speed',
+                        'average_cadence': 'Average Cadence',
+                        'average_watts': 'Average Watts',
+                        'average_heartrate': 'Average Heart Rate',
+                        'max_heartrate': 'Max Heart Rate',
+                        'elev_high': 'Elevation High',
+                        'elev_low': 'Elevation Low'}
+CSV_DATE_FORMAT = "%b %d, %Y, %I:%M:%S %p"
+
+# Centred moving average of the derived velocity and grade streams (samples)
+SMOOTHING_WINDOW = 5
+
+# Decimals of the stored streams
+STREAM_DECIMALS = {'time': 0, 'heartrate': 0, 'cadence': 0, 'watts': 0,
+                   'distance': 1, 'altitude': 1, 'velocity_smooth': 3, 'grade_smooth': 1}
+
+SEMICIRCLE_TO_DEGREE = 180 / 2 ** 31
+EARTH_RADIUS_M = 6371000.0
+
+# Commit every n activities
+COMMIT_EVERY = 50
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+# Archive opened once by each worker process
+_archive = None
+
+
+# ============================================================================
+# ACTIVITIES.CSV
+# ============================================================================
+
+def _float(value):
+    """Float of a CSV cell, None when empty"""
+    try:
+        return float(value.replace(',', '')) if value.strip() else None
+    except ValueError:
+        return None
+
+
+def read_activities_csv(archive):
+    """
+    Activity rows of the export.
+
+    Args:
+        archive: Opened zipfile.ZipFile of the export
+
+    Returns:
+        List of dictionaries with the activity table columns and the 'filename'
+        of the activity file in the archive (None for manual activities)
+    """
+    with archive.open('activities.csv') as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8'))
+        header = next(reader)
+        # Last index of each column name
+        column = {name: i for i, name in enumerate(header)}
+        activities = []
+        for row in reader:
+            if not row:
+                continue
+            sport_type = row[column['Activity Type']].replace(' ', '')
+            try:
+                start_date = datetime.datetime.strptime(row[column['Activity Date']],
+                                                        CSV_DATE_FORMAT)
+                start_date = str(start_date.replace(tzinfo=datetime.timezone.utc))
+            except ValueError:
+                start_date = None
+            activity = {'id': int(row[column['Activity ID']]),
+                        'sport_type': sport_type,
+                        'name': row[column['Activity Name']],
+                        'start_date': start_date,
+                        'filename': ((row[column['Filename']] or None)
+                                     if 'Filename' in column else None)}
+            for activity_column, csv_column in CSV_ACTIVITY_COLUMNS.items():
+                activity[activity_column] = (_float(row[column[csv_column]])
+                                             if csv_column in column else None)
+            activities.append(activity)
+    return activities
+
+
+# ============================================================================
+# FILE PARSING
+# ============================================================================
+
+def _local_name(tag):
+    """XML tag without its namespace"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _epoch(value):
+    """UTC epoch seconds of an ISO 8601 date (with its offset, UTC without one)"""
+    value = value.strip()
+    if value[-1:] in ('Z', 'z'):
+        value = value[:-1] + '+00:00'
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+
+def _child_values(element, names):
+    """{name: text} of the descendants of element with a local name in names"""
+    values = {}
+    for child in element.iter():
+        name = _local_name(child.tag)
+        if name in names and child.text is not None and name not in values:
+            values[name] = child.text
+    return values
+
+
+def parse_gpx(data):
+    """Records of a GPX file as {field: list} (fields of _records_to_streams)"""
+    records = {field: [] for field in ['time', 'lat', 'lng', 'altitude', 'heartrate',
+                                       'cadence', 'watts']}
+    root = ElementTree.fromstring(data.strip())
+    for point in root.iter():
+        if _local_name(point.tag) != 'trkpt':
+            continue
+        values = _child_values(point, {'time', 'ele', 'hr', 'cad', 'power'})
+        if 'time' not in values:
+            continue
+        records['time'].append(_epoch(values['time']))
+        records['lat'].append(float(point.get('lat')))
+        records['lng'].append(float(point.get('lon')))
+        records['altitude'].append(float(values.get('ele', 'nan')))
+        records['heartrate'].append(float(values.get('hr', 'nan')))
+        records['cadence'].append(float(values.get('cad', 'nan')))
+        records['watts'].append(float(values.get('power', 'nan')))
+    return records
+
+
+def parse_tcx(data):
+    """Records of a TCX file as {field: list} (fields of _records_to_streams)"""
+    records = {field: [] for field in ['time', 'lat', 'lng', 'altitude', 'distance',
+                                       'heartrate', 'cadence', 'watts']}
+    root = ElementTree.fromstring(data.strip())
+    for point in root.iter():
+        if _local_name(point.tag) != 'Trackpoint':
+            continue
+        values = _child_values(point, {'Time', 'LatitudeDegrees', 'LongitudeDegrees',
+                                       'AltitudeMeters', 'DistanceMeters', 'Value',
+                                       'Cadence', 'RunCadence', 'Watts'})
+        if 'Time' not in values:
+            continue
+        records['time'].append(_epoch(values['Time']))
+        records['lat'].append(float(values.get('LatitudeDegrees', 'nan')))
+        records['lng'].append(float(values.get('LongitudeDegrees', 'nan')))
+        records['altitude'].append(float(values.get('AltitudeMeters', 'nan')))
+        records['distance'].append(float(values.get('DistanceMeters', 'nan')))
+        # Heart rate is the only <Value> of a trackpoint (HeartRateBpm/Value)
+        records['heartrate'].append(float(values.get('Value', 'nan')))
+        records['cadence'].append(float(values.get('Cadence', values.get('RunCadence', 'nan'))))
+        records['watts'].append(float(values.get('Watts', 'nan')))
+    return records
+
+
+def _fit_messages(data):
+    """Field dictionaries of the record messages of a FIT file (fitdecode or fitparse)"""
+    try:
+        import fitdecode
+    except ImportError:
+        fitdecode = None
+    if fitdecode is not None:
+        with fitdecode.FitReader(io.BytesIO(data)) as reader:
+            for frame in reader:
+                if isinstance(frame, fitdecode.FitDataMessage) and frame.name == 'record':
+                    yield {field.name: field.value for field in frame.fields}
+        return
+
+    try:
+        import fitparse
+    except ImportError:
+        raise ImportError("FIT files require fitdecode or fitparse (pip install fitdecode)")
+    for message in fitparse.FitFile(io.BytesIO(data)).get_messages('record'):
+        yield message.get_values()
+
+
+def parse_fit(data):
+    """Records of a FIT file as {field: list} (fields of _records_to_streams)"""
+    records = {field: [] for field in ['time', 'lat', 'lng', 'altitude', 'distance',
+                                       'heartrate', 'cadence', 'watts']}
+
+    def number(value, scale=1.0):
+        return np.nan if value is None else float(value) * scale
+
+    for values in _fit_messages(data):
+        timestamp = values.get('timestamp')
+        if timestamp is None:
+            continue
+        if isinstance(timestamp, datetime.datetime):
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            timestamp = int(timestamp.timestamp())
+        records['time'].append(int(timestamp))
+        records['lat'].append(number(values.get('position_lat'), SEMICIRCLE_TO_DEGREE))
+        records['lng'].append(number(values.get('position_long'), SEMICIRCLE_TO_DEGREE))
+        records['altitude'].append(number(values.get('enhanced_altitude', values.get('altitude'))))
+        records['distance'].append(number(values.get('distance')))
+        records['heartrate'].append(number(values.get('heart_rate')))
+        records['cadence'].append(number(values.get('cadence')))
+        records['watts'].append(number(values.get('power')))
+    return records
+
+
+def _fill_missing(values):
+    """Linear interpolation of the NaN samples (None if every sample is missing)"""
+    missing = np.isnan(values)
+    if missing.all():
+        return None
+    if missing.any():
+        index = np.arange(len(values))
+        values = values.copy()
+        values[missing] = np.interp(index[missing], index[~missing], values[~missing])
+    return values
+
+
+def _smooth(values, window=SMOOTHING_WINDOW):
+    """Centred moving average keeping the length of the stream"""
+    if len(values) < window:
+        return values
+    padded = np.pad(values, window // 2, mode='edge')
+    return np.convolve(padded, np.ones(window) / window, mode='valid')
+
+
+def _records_to_streams(records):
+    """
+    Streams of an activity file, like client.get_activity_streams.
+    Distance is integrated from the GPS points when the file has none,
+    velocity_smooth and grade_smooth are derived from distance and altitude.
+
+    Args:
+        records: {field: list} of the file samples
+
+    Returns:
+        Dictionary {stream_type: numpy array}, latlng as a (n, 2) array
+    """
+    time = np.asarray(records['time'], dtype=np.int64)
+    if len(time) < 2:
+        return {}
+    order = np.argsort(time, kind='stable')
+    time = time[order]
+    keep = np.concatenate([[True], np.diff(time) > 0])
+    columns = {field: np.asarray(values, dtype=float)[order][keep]
+               for field, values in records.items() if field != 'time'}
+    time = time[keep] - time[keep][0]
+
+    streams = {'time': time.astype(float)}
+    lat, lng = columns['lat'], columns['lng']
+    has_position = ~(np.isnan(lat) | np.isnan(lng))
+    if has_position.any():
+        # Every sample is kept (positions interpolated between fixes), so latlng
+        # is aligned with the other streams as in the API
+        streams['latlng'] = np.column_stack([_fill_missing(lat), _fill_missing(lng)])
+
+    distance = _fill_missing(columns['distance']) if 'distance' in columns else None
+    if distance is None and has_position.sum() > 1:
+        # Positions are smoothed first, GPS noise would inflate the distance
+        lat_radians = np.radians(_smooth(_fill_missing(lat)))
+        lng_radians = np.radians(_smooth(_fill_missing(lng)))
+        a = (np.sin(np.diff(lat_radians) / 2) ** 2 + np.cos(lat_radians[:-1])
+             * np.cos(lat_radians[1:]) * np.sin(np.diff(lng_radians) / 2) ** 2)
+        step = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        distance = np.concatenate([[0], np.cumsum(step)])
+
+    for stream_type in ['altitude', 'heartrate', 'cadence', 'watts']:
+        values = _fill_missing(columns[stream_type])
+        if values is not None:
+            streams[stream_type] = values
+
+    if distance is not None:
+        distance = np.maximum.accumulate(distance)
+        streams['distance'] = distance
+        streams['velocity_smooth'] = _smooth(np.gradient(distance, streams['time']))
+        if 'altitude' in streams:
+            distance_step = np.gradient(distance)
+            grade = np.gradient(_smooth(streams['altitude'])) / np.where(distance_step > 0.5,
+                                                                          distance_step, np.nan)
+            streams['grade_smooth'] = np.clip(_smooth(np.nan_to_num(grade * 100)), -50, 50)
+    return streams
+
+
+def _init_worker(archive_path):
+    """Open the archive once in each worker process"""
+    global _archive
+    _archive = zipfile.ZipFile(archive_path)
+
+
+def parse_activity_file(task):
+    """
+    Parse one activity file of the archive (run in the worker processes).
+
+    Args:
+        task: Tuple of (activity_id, filename in the archive)
+
+    Returns:
+        Tuple of (activity_id, streams or None, error message or None)
+    """
+    activity_id, filename = task
+    try:
+        data = _archive.read(filename)
+        name = filename.lower()
+        if name.endswith('.gz'):
+            data = gzip.decompress(data)
+            name = name[:-3]
+        if name.endswith('.fit'):
+            records = parse_fit(data)
+        elif name.endswith('.gpx'):
+            records = parse_gpx(data)
+        elif name.endswith('.tcx'):
+            records = parse_tcx(data)
+        else:
+            return activity_id, None, f"unknown file type {filename}"
+        return activity_id, _records_to_streams(records), None
+    except Exception as e:
+        return activity_id, None, f"{filename}: {e}"
+
+
+# ============================================================================
+# DATABASE
+# ============================================================================
+
+def _stream_text(stream_type, values):
+    """Stored text of a stream (rounded JSON, encoded polyline for latlng)"""
+    if stream_type == 'latlng':
+        return encode_stream(stream_type, values)
+    values = np.round(values, STREAM_DECIMALS.get(stream_type, 3))
+    if STREAM_DECIMALS.get(stream_type) == 0:
+        return json.dumps(values.astype(np.int64).tolist())
+    return json.dumps(values.tolist())
+
+
+def store_activity(activity, streams):
+    """
+    Insert the activity row (kept if the API sync already stored it) and its streams.
+
+    Args:
+        activity: Dictionary from read_activities_csv
+        streams: Dictionary {stream_type: array} (may be empty)
+    """
+    columns = [column for column in ['id', 'sport_type', 'name', 'start_date']
+               + list(CSV_ACTIVITY_COLUMNS) if activity.get(column) is not None]
+    if streams.get('heartrate') is not None:
+        columns.append('has_heartrate')
+        activity = dict(activity, has_heartrate=1.0)
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO activity ({', '.join(columns)})
+        VALUES ({', '.join('?' for _ in columns)});
+    """, [activity[column] for column in columns])
+
+    if 'latlng' in streams and len(streams['latlng']):
+        store_activity_location(activity['id'], streams['latlng'][0].tolist(),
+                                streams['latlng'][-1].tolist(), cursor)
+    if streams:
+        cursor.executemany("""
+            INSERT OR REPLACE INTO streams (id, stream_type, stream_value)
+            VALUES (?, ?, ?);
+        """, [(activity['id'], stream_type,
+               _stream_text(stream_type, streams[stream_type]) if stream_type in streams
+               else json.dumps([]))
+              for stream_type in STREAM_TYPES])
+
+
+@profiled()
+def import_archive(archive_path, workers=None, sport_types=SPORT_TYPES):
+    """
+    Import the activities of a bulk-export archive that have no streams yet.
+
+    Args:
+        archive_path: Path of the export ZIP
+        workers: Number of parsing processes, defaults to the number of CPUs
+        sport_types: Sport types imported (None for every sport)
+
+    Returns:
+        Tuple of (number of imported activities, list of error messages)
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        activities = read_activities_csv(archive)
+        archive_files = set(archive.namelist())
+
+    existing = {row[0] for row in cursor.execute("SELECT DISTINCT id FROM streams;").fetchall()}
+    activities = [activity for activity in activities if activity['id'] not in existing
+                  and (sport_types is None or activity['sport_type'] in sport_types)]
+    activities_by_id = {activity['id']: activity for activity in activities}
+
+    tasks = [(activity['id'], activity['filename']) for activity in activities
+             if activity['filename'] in archive_files]
+    imported, errors = 0, []
+
+    # Manual activities (no file) only have their activity row
+    for activity in activities:
+        if activity['filename'] not in archive_files:
+            store_activity(activity, {})
+    conn.commit()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(archive_path,)) as executor:
+        results = executor.map(parse_activity_file, tasks, chunksize=8)
+        for activity_id, streams, error in tqdm(results, total=len(tasks),
+                                                desc="Importing activities"):
+            if error is not None:
+                errors.append(error)
+                continue
+            store_activity(activities_by_id[activity_id], streams)
+            imported += 1
+            if imported % COMMIT_EVERY == 0:
+                conn.commit()
+    conn.commit()
+    return imported, errors
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a Strava bulk-export archive")
+    parser.add_argument("archive", help="export ZIP file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--all-sports", action="store_true",
+                        help="import every sport type, not only runs")
+    arguments = parser.parse_args()
+
+    imported, errors = import_archive(arguments.archive, arguments.workers,
+                                      None if arguments.all_sports else SPORT_TYPES)
+    for error in errors:
+        print(f"Skipped {error}")
+    print(f"Imported activities: {imported}")
+    update_derived_tables()
@@ -1,68 +1,104 @@
-import sqlite3
-from api_call import client
 import json
 from tqdm import tqdm
 from datetime import datetime
+from instrumentation import profiled
+from database import connection, register_schema
+from polyline import encode_polyline
+from route_matching import update_route_signatures
+from zone_histograms import update_zone_histograms
+from duration_curves import update_duration_curves
+from aerobic_decoupling import update_aerobic_decoupling
+from stream_chunks import update_stream_chunks
+from gap_statistics import update_gap_statistics
+from splits import update_splits
+from weather import update_activity_weather
 
 
-conn = sqlite3.connect("sqlite_activity_database.db")
+conn = connection()
 cursor = conn.cursor()
 
 # Columns of activity table
 LIST_ACTIVITY_DATA_TYPES = ['distance', 'moving_time', 'total_elevation_gain',
                              'average_speed', 'max_speed', 'average_cadence',
                              'average_watts', 'kilojoules', 'has_heartrate', 
-                             'average_heartrate', 'max_heartrate', 'elev_high', 'elev_low','start_latlng','end_latlng']
+                             'average_heartrate', 'max_heartrate', 'elev_high', 'elev_low']
+
+# Start and end coordinates, stored as separate lat/lng columns of activity
+# and indexed in the R*Tree tables activity_start_rtree / activity_end_rtree
+LATLNG_DATA_TYPES = ['start_latlng', 'end_latlng']
+LOCATION_COLUMNS = ['start_lat', 'start_lng', 'end_lat', 'end_lng']
+
+# Activities per page of get_activities() (stravalib default), one API call each
+ACTIVITIES_PAGE_SIZE = 200
 
 STREAM_TYPES = ['time', 'distance', 'heartrate', 'altitude', 'cadence', 
-                'grade_smooth', 'velocity_smooth', 'watts']
-
-# Create activity table
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS activity (
-    id INTEGER PRIMARY KEY,
-    sport_type TEXT,
-    name TEXT,
-    start_date_local TEXT
-);
-""")
-
-# Add columns dynamically
-activity_columns = cursor.execute("PRAGMA table_info(activity);").fetchall()
-activity_columns = [column[1] for column in activity_columns]
-for activity_data_type in LIST_ACTIVITY_DATA_TYPES:
-    if activity_data_type not in activity_columns:
+                'grade_smooth', 'velocity_smooth', 'watts', 'latlng']
+
+def create_schema(cursor):
+    """Create the tables and indexes of the database if they do not exist"""
+    # Create activity table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS activity (
+        id INTEGER PRIMARY KEY,
+        sport_type TEXT,
+        name TEXT,
+        start_date TEXT,
+        start_date_local TEXT
+    );
+    """)
+
+    # Add columns dynamically
+    activity_columns = cursor.execute("PRAGMA table_info(activity);").fetchall()
+    activity_columns = [column[1] for column in activity_columns]
+    if 'start_date' not in activity_columns:
+        cursor.execute("ALTER TABLE activity ADD COLUMN start_date TEXT;")
+    for activity_data_type in LIST_ACTIVITY_DATA_TYPES + LOCATION_COLUMNS:
+        if activity_data_type not in activity_columns:
+            cursor.execute(f"""
+            ALTER TABLE activity
+            ADD COLUMN {activity_data_type} REAL;
+            """)
+    # Set once the location of an activity has been looked up (it may have no GPS)
+    if 'location_checked' not in activity_columns:
+        cursor.execute("ALTER TABLE activity ADD COLUMN location_checked INTEGER;")
+
+    # Spatial indexes of the start and end points (points are degenerate boxes)
+    for point in ['start', 'end']:
         cursor.execute(f"""
-        ALTER TABLE activity
-        ADD COLUMN {activity_data_type} REAL;
+        CREATE VIRTUAL TABLE IF NOT EXISTS activity_{point}_rtree USING rtree(
+            id,
+            min_lat, max_lat,
+            min_lng, max_lng
+        );
         """)
 
-# Create streams table
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS streams (
-    id INTEGER,
-    stream_type TEXT,
-    stream_value TEXT,
-    PRIMARY KEY (id, stream_type),
-    FOREIGN KEY (id) REFERENCES activity(id)
-);
-""")
-
-# Create index for faster queries
-cursor.execute("""
-CREATE INDEX IF NOT EXISTS idx_streams_id ON streams(id);
-""")
-
-# Track API calls (optional but useful)
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS api_calls (
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-    endpoint TEXT,
-    activity_id INTEGER
-);
-""")
-
-conn.commit()
+    # Create streams table
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS streams (
+        id INTEGER,
+        stream_type TEXT,
+        stream_value TEXT,
+        PRIMARY KEY (id, stream_type),
+        FOREIGN KEY (id) REFERENCES activity(id)
+    );
+    """)
+
+    # Create index for faster queries
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_streams_id ON streams(id);
+    """)
+
+    # Track API calls (optional but useful)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS api_calls (
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        endpoint TEXT,
+        activity_id INTEGER
+    );
+    """)
+
+
+register_schema(create_schema)
 
 
 def log_api_call(endpoint, activity_id=None):
@@ -73,11 +109,122 @@ def log_api_call(endpoint, activity_id=None):
     """, (endpoint, activity_id))
 
 
-def insert_activity_data():
-    """Insert activity data, using cached data from get_activities() first"""
-    print("Fetching activities list...")
+def iter_activity_summaries(client):
+    """Activity summaries of get_activities(), logging one API call per page"""
     log_api_call('get_activities')
-    activities = client.get_activities()
+    for index, activity in enumerate(client.get_activities(), start=1):
+        yield activity
+        if index % ACTIVITIES_PAGE_SIZE == 0:
+            log_api_call('get_activities')
+
+
+def latlng_values(latlng):
+    """
+    Latitude and longitude of a stravalib LatLon (or [lat, lng] list).
+    
+    Returns:
+        Tuple (lat, lng), (None, None) when the activity has no GPS position
+    """
+    if not latlng:
+        return None, None
+    try:
+        return float(latlng.lat), float(latlng.lon)
+    except AttributeError:
+        pass
+    try:
+        return float(latlng[0]), float(latlng[1])
+    except (TypeError, IndexError, ValueError):
+        return None, None
+
+
+def store_activity_location(activity_id, start_latlng, end_latlng, location_cursor=None):
+    """
+    Store start and end coordinates in the activity columns and the R*Tree indexes.
+    
+    Args:
+        activity_id: Strava activity ID
+        start_latlng: Start LatLon (or [lat, lng])
+        end_latlng: End LatLon (or [lat, lng])
+        location_cursor: Cursor to write with, defaults to the module cursor
+    """
+    location_cursor = location_cursor or cursor
+    start_lat, start_lng = latlng_values(start_latlng)
+    end_lat, end_lng = latlng_values(end_latlng)
+    location_cursor.execute("""
+        UPDATE activity SET start_lat = ?, start_lng = ?, end_lat = ?, end_lng = ?,
+        location_checked = 1
+        WHERE id = ?;
+    """, (start_lat, start_lng, end_lat, end_lng, activity_id))
+    
+    for point, lat, lng in [('start', start_lat, start_lng), ('end', end_lat, end_lng)]:
+        if lat is None:
+            location_cursor.execute(f"DELETE FROM activity_{point}_rtree WHERE id = ?;",
+                                    (activity_id,))
+        else:
+            location_cursor.execute(f"""
+                INSERT OR REPLACE INTO activity_{point}_rtree (id, min_lat, max_lat, min_lng, max_lng)
+                VALUES (?, ?, ?, ?, ?);
+            """, (activity_id, lat, lat, lng, lng))
+
+
+def rebuild_location_index():
+    """Rebuild the R*Tree indexes from the lat/lng columns of the activity table"""
+    for point in ['start', 'end']:
+        cursor.execute(f"DELETE FROM activity_{point}_rtree;")
+        cursor.execute(f"""
+            INSERT INTO activity_{point}_rtree (id, min_lat, max_lat, min_lng, max_lng)
+            SELECT id, {point}_lat, {point}_lat, {point}_lng, {point}_lng FROM activity
+            WHERE {point}_lat IS NOT NULL AND {point}_lng IS NOT NULL;
+        """)
+    conn.commit()
+
+
+def backfill_locations(client=None):
+    """
+    Fill the coordinates of activities stored before the lat/lng columns existed.
+    Uses the activity summaries of get_activities() (one call per page).
+    Every activity is looked up once, those without GPS are not fetched again.
+    
+    Args:
+        client: Strava client, defaults to the client of api_call.py
+    """
+    missing = cursor.execute("""
+        SELECT id FROM activity WHERE start_lat IS NULL AND location_checked IS NULL;
+    """).fetchall()
+    missing = {item[0] for item in missing}
+    if not missing:
+        return
+    
+    if client is None:
+        from api_call import client
+    for activity in iter_activity_summaries(client):
+        if activity.id in missing:
+            store_activity_location(activity.id, activity.start_latlng, activity.end_latlng)
+    # Activities not returned by the API (deleted, other athlete) are not looked up again
+    cursor.executemany("UPDATE activity SET location_checked = 1 WHERE id = ?;",
+                       [(activity_id,) for activity_id in missing])
+    conn.commit()
+
+
+def encode_stream(stream_type, data):
+    """Text stored for a stream: encoded polyline for latlng, JSON list otherwise"""
+    if stream_type == 'latlng' and len(data) > 0:
+        return encode_polyline(data)
+    return json.dumps(data)
+
+
+@profiled()
+def insert_activity_data(client=None):
+    """
+    Insert activity data, using cached data from get_activities() first
+    
+    Args:
+        client: Strava client, defaults to the client of api_call.py
+    """
+    if client is None:
+        from api_call import client
+    print("Fetching activities list...")
+    activities = iter_activity_summaries(client)
     activities = [activity for activity in activities 
                   if activity.sport_type in ['Run', 'TrailRun']]
     activities_dict = {a.id: a for a in activities}
@@ -108,16 +255,16 @@ def insert_activity_data():
                             """, (float(activity_data_value) if activity_data_value else None, 
                                 activity_id))
                         except TypeError:
-                            if type(activity_data_value)=='LatLon':
-                                cursor.execute(f"""
-                                    UPDATE activity SET {activity_data_type} = ? WHERE id = ?;
-                                """, ((activity_data_value) if activity_data_value else None, 
-                                    activity_id))
+                            pass
                     else:
                         needs_detailed_fetch = True
                 except AttributeError:
                     needs_detailed_fetch = True
             
+            store_activity_location(activity_id,
+                                    getattr(activity, 'start_latlng', None),
+                                    getattr(activity, 'end_latlng', None))
+            
             # Only fetch detailed activity if necessary
             if needs_detailed_fetch:
                 print(f"\nFetching detailed data for activity {activity_id}...")
@@ -145,8 +292,16 @@ def insert_activity_data():
     conn.commit()
 
 
-def insert_stream_data():
-    """Insert stream data only for activities that don't have streams yet"""
+@profiled()
+def insert_stream_data(client=None):
+    """
+    Insert stream data only for activities that don't have streams yet
+    
+    Args:
+        client: Strava client, defaults to the client of api_call.py
+    """
+    if client is None:
+        from api_call import client
     activities = client.get_activities()
     activities = [activity for activity in activities 
                   if activity.sport_type in ['Run', 'TrailRun']]
@@ -178,7 +333,7 @@ def insert_stream_data():
                 
                 for stream_type in STREAM_TYPES:
                     try:
-                        stream_json = json.dumps(streams[stream_type].data)
+                        stream_json = encode_stream(stream_type, streams[stream_type].data)
                     except (KeyError, AttributeError):
                         stream_json = json.dumps([])
                     
@@ -195,6 +350,19 @@ def insert_stream_data():
                 conn.rollback()
 
 
+def update_derived_tables():
+    """Compute the per-activity derived tables of the newly inserted activities"""
+    print("Updating derived tables...")
+    update_stream_chunks()
+    update_route_signatures()
+    update_zone_histograms()
+    update_duration_curves()
+    update_aerobic_decoupling()
+    update_gap_statistics()
+    update_splits()
+    update_activity_weather(missing_only=True)
+
+
 def get_api_call_stats():
     """Check how many API calls were made"""
     result = cursor.execute("""
@@ -239,7 +407,9 @@ def get_api_call_stats():
 if __name__ == "__main__":
     try:
         insert_activity_data()
+        backfill_locations()
         insert_stream_data()
+        update_derived_tables()
         get_api_call_stats()
     finally:
         conn.commit()
@@ -258,4 +428,8 @@ if __name__ == "__main__":
 # 1001 | heartrate   | [val1, val2, ...]
 # 1001 | distance    | [val1, val2, ...]
 # 1002 | heartrate   | [val1, val2, ...]
-# 1002 | distance    | [val1, val2, ...]
\ No newline at end of file
+# 1002 | distance    | [val1, val2, ...]
+# 1002 | latlng      | encoded polyline
+#Tables activity_start_rtree / activity_end_rtree (R*Tree, one point per activity)
+# id | min_lat | max_lat | min_lng | max_lng
+# 1001 | 45.18 | 45.18 | 5.72 | 5.72
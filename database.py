@@ -0,0 +1,260 @@
+"""
+Connection layer of the activity database.
+Every module gets its connection and cursor from here instead of opening
+sqlite_activity_database.db itself:
+
+    conn = connection(read_only=True)
+    cursor = conn.cursor()
+
+conn and cursor are proxies: each thread (and each process after a fork) gets
+its own sqlite3 connection, opened lazily on first use, so module-level code
+such as cursor.execute(...) is unchanged and safe from threads and process pools.
+Writers share one connection per thread, analysis readers use read-only URI
+connections. The database is in WAL mode with a busy timeout, so analysis runs
+while a sync is writing.
+
+The database path is read from the environment variable STRAVA_DATABASE
+(default sqlite_activity_database.db) or set with set_database(), and can be
+switched for the calling thread only with use_database() (one database per athlete).
+Tables are declared with register_schema() and created in every database
+a writer connection is opened on.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from instrumentation import instrument_connection
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+DATABASE_FILE = os.environ.get("STRAVA_DATABASE", "sqlite_activity_database.db")
+
+# Time a connection waits for a lock before raising "database is locked" (ms)
+BUSY_TIMEOUT_MS = 10000
+
+# Functions called with every new raw sqlite3 connection (e.g. to register SQL functions)
+_connection_hooks = []
+
+# Table declarations (SQL statements or functions taking a cursor) run on every writer connection
+_schema = []
+
+# Per-thread {(pid, path, read_only): connection} and database override
+_local = threading.local()
+_wal_checked = set()
+_wal_lock = threading.Lock()
+
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+def set_database(path):
+    """
+    Use another database file.
+    Connections already opened on the previous file stay open,
+    the next queries of every module go to the new file.
+
+    Args:
+        path: SQLite database file
+    """
+    global DATABASE_FILE
+    DATABASE_FILE = str(path)
+
+
+def current_database():
+    """Database file of the calling thread"""
+    return getattr(_local, 'database', None) or DATABASE_FILE
+
+
+def database_path():
+    """Absolute path of the database file of the calling thread"""
+    return str(Path(current_database()).resolve())
+
+
+@contextlib.contextmanager
+def use_database(path):
+    """
+    Use another database file in the calling thread only, e.g. one database per
+    athlete synced in parallel threads.
+
+    Args:
+        path: SQLite database file
+    """
+    previous = getattr(_local, 'database', None)
+    _local.database = str(path)
+    try:
+        yield
+    finally:
+        _local.database = previous
+
+
+def add_connection_hook(hook):
+    """
+    Call a function with every new sqlite3 connection, and with the ones
+    already opened by the calling thread.
+
+    Args:
+        hook: Function taking a sqlite3.Connection
+    """
+    if hook in _connection_hooks:
+        return
+    _connection_hooks.append(hook)
+    for existing in getattr(_local, 'connections', {}).values():
+        hook(existing)
+
+
+def register_schema(*statements):
+    """
+    Declare tables of a module. They are created now in the database of the
+    calling thread, and in every database a writer connection is opened on later.
+
+    Args:
+        statements: SQL statements (CREATE ... IF NOT EXISTS) or functions taking a cursor
+    """
+    _schema.extend(statements)
+    writer = get_connection()
+    _apply_schema(writer, statements)
+    writer.commit()
+
+
+def _apply_schema(schema_connection, statements):
+    schema_cursor = schema_connection.cursor()
+    for statement in statements:
+        if callable(statement):
+            statement(schema_cursor)
+        else:
+            schema_cursor.execute(statement)
+
+
+# ============================================================================
+# CONNECTIONS
+# ============================================================================
+
+def _enable_wal(path):
+    """Switch the database to WAL once per process (the mode is stored in the file)"""
+    with _wal_lock:
+        if path in _wal_checked:
+            return
+        _wal_checked.add(path)
+        try:
+            writer = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+            writer.execute("PRAGMA journal_mode=WAL;")
+            writer.close()
+        except sqlite3.OperationalError:
+            # Read-only file system or database locked: keep the current mode
+            pass
+
+
+def open_connection(read_only=False, path=None):
+    """
+    Open a new connection (not shared, the caller closes it).
+
+    Args:
+        read_only: Open with the read-only URI mode
+        path: Database file, defaults to the current one
+
+    Returns:
+        sqlite3 connection (instrumented when the instrumentation is enabled)
+    """
+    path = str(Path(path or current_database()).resolve())
+    if read_only:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Database not found: {path}")
+        _enable_wal(path)
+        raw_connection = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro", uri=True,
+                                         timeout=BUSY_TIMEOUT_MS / 1000)
+    else:
+        _enable_wal(path)
+        raw_connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    raw_connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};")
+    for hook in _connection_hooks:
+        hook(raw_connection)
+    if not read_only and _schema:
+        _apply_schema(raw_connection, _schema)
+        raw_connection.commit()
+    return instrument_connection(raw_connection)
+
+
+def get_connection(read_only=False):
+    """
+    Connection of the calling thread, opened on first use.
+
+    Args:
+        read_only: Read-only connection (analysis) or writer connection (ingestion)
+
+    Returns:
+        sqlite3 connection (instrumented when the instrumentation is enabled)
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (os.getpid(), current_database(), read_only)
+    if key not in connections:
+        connections[key] = open_connection(read_only, key[1])
+    return connections[key]
+
+
+def close_connections():
+    """Close the connections of the calling thread"""
+    for key, existing in list(getattr(_local, 'connections', {}).items()):
+        if key[0] == os.getpid():
+            existing.close()
+    _local.connections = {}
+
+
+# ============================================================================
+# PROXIES
+# ============================================================================
+
+class ConnectionProxy:
+    """Module-level connection resolving to the connection of the calling thread"""
+
+    def __init__(self, read_only=False):
+        self.read_only = read_only
+
+    def cursor(self):
+        return CursorProxy(self.read_only)
+
+    def close(self):
+        close_connections()
+
+    def __getattr__(self, name):
+        return getattr(get_connection(self.read_only), name)
+
+
+class CursorProxy:
+    """Module-level cursor resolving to a cursor of the calling thread's connection"""
+
+    def __init__(self, read_only=False):
+        self.read_only = read_only
+        self._local = threading.local()
+
+    def _cursor(self):
+        connection = get_connection(self.read_only)
+        if getattr(self._local, 'connection', None) is not connection:
+            self._local.connection = connection
+            self._local.cursor = connection.cursor()
+        return self._local.cursor
+
+    def __iter__(self):
+        return iter(self._cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor(), name)
+
+
+def connection(read_only=False):
+    """
+    Module-level connection proxy.
+
+    Args:
+        read_only: True for analysis modules, False for modules writing tables
+
+    Returns:
+        ConnectionProxy (use conn.cursor() for the module cursor)
+    """
+    return ConnectionProxy(read_only)
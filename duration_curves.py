@@ -0,0 +1,224 @@
+"""
+Module for mean-maximal duration curves (best average speed, power and heart rate
+over durations from 5 s to 2 h).
+Curves are computed once per activity with cumulative-sum sliding windows and
+stored in the duration_curve table. Lifetime and rolling envelopes are maxima
+over the stored curves, computed in SQL.
+"""
+
+import numpy as np
+from specific_activity_analysis import iter_activity_streams, resample_stream
+from instrumentation import profiled
+from database import connection, register_schema
+from lazy_imports import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Durations of the curve (s)
+DURATION_LADDER = [5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 420, 600, 900,
+                   1200, 1800, 2700, 3600, 5400, 7200]
+
+# Stream of each curve and conversion factor
+CURVE_STREAMS = {'speed': ('velocity_smooth', 3.6),
+                 'power': ('watts', 1.0),
+                 'heartrate': ('heartrate', 1.0)}
+
+CURVE_UNITS = {'speed': 'km/h', 'power': 'W', 'heartrate': 'bpm'}
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS duration_curve (
+    id INTEGER,
+    feature TEXT,
+    duration INTEGER,
+    best_value REAL,
+    PRIMARY KEY (id, feature, duration),
+    FOREIGN KEY (id) REFERENCES activity(id)
+);
+""", """
+CREATE INDEX IF NOT EXISTS idx_duration_curve_feature ON duration_curve(feature, duration);
+""")
+
+
+# ============================================================================
+# CURVES
+# ============================================================================
+
+def mean_maximal(values, durations=DURATION_LADDER, grid_step=1.0):
+    """
+    Best average of a uniformly sampled stream over each duration.
+    Window sums are differences of the cumulative sum, O(n) per duration.
+
+    Args:
+        values: Stream on a uniform grid (NaN samples invalidate their windows)
+        durations: Durations in seconds
+        grid_step: Grid spacing in seconds
+
+    Returns:
+        Array of best averages (NaN when the stream is shorter than the duration)
+    """
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    cumulative = np.concatenate([[0], np.cumsum(np.where(missing, 0, values))])
+    cumulative_missing = np.concatenate([[0], np.cumsum(missing)])
+
+    best = np.full(len(durations), np.nan)
+    for i, duration in enumerate(durations):
+        size = int(round(duration / grid_step))
+        if size < 1 or size > len(values):
+            continue
+        window_sum = cumulative[size:] - cumulative[:-size]
+        complete = (cumulative_missing[size:] - cumulative_missing[:-size]) == 0
+        if complete.any():
+            best[i] = window_sum[complete].max() / size
+    return best
+
+
+def activity_duration_curves(streams, durations=DURATION_LADDER, grid_step=1.0):
+    """
+    Duration curves of one activity, on moving time (pauses are removed).
+
+    Args:
+        streams: Stream bundle {stream_type: array} with the 'time' stream
+        durations: Durations in seconds
+        grid_step: Resampling grid spacing in seconds
+
+    Returns:
+        Dictionary {feature: array of best averages}
+    """
+    curves = {}
+    for feature, (stream_type, factor) in CURVE_STREAMS.items():
+        data = streams.get(stream_type)
+        if data is None or len(data) == 0:
+            continue
+        _, grid_data, pause_mask = resample_stream(streams['time'], data * factor, grid_step)
+        if len(grid_data) == 0:
+            continue
+        curves[feature] = mean_maximal(grid_data[~pause_mask], durations, grid_step)
+    return curves
+
+
+@profiled()
+def update_duration_curves(activity_ids=None):
+    """
+    Compute and store the duration curves of the activities not processed yet.
+
+    Args:
+        activity_ids: Activities to (re)compute, defaults to the new ones
+
+    Returns:
+        Number of processed activities
+    """
+    if activity_ids is None:
+        activity_ids = [row[0] for row in cursor.execute("""
+            SELECT DISTINCT s.id FROM streams s
+            WHERE s.stream_type = 'time'
+            AND NOT EXISTS (SELECT 1 FROM duration_curve d WHERE d.id = s.id);
+        """).fetchall()]
+    if not activity_ids:
+        return 0
+
+    stream_types = ['time'] + [stream_type for stream_type, _ in CURVE_STREAMS.values()]
+    n_processed = 0
+    for activity_id, streams in iter_activity_streams(activity_ids, stream_types,
+                                                      require_all=False):
+        if 'time' not in streams:
+            continue
+        rows = [(activity_id, feature, duration, float(value))
+                for feature, curve in activity_duration_curves(streams).items()
+                for duration, value in zip(DURATION_LADDER, curve) if not np.isnan(value)]
+        # A NULL row marks activities without any curve, they are not reprocessed
+        rows = rows or [(activity_id, None, 0, None)]
+        cursor.executemany("""
+            INSERT OR REPLACE INTO duration_curve (id, feature, duration, best_value)
+            VALUES (?, ?, ?, ?);
+        """, rows)
+        n_processed += 1
+    conn.commit()
+    return n_processed
+
+
+# ============================================================================
+# ENVELOPES
+# ============================================================================
+
+def duration_envelope(feature='speed', start_date=None, end_date=None):
+    """
+    Best value over all stored curves for each duration.
+
+    Args:
+        feature: {"speed","power","heartrate"}
+        start_date: First date included ('YYYY-MM-DD'), None for no limit
+        end_date: Last date included ('YYYY-MM-DD'), None for no limit
+
+    Returns:
+        Tuple of (durations, best values, activity IDs of the best values)
+    """
+    result = cursor.execute("""
+        SELECT d.duration, MAX(d.best_value), d.id
+        FROM duration_curve d JOIN activity a ON a.id = d.id
+        WHERE d.feature = ?
+        AND (? IS NULL OR date(a.start_date) >= date(?))
+        AND (? IS NULL OR date(a.start_date) <= date(?))
+        GROUP BY d.duration
+        ORDER BY d.duration;
+    """, (feature, start_date, start_date, end_date, end_date)).fetchall()
+
+    durations = np.array([row[0] for row in result])
+    best_values = np.array([row[1] for row in result], dtype=float)
+    activity_ids = [row[2] for row in result]
+    return durations, best_values, activity_ids
+
+
+def lifetime_envelope(feature='speed'):
+    """Lifetime best value for each duration (see duration_envelope)"""
+    return duration_envelope(feature)
+
+
+def rolling_envelope(feature='speed', days=90, end_date=None):
+    """
+    Best value for each duration over the last days before end_date.
+
+    Args:
+        feature: {"speed","power","heartrate"}
+        days: Length of the rolling period
+        end_date: Last date ('YYYY-MM-DD'), defaults to today
+    """
+    end_date = end_date or cursor.execute("SELECT date('now');").fetchone()[0]
+    start_date = cursor.execute("SELECT date(?, ?);", (end_date, f"-{days} days")).fetchone()[0]
+    return duration_envelope(feature, start_date, end_date)
+
+
+def plot_duration_curves(feature='speed', days=90, end_date=None, save=False):
+    """Lifetime and rolling envelopes of a feature, durations in log scale"""
+    durations, lifetime, _ = lifetime_envelope(feature)
+    rolling_durations, rolling, _ = rolling_envelope(feature, days, end_date)
+    plt.plot(durations, lifetime, color='#FC4C02', marker='o', label='Lifetime')
+    plt.plot(rolling_durations, rolling, color='gray', marker='o', label=f'Last {days} days')
+    plt.xscale('log')
+    plt.xlabel("Duration (s)")
+    plt.ylabel(f"Best average {feature} ({CURVE_UNITS[feature]})")
+    plt.title(f"Mean-maximal {feature} curve")
+    plt.grid(True, alpha=0.3)
+    plt.legend()
+    if save:
+        plt.savefig(f"./Results/duration_curve_{feature}.png", dpi=300)
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"Processed activities: {update_duration_curves()}")
+    for feature in CURVE_STREAMS:
+        plt.figure()
+        plot_duration_curves(feature, save=True)
+    plt.show()
@@ -0,0 +1,233 @@
+"""
+Module for the selection of the GAP (Grade Adjusted Pace) model.
+Loads the window features once, scores a grid of polynomial degrees and
+spline smoothings by k-fold cross-validation in parallel, and persists the best model.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.interpolate as interpolate
+from specific_activity_analysis import collect_window_features, fit_binned_spline
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Default file of the selected model
+GAP_MODEL_FILE = "gap_model.json"
+
+POLYNOMIAL_DEGREES = [1, 2, 3, 4, 5, 6]
+
+# Smoothing of the binned spline, as a multiple of the number of bins
+SPLINE_SMOOTHING_FACTORS = [0.25, 0.5, 1, 2, 4, 8]
+
+N_FOLDS = 5
+
+
+# ============================================================================
+# DATA
+# ============================================================================
+
+def load_gap_dataset(n_folds=N_FOLDS, seed=42):
+    """
+    Load the gradient and normalized efficiency of all windows once,
+    and assign each activity to a cross-validation fold.
+    Folds are built by activity: windows of the same run are correlated,
+    they would leak between training and validation sets otherwise.
+
+    Args:
+        n_folds: Number of folds
+        seed: Seed of the fold assignment
+
+    Returns:
+        Tuple of (gradient, efficiency, fold) numpy arrays
+    """
+    features, activity_ids = collect_window_features(return_activity_ids=True)
+    gradient = features[:, 1]
+    efficiency = features[:, 3]
+
+    mask = ~(np.isnan(gradient) | np.isnan(efficiency))
+    gradient, efficiency, activity_ids = gradient[mask], efficiency[mask], activity_ids[mask]
+
+    unique_ids, activity_index = np.unique(activity_ids, return_inverse=True)
+    rng = np.random.default_rng(seed)
+    activity_fold = rng.permutation(len(unique_ids)) % n_folds
+
+    return gradient, efficiency, activity_fold[activity_index]
+
+
+# ============================================================================
+# MODELS
+# ============================================================================
+
+def candidate_models(polynomial_degrees=POLYNOMIAL_DEGREES,
+                     smoothing_factors=SPLINE_SMOOTHING_FACTORS):
+    """
+    Grid of candidate models.
+
+    Returns:
+        List of (regression, parameter) tuples
+    """
+    return ([('polynomial', degree) for degree in polynomial_degrees]
+            + [('binned', factor) for factor in smoothing_factors])
+
+
+def fit_model(regression, parameter, gradient, efficiency):
+    """
+    Fit one candidate model.
+
+    Args:
+        regression: {"polynomial","binned"}
+        parameter: Polynomial degree or smoothing factor (multiple of the number of bins)
+        gradient: Gradient of each window (%)
+        efficiency: Normalized efficiency of each window
+
+    Returns:
+        Callable model (np.poly1d or B-spline)
+    """
+    if regression == 'polynomial':
+        return np.poly1d(np.polyfit(gradient, efficiency, parameter))
+    elif regression == 'binned':
+        return fit_binned_spline(gradient, efficiency, smoothing_factor=parameter)
+    raise ValueError(f"Unknown regression: {regression}")
+
+
+# Dataset of the worker processes, set once by _init_worker
+_dataset = {}
+
+
+def _init_worker(gradient, efficiency, fold):
+    """Keep the dataset in the worker, it is sent once per process and not per task"""
+    _dataset['gradient'] = gradient
+    _dataset['efficiency'] = efficiency
+    _dataset['fold'] = fold
+
+
+def cross_validate(candidate):
+    """
+    K-fold cross-validated error of one candidate on the worker dataset.
+
+    Args:
+        candidate: (regression, parameter) tuple
+
+    Returns:
+        Dictionary with the regression, parameter, cross-validated RMSE (mean and std
+        over folds) and out-of-fold R squared
+    """
+    regression, parameter = candidate
+    gradient, efficiency, fold = _dataset['gradient'], _dataset['efficiency'], _dataset['fold']
+
+    fold_rmse = []
+    prediction = np.full(len(gradient), np.nan)
+    for k in np.unique(fold):
+        validation = fold == k
+        try:
+            model = fit_model(regression, parameter, gradient[~validation], efficiency[~validation])
+        except ValueError:
+            return {'regression': regression, 'parameter': parameter,
+                    'cv_rmse': np.inf, 'cv_rmse_std': np.nan, 'cv_r2': np.nan}
+        prediction[validation] = model(gradient[validation])
+        fold_rmse.append(np.sqrt(np.mean((prediction[validation] - efficiency[validation]) ** 2)))
+
+    residual = np.sum((prediction - efficiency) ** 2)
+    total = np.sum((efficiency - efficiency.mean()) ** 2)
+    return {'regression': regression, 'parameter': parameter,
+            'cv_rmse': float(np.mean(fold_rmse)), 'cv_rmse_std': float(np.std(fold_rmse)),
+            'cv_r2': float(1 - residual / total)}
+
+
+# ============================================================================
+# MODEL SELECTION
+# ============================================================================
+
+def select_gap_model(candidates=None, n_folds=N_FOLDS, max_workers=None,
+                     filename=GAP_MODEL_FILE, dataset=None):
+    """
+    Rank candidate GAP models by cross-validated error and persist the best one.
+
+    Args:
+        candidates: List of (regression, parameter), defaults to candidate_models()
+        n_folds: Number of folds
+        max_workers: Number of worker processes, defaults to the number of CPUs
+        filename: File of the best model, not saved if None
+        dataset: (gradient, efficiency, fold) from load_gap_dataset, loaded when not given
+
+    Returns:
+        Ranked list of result dictionaries (best first)
+    """
+    if candidates is None:
+        candidates = candidate_models()
+    if dataset is None:
+        dataset = load_gap_dataset(n_folds)
+    gradient, efficiency, fold = dataset
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(candidates))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(gradient, efficiency, fold)) as executor:
+        results = list(executor.map(cross_validate, candidates))
+
+    ranking = sorted(results, key=lambda result: result['cv_rmse'])
+
+    if filename is not None:
+        best = ranking[0]
+        model = fit_model(best['regression'], best['parameter'], gradient, efficiency)
+        save_gap_model(model, best, filename)
+
+    return ranking
+
+
+def print_ranking(ranking):
+    """Print the ranked table of select_gap_model"""
+    print(f"{'rank':>4} {'regression':<12} {'parameter':>9} {'cv_rmse':>10} {'std':>10} {'cv_r2':>8}")
+    for rank, result in enumerate(ranking, start=1):
+        print(f"{rank:>4} {result['regression']:<12} {result['parameter']:>9} "
+              f"{result['cv_rmse']:>10.5f} {result['cv_rmse_std']:>10.5f} {result['cv_r2']:>8.4f}")
+
+
+def save_gap_model(model, result, filename=GAP_MODEL_FILE):
+    """
+    Persist a fitted GAP model and its selection score to a JSON file.
+
+    Args:
+        model: np.poly1d or B-spline
+        result: Result dictionary of cross_validate
+        filename: Output file
+    """
+    saved = dict(result)
+    if isinstance(model, np.poly1d):
+        saved['coefficients'] = model.coeffs.tolist()
+    else:
+        saved['knots'] = model.t.tolist()
+        saved['coefficients'] = model.c.tolist()
+        saved['spline_degree'] = int(model.k)
+
+    with open(filename, "w") as f:
+        json.dump(saved, f, indent=4)
+
+
+def load_gap_model(filename=GAP_MODEL_FILE):
+    """
+    Load a model saved by select_gap_model.
+
+    Returns:
+        Callable model (np.poly1d or B-spline)
+    """
+    with open(filename, "r") as f:
+        saved = json.load(f)
+
+    if saved['regression'] == 'polynomial':
+        return np.poly1d(saved['coefficients'])
+    return interpolate.BSpline(np.array(saved['knots']), np.array(saved['coefficients']),
+                               saved['spline_degree'])
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    ranking = select_gap_model()
+    print_ranking(ranking)
+    print(f"\nBest model saved in {GAP_MODEL_FILE}")
@@ -0,0 +1,276 @@
+"""
+Module for the incremental fit of the polynomial GAP model.
+The normal equations of a polynomial least-squares fit only need the power sums
+Σx^k (k <= 2 * degree) and Σx^k·y (k <= degree) of the windows. They are stored
+per activity in the gap_statistics table, so a sync only processes the windows
+of the new activities, a removed activity is subtracted by deleting its rows,
+and the fit is a small linear solve on the SQL totals.
+"""
+
+import numpy as np
+from specific_activity_analysis import (iter_activity_streams, iter_window_features,
+                                        ids_restricted, WINDOW_STREAMS)
+from instrumentation import profiled
+from database import connection, register_schema
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Highest polynomial degree that can be fitted from the stored sums
+MAX_DEGREE = 6
+
+# Gradients are divided by this scale before the power sums (x in [-1, 1]),
+# which keeps the normal equations well conditioned up to MAX_DEGREE
+GRADIENT_SCALE = 20.0
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS gap_statistics (
+    window_time INTEGER,
+    id INTEGER,
+    power INTEGER,
+    sum_x REAL,
+    sum_xy REAL,
+    PRIMARY KEY (window_time, id, power),
+    FOREIGN KEY (id) REFERENCES activity(id)
+) WITHOUT ROWID;
+""")
+
+
+# ============================================================================
+# SUFFICIENT STATISTICS
+# ============================================================================
+
+def power_sums(gradient, efficiency, max_degree=MAX_DEGREE):
+    """
+    Power sums of the windows of one activity.
+
+    Args:
+        gradient: Window gradients (%)
+        efficiency: Normalized efficiency of the windows
+        max_degree: Highest polynomial degree
+
+    Returns:
+        Tuple of (sums_x, sums_xy): Σx^k for k = 0..2*max_degree and Σx^k·y
+        for k = 0..max_degree, with x the scaled gradient
+    """
+    x = np.asarray(gradient, dtype=float) / GRADIENT_SCALE
+    powers = x[:, None] ** np.arange(2 * max_degree + 1)
+    sums_x = powers.sum(axis=0)
+    sums_xy = powers[:, :max_degree + 1].T @ np.asarray(efficiency, dtype=float)
+    return sums_x, sums_xy
+
+
+def window_regression_data(features):
+    """Gradient and efficiency of the windows used by the GAP regressions"""
+    valid = ~np.isnan(features).any(axis=1)
+    return features[valid, 1], features[valid, 3]
+
+
+def solve_polynomial(sums_x, sums_xy, degree):
+    """
+    Least-squares polynomial from power sums.
+    Also accepts stacks of sums ((..., 2*max_degree+1) and (..., max_degree+1))
+    and solves all the systems in one batched call.
+
+    Args:
+        sums_x: Σx^k of the scaled gradient
+        sums_xy: Σx^k·y
+        degree: Polynomial degree (<= MAX_DEGREE)
+
+    Returns:
+        Coefficients for the gradient in %, highest degree first as np.polyfit
+        (shape (..., degree + 1))
+    """
+    if degree > MAX_DEGREE:
+        raise ValueError(f"degree must be <= {MAX_DEGREE}")
+    sums_x = np.asarray(sums_x, dtype=float)
+    sums_xy = np.asarray(sums_xy, dtype=float)
+    # Gram matrix XᵀX[i, j] = Σx^(i+j) (Hankel structure)
+    index = np.arange(degree + 1)
+    gram = sums_x[..., index[:, None] + index[None, :]]
+    coefficients = np.linalg.solve(gram, sums_xy[..., :degree + 1, None])[..., 0]
+    # Undo the gradient scaling and order as np.polyfit
+    coefficients = coefficients / GRADIENT_SCALE ** index
+    return coefficients[..., ::-1]
+
+
+@profiled()
+def update_gap_statistics(activity_ids=None, window_time=60):
+    """
+    Store the power sums of the activities not processed yet, and remove
+    the ones of activities no longer in the activity table.
+
+    Args:
+        activity_ids: Activities to (re)compute, defaults to the new ones
+        window_time: Window size in seconds
+
+    Returns:
+        Number of processed activities
+    """
+    cursor.execute("""
+        DELETE FROM gap_statistics WHERE id NOT IN (SELECT id FROM activity);
+    """)
+    if activity_ids is None:
+        stored = {row[0] for row in cursor.execute("""
+            SELECT DISTINCT id FROM gap_statistics WHERE window_time = ?;
+        """, (window_time,)).fetchall()}
+        activity_ids = [activity_id for activity_id in ids_restricted(WINDOW_STREAMS[1:])
+                        if activity_id not in stored]
+    if not activity_ids:
+        conn.commit()
+        return 0
+
+    n_processed = 0
+    for activity_id, features in iter_window_features(iter_activity_streams(activity_ids),
+                                                      window_time):
+        sums_x, sums_xy = power_sums(*window_regression_data(features))
+        sums_xy = np.concatenate([sums_xy, np.full(len(sums_x) - len(sums_xy), np.nan)])
+        cursor.executemany("""
+            INSERT OR REPLACE INTO gap_statistics (window_time, id, power, sum_x, sum_xy)
+            VALUES (?, ?, ?, ?, ?);
+        """, [(window_time, activity_id, power, float(sum_x),
+               None if np.isnan(sum_xy) else float(sum_xy))
+              for power, (sum_x, sum_xy) in enumerate(zip(sums_x, sums_xy))])
+        n_processed += 1
+    conn.commit()
+    return n_processed
+
+
+def remove_gap_statistics(activity_ids, window_time=None):
+    """
+    Remove the contribution of some activities. Activities still in the activity
+    table are folded in again by the next update_gap_statistics.
+
+    Args:
+        activity_ids: Activities to remove
+        window_time: Window size in seconds, None for every window size
+    """
+    activity_ids = [int(activity_id) for activity_id in activity_ids]
+    cursor.execute(f"""
+        DELETE FROM gap_statistics WHERE id IN ({','.join('?' for _ in activity_ids)})
+        AND (? IS NULL OR window_time = ?);
+    """, activity_ids + [window_time, window_time])
+    conn.commit()
+
+
+def total_power_sums(window_time=60):
+    """
+    Power sums of all stored activities, summed in SQL.
+
+    Returns:
+        Tuple of (sums_x, sums_xy) arrays
+    """
+    rows = cursor.execute("""
+        SELECT power, SUM(sum_x), SUM(sum_xy) FROM gap_statistics
+        WHERE window_time = ? GROUP BY power ORDER BY power;
+    """, (window_time,)).fetchall()
+    sums_x = np.array([row[1] for row in rows], dtype=float)
+    sums_xy = np.array([row[2] for row in rows[:MAX_DEGREE + 1]], dtype=float)
+    return sums_x, sums_xy
+
+
+def activity_power_sums(window_time=60):
+    """
+    Power sums of every stored activity, for resampling at the activity level.
+
+    Returns:
+        Tuple of (activity_ids, sums_x, sums_xy) with sums_x a (n, 2*MAX_DEGREE+1)
+        array and sums_xy a (n, MAX_DEGREE+1) array
+    """
+    rows = cursor.execute("""
+        SELECT id, power, sum_x, sum_xy FROM gap_statistics
+        WHERE window_time = ? ORDER BY id, power;
+    """, (window_time,)).fetchall()
+    table = np.array(rows, dtype=float).reshape(-1, 2 * MAX_DEGREE + 1, 4)
+    activity_ids = table[:, 0, 0].astype(np.int64)
+    return activity_ids, table[:, :, 2], table[:, :MAX_DEGREE + 1, 3]
+
+
+def incremental_gap_polynomial(degree=2, window_time=60, update=True):
+    """
+    Polynomial GAP model from the stored power sums.
+    Gives the coefficients of efficiency_regression_polynomial (up to rounding)
+    while only the windows of new activities are computed.
+
+    Args:
+        degree: Polynomial degree (<= MAX_DEGREE)
+        window_time: Window size in seconds
+        update: Fold in the new activities first
+
+    Returns:
+        np.poly1d
+    """
+    if update:
+        update_gap_statistics(window_time=window_time)
+    sums_x, sums_xy = total_power_sums(window_time)
+    return np.poly1d(solve_polynomial(sums_x, sums_xy, degree))
+
+
+# ============================================================================
+# BOOTSTRAP
+# ============================================================================
+
+def bootstrap_gap_bands(degree=2, n_replicates=500, gradient=None, percentiles=(2.5, 97.5),
+                        window_time=60, seed=0, update=True):
+    """
+    Percentile bands of the GAP curve by bootstrap over activities.
+    Activities (not windows, which are correlated within a run) are resampled
+    with multinomial weights, so every replicate is a weighted sum of the stored
+    per-activity power sums and all the replicates are solved in one batched call.
+
+    Args:
+        degree: Polynomial degree (<= MAX_DEGREE)
+        n_replicates: Number of bootstrap replicates
+        gradient: Gradients (%) where the bands are computed, defaults to -20..20
+        percentiles: Lower and upper percentiles of the bands
+        window_time: Window size in seconds
+        seed: Seed of the random generator
+        update: Fold in the new activities first
+
+    Returns:
+        Dictionary with 'gradient', the 'fit' of the full dataset and the 'lower'
+        and 'upper' bands, as GAP factors (efficiency relative to flat - 1)
+    """
+    if update:
+        update_gap_statistics(window_time=window_time)
+    gradient = np.linspace(-20, 20, 81) if gradient is None else np.asarray(gradient, float)
+    _, sums_x, sums_xy = activity_power_sums(window_time)
+    n_activities = len(sums_x)
+
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(n_activities, np.full(n_activities, 1 / n_activities),
+                              size=n_replicates).astype(float)
+    replicate_sums_x = weights @ sums_x
+    replicate_sums_xy = weights @ sums_xy
+    try:
+        coefficients = solve_polynomial(replicate_sums_x, replicate_sums_xy, degree)
+    except np.linalg.LinAlgError:
+        # A replicate drew too few distinct activities, drop the singular systems
+        index = np.arange(degree + 1)
+        gram = replicate_sums_x[:, index[:, None] + index[None, :]]
+        regular = np.linalg.matrix_rank(gram) == degree + 1
+        coefficients = solve_polynomial(replicate_sums_x[regular],
+                                        replicate_sums_xy[regular], degree)
+
+    # GAP factor of every replicate at every gradient, normalized at gradient 0
+    vandermonde = gradient[:, None] ** np.arange(degree, -1, -1)
+    curves = (coefficients @ vandermonde.T) / coefficients[:, -1:] - 1
+    fit = np.poly1d(solve_polynomial(sums_x.sum(axis=0), sums_xy.sum(axis=0), degree))
+    lower, upper = np.percentile(curves, percentiles, axis=0)
+    return {'gradient': gradient, 'fit': fit(gradient) / fit(0) - 1,
+            'lower': lower, 'upper': upper}
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"Processed activities: {update_gap_statistics()}")
+    for degree in range(1, MAX_DEGREE + 1):
+        print(f"Degree {degree}: {incremental_gap_polynomial(degree, update=False).coeffs}")
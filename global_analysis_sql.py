@@ -1,11 +1,17 @@
-from matplotlib import pyplot as plt
 import numpy as np
 import datetime
-import sqlite3
-from api_call import client
 from functools import partial
+from instrumentation import instrument_matplotlib, profiled
+from database import connection, add_connection_hook
+from sql_functions import register_stream_functions, select_streams
+from lazy_imports import lazy_import
 
-conn = sqlite3.connect("sqlite_activity_database.db")
+# matplotlib is imported on first use, the statistics only need NumPy and sqlite3
+plt = lazy_import('matplotlib.pyplot', on_load=instrument_matplotlib)
+
+# Stream functions usable in the SQL queries (stream_mean, stream_time_above...)
+add_connection_hook(register_stream_functions)
+conn = connection(read_only=True)
 cursor = conn.cursor()
 
 
@@ -76,6 +82,7 @@ def total_distance_km():
     return int(total_distance / 1000)
 
 
+@profiled()
 def show_global_statistics():
     """Affiche les statistiques globales"""
     print('last run date:', last_activity_date())
@@ -102,6 +109,7 @@ def get_average_bpm():
     return avg_bpm
 
 
+@profiled()
 def get_monthly_distance():
     """Get total distance per month in km"""
     activities=cursor.execute("""
@@ -119,6 +127,7 @@ def get_monthly_distance():
     return monthly_distance
             
 
+@profiled()
 def get_dates():
     """Récupère les dates des courses"""
     activities = cursor.execute("""
@@ -266,6 +275,7 @@ def get_running_effectiveness():
     return running_effectiveness,activity_with_power_date
 
 def personal_best_evolution(distance_km=10,min_time=3000):
+    from api_call import client
     activities=client.get_activities()
     activities=list(activities)
     activities.reverse()
@@ -285,6 +295,109 @@ def personal_best_evolution(distance_km=10,min_time=3000):
     return personal_best_time[1:]
 
 
+# ============== CONDITIONS SUR LES STREAMS ==============
+
+def activities_where(condition, stream_types, parameters=()):
+    """
+    IDs of the activities whose streams satisfy a SQL condition, evaluated in SQLite
+    with the stream functions of sql_functions.py.
+
+    Example:
+        activities_where("stream_time_above(heartrate, time, ?) > 600", ['heartrate', 'time'], (175,))
+
+    Args:
+        condition: SQL condition, the stream types are columns
+        stream_types: Stream types used by the condition
+        parameters: Parameters of the ? placeholders
+
+    Returns:
+        List of activity IDs
+    """
+    rows = select_streams(cursor, "id", stream_types, condition, parameters)
+    return [row[0] for row in rows]
+
+
+def stream_summary(stream_type, percentile=90):
+    """
+    Mean, standard deviation and percentile of a stream for every activity, computed in SQLite.
+
+    Returns:
+        List of (id, mean, std, percentile) rows
+    """
+    return select_streams(cursor, f"id, stream_mean({stream_type}), stream_std({stream_type}), "
+                                  f"stream_percentile({stream_type}, ?)",
+                          [stream_type], parameters=(percentile,))
+
+
+# ============== LOCALISATION ==============
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+
+def activities_in_bounding_box(min_lat, max_lat, min_lng, max_lng, point='start'):
+    """
+    Activities whose start (or end) point lies in a bounding box, using the R*Tree index
+    
+    Args:
+        min_lat, max_lat, min_lng, max_lng: Bounding box in degrees
+        point: {"start","end"}
+    
+    Returns:
+        List of activity IDs
+    """
+    result = cursor.execute(f"""
+        SELECT r.id FROM activity_{point}_rtree r
+        JOIN activity a ON a.id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ?
+        AND r.max_lng >= ? AND r.min_lng <= ?
+        AND a.{point}_lat BETWEEN ? AND ?
+        AND a.{point}_lng BETWEEN ? AND ?;
+    """, (min_lat, max_lat, min_lng, max_lng,
+          min_lat, max_lat, min_lng, max_lng)).fetchall()
+    return [activity[0] for activity in result]
+
+
+def activities_near(lat, lng, radius_km, point='start'):
+    """
+    Activities starting (or ending) within radius_km of a point
+    The R*Tree gives the candidates of the enclosing box, the haversine distance filters them
+    
+    Args:
+        lat, lng: Point in degrees
+        radius_km: Search radius in km
+        point: {"start","end"}
+    
+    Returns:
+        Tuple of (activity IDs, distances in km) sorted by distance
+    """
+    delta_lat = radius_km / KM_PER_DEGREE_LAT
+    delta_lng = radius_km / (KM_PER_DEGREE_LAT * max(np.cos(np.radians(lat)), 1e-6))
+    result = cursor.execute(f"""
+        SELECT a.id, a.{point}_lat, a.{point}_lng FROM activity_{point}_rtree r
+        JOIN activity a ON a.id = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ?
+        AND r.max_lng >= ? AND r.min_lng <= ?;
+    """, (lat - delta_lat, lat + delta_lat, lng - delta_lng, lng + delta_lng)).fetchall()
+    if not result:
+        return np.array([], dtype=np.int64), np.array([])
+    
+    candidates = np.array(result, dtype=float)
+    distances = haversine_km(lat, lng, candidates[:, 1], candidates[:, 2])
+    inside = distances <= radius_km
+    order = np.argsort(distances[inside])
+    ids = np.array([activity[0] for activity in result], dtype=np.int64)[inside][order]
+    return ids, distances[inside][order]
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great circle distance in km (vectorized)"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
 # ============== GRAPHIQUES ==============
 
 def scatter_average_bpm():
@@ -428,6 +541,7 @@ def plot_average_bpm_speed_trend(altitude_gain_limit=100):
     plt.xticks(size=8)
     return plot_bpm_speed
 
+@profiled()
 def plot_corrcoef_evolution():
     corr_coefficients=[]
     for alt_gain_limit in np.linspace(10,2000,500):
@@ -442,6 +556,7 @@ def plot_corrcoef_evolution():
     plt.xticks(size=8)
     return corrcoef_evolution
 
+@profiled()
 def plot_settings(function, title,xlabel,ylabel,filename,grid=False,save=False):
     
     plot=function()
@@ -455,6 +570,7 @@ def plot_settings(function, title,xlabel,ylabel,filename,grid=False,save=False):
     
     return plot
 
+@profiled()
 def plot_monthly_distance(save=False):
     monthly_distance=get_monthly_distance()
     months=list(monthly_distance.keys())
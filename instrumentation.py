@@ -0,0 +1,289 @@
+"""
+Opt-in instrumentation of the analysis hot paths.
+Counts and times SQL queries per calling function, times stream decodes and
+analysis stages, then writes a per-run profile as JSON and prints a summary.
+
+Single switch: set the environment variable STRAVA_PROFILE=1 (or call enable()
+before importing the analysis modules). When it is off, instrument_connection
+and profiled return their argument unchanged, so nothing is added to the hot paths.
+"""
+
+import atexit
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+ENABLED = os.environ.get("STRAVA_PROFILE", "") not in ("", "0")
+
+PROFILE_FILE = os.environ.get("STRAVA_PROFILE_FILE", "./Results/profile.json")
+
+# {function: [count, seconds]}
+_queries = defaultdict(lambda: [0, 0.0])
+_stages = defaultdict(lambda: [0, 0.0])
+_start_time = time.perf_counter()
+_report_registered = False
+
+
+# ============================================================================
+# SWITCH
+# ============================================================================
+
+def enable(profile_file=None):
+    """
+    Enable the instrumentation for this process.
+    Must be called before the analysis modules are imported.
+
+    Args:
+        profile_file: JSON file of the profile written at exit
+    """
+    global ENABLED, PROFILE_FILE
+    ENABLED = True
+    if profile_file is not None:
+        PROFILE_FILE = profile_file
+    _register_report()
+
+
+def _register_report():
+    """Write and print the profile when the process exits"""
+    global _report_registered
+    if not _report_registered:
+        atexit.register(report)
+        _report_registered = True
+
+
+# ============================================================================
+# SQL QUERIES
+# ============================================================================
+
+def _caller_name(depth=2):
+    """Qualified name of the function calling the instrumented method"""
+    frame = sys._getframe(depth)
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+class InstrumentedCursor:
+    """sqlite3 cursor proxy counting and timing queries and fetches per calling function"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._caller = None
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        statistics = _queries[self._caller]
+        statistics[1] += time.perf_counter() - start
+        return result
+
+    def execute(self, sql, parameters=()):
+        self._caller = _caller_name()
+        _queries[self._caller][0] += 1
+        self._timed(self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, parameters):
+        self._caller = _caller_name()
+        _queries[self._caller][0] += 1
+        self._timed(self._cursor.executemany, sql, parameters)
+        return self
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._timed(self._cursor.fetchmany)
+        return self._timed(self._cursor.fetchmany, size)
+
+    def __iter__(self):
+        while True:
+            row = self._timed(self._cursor.fetchone)
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """sqlite3 connection proxy whose cursors are instrumented"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args):
+        return InstrumentedCursor(self._connection.cursor(*args))
+
+    def execute(self, sql, parameters=()):
+        cursor = self.cursor()
+        cursor._caller = _caller_name()
+        _queries[cursor._caller][0] += 1
+        cursor._timed(cursor._cursor.execute, sql, parameters)
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def instrument_connection(connection):
+    """
+    Instrument a module-level SQLite connection.
+
+    Args:
+        connection: sqlite3 connection
+
+    Returns:
+        The instrumented proxy when enabled, the connection itself otherwise
+    """
+    if not ENABLED:
+        return connection
+    _register_report()
+    return InstrumentedConnection(connection)
+
+
+# ============================================================================
+# STAGES
+# ============================================================================
+
+def record_stage(name, seconds):
+    """Add one timed call to a stage"""
+    statistics = _stages[name]
+    statistics[0] += 1
+    statistics[1] += seconds
+
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    """
+    Context manager timing a block of code as a stage.
+
+    Args:
+        name: Stage name in the profile
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _timed_stage(name)
+
+
+def profiled(name=None):
+    """
+    Decorator timing every call of a function as a stage.
+    For generator functions the time spent producing each item is accumulated
+    (inclusive of the upstream generators it pulls from).
+    Returns the function unchanged when the instrumentation is off.
+
+    Args:
+        name: Stage name, defaults to module.function
+    """
+    def decorator(function):
+        if not ENABLED:
+            return function
+        stage_name = name or f"{function.__module__}.{function.__name__}"
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                elapsed = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    record_stage(stage_name, elapsed)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_stage(stage_name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def instrument_matplotlib():
+    """Time pyplot.savefig and pyplot.show as matplotlib stages"""
+    if not ENABLED:
+        return
+    from matplotlib import pyplot as plt
+    if getattr(plt.savefig, '_instrumented', False):
+        return
+    for function_name in ('savefig', 'show'):
+        wrapped = profiled(f"matplotlib.{function_name}")(getattr(plt, function_name))
+        wrapped._instrumented = True
+        setattr(plt, function_name, wrapped)
+
+
+# ============================================================================
+# REPORT
+# ============================================================================
+
+def profile():
+    """
+    Profile of the run so far.
+
+    Returns:
+        Dictionary with the total time, the queries and the stages
+        ({name: {'count', 'seconds'}}) sorted by decreasing time
+    """
+    def as_table(statistics):
+        return {name: {'count': count, 'seconds': seconds}
+                for name, (count, seconds) in sorted(statistics.items(),
+                                                     key=lambda item: -item[1][1])}
+
+    return {'total_seconds': time.perf_counter() - _start_time,
+            'queries': as_table(_queries),
+            'stages': as_table(_stages)}
+
+
+def report(filename=None):
+    """Write the profile as JSON and print a summary"""
+    run_profile = profile()
+    filename = filename or PROFILE_FILE
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(run_profile, f, indent=4)
+
+    print(f"\n=== Profile ({run_profile['total_seconds']:.2f} s) ===")
+    query_count = sum(entry['count'] for entry in run_profile['queries'].values())
+    query_time = sum(entry['seconds'] for entry in run_profile['queries'].values())
+    print(f"SQL: {query_count} queries, {query_time:.3f} s")
+    for name, entry in run_profile['queries'].items():
+        print(f"  {name:<60} {entry['count']:>7} {entry['seconds']:>9.3f} s")
+    print("Stages (inclusive):")
+    for name, entry in run_profile['stages'].items():
+        print(f"  {name:<60} {entry['count']:>7} {entry['seconds']:>9.3f} s")
+    print(f"Profile saved in {filename}")
@@ -0,0 +1,69 @@
+"""
+Lazy import of the heavy optional modules (matplotlib, SciPy, scikit-learn).
+The compute paths (windowing, regressions, statistics, derived tables) only
+need NumPy and sqlite3, so the plotting and fitting libraries are imported on
+first use instead of at module import, which keeps scripts and worker
+processes fast to start.
+
+Example:
+    plt = lazy_import('matplotlib.pyplot')
+    plt.figure()  # matplotlib is imported here
+"""
+
+import importlib
+import sys
+import threading
+import types
+
+_import_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy importing the real module on first attribute access"""
+
+    def __init__(self, name, on_load=None):
+        super().__init__(name)
+        self._lazy_name = name
+        self._lazy_on_load = on_load
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            with _import_lock:
+                if self._lazy_module is None:
+                    module = importlib.import_module(self._lazy_name)
+                    if self._lazy_on_load is not None:
+                        self._lazy_on_load()
+                    self._lazy_module = module
+        return self._lazy_module
+
+    def __getattr__(self, name):
+        # Only called for the attributes missing on the proxy, i.e. the module ones
+        if name.startswith('_lazy_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._lazy_module is not None else 'not loaded'
+        return f"<lazy module {self._lazy_name!r} ({state})>"
+
+
+def lazy_import(name, on_load=None):
+    """
+    Module imported on first use (the module itself when it is already imported).
+
+    Args:
+        name: Module name, e.g. 'matplotlib.pyplot'
+        on_load: Function called once after the import (e.g. instrumentation)
+
+    Returns:
+        Module or LazyModule proxy
+    """
+    if name in sys.modules:
+        if on_load is not None:
+            on_load()
+        return sys.modules[name]
+    return LazyModule(name, on_load)
@@ -0,0 +1,306 @@
+"""
+Local HTTP server of the reports (global statistics, monthly distance, trends, GAP model)
+as JSON and PNG, for dashboards.
+Every response is computed once and cached with the database version (modification
+time and size of the database and WAL files): a request only checks the version,
+so the cache is invalidated only when the database changes. A background thread
+recomputes the reports after a change, so polling clients always hit the cache.
+Responses carry an ETag and conditional requests (If-None-Match) get a 304.
+
+Usage:
+    python report_server.py --port 8050
+    curl http://localhost:8050/api/statistics
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+import numpy as np
+import global_analysis_sql as gas
+from database import database_path, close_connections, set_database
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+DEFAULT_PORT = 8050
+
+# Seconds between two checks of the database version by the refresh thread
+REFRESH_INTERVAL = 5.0
+
+FIGURE_DPI = 100
+
+# {path: (version, etag, content_type, body)}
+_cache = {}
+_cache_lock = threading.Lock()
+# The reports share the module cursors and pyplot, they are computed one at a time
+_compute_lock = threading.Lock()
+
+
+# ============================================================================
+# REPORTS
+# ============================================================================
+
+def _linear_trend(values):
+    """Coefficients (slope per activity, intercept) of a linear fit"""
+    if len(values) < 2:
+        return None
+    return np.polyfit(np.arange(len(values)), values, 1).tolist()
+
+
+def statistics_report():
+    """Global statistics"""
+    first_date, last_date = gas.first_activity_date(), gas.last_activity_date()
+    return {'number_of_activities': gas.number_of_activities(),
+            'total_time_hours': gas.total_time_hours(),
+            'total_distance_km': gas.total_distance_km(),
+            'first_activity_date': first_date.isoformat() if first_date else None,
+            'last_activity_date': last_date.isoformat() if last_date else None}
+
+
+def monthly_distance_report():
+    """Distance per month (km)"""
+    return {month: round(distance, 3) for month, distance in gas.get_monthly_distance().items()}
+
+
+def trends_report():
+    """Average pace, speed and heart rate of every activity with their linear trends"""
+    dates = gas.get_dates()
+    series = {'pace': gas.get_average_pace(), 'speed': gas.get_average_speed(),
+              'heartrate': gas.get_average_bpm()}
+    report = {'dates': [date.isoformat() for date in dates]}
+    for name, values in series.items():
+        # Series with skipped activities cannot be aligned with the dates
+        if len(values) != len(dates):
+            continue
+        report[name] = {'values': np.round(values, 4).tolist(), 'trend': _linear_trend(values)}
+    return report
+
+
+def gap_model_report(degree=2, n_replicates=500):
+    """Polynomial GAP model and its bootstrap band from the stored power sums"""
+    from gap_statistics import incremental_gap_polynomial, bootstrap_gap_bands, total_power_sums
+    if len(total_power_sums()[0]) == 0:
+        return {'degree': degree, 'coefficients': None}
+    polynomial = incremental_gap_polynomial(degree, update=False)
+    band = bootstrap_gap_bands(degree, n_replicates, update=False)
+    return {'degree': degree, 'coefficients': polynomial.coeffs.tolist(),
+            **{key: np.round(values, 5).tolist() for key, values in band.items()}}
+
+
+# ============================================================================
+# FIGURES
+# ============================================================================
+
+def _render_png(draw):
+    """Draw on a new pyplot figure and return it as PNG bytes"""
+    figure = plt.figure(figsize=(12, 6))
+    try:
+        draw()
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png', dpi=FIGURE_DPI)
+        return buffer.getvalue()
+    finally:
+        plt.close(figure)
+
+
+def monthly_distance_figure():
+    return _render_png(gas.plot_monthly_distance)
+
+
+def trends_figure():
+    def draw():
+        gas.plot_settings(gas.scatter_average_pace, "Average pace", "Date", "Pace (min/km)", None)
+        gas.plot_pace_trend()
+    return _render_png(draw)
+
+
+def gap_model_figure():
+    report = gap_model_report()
+
+    def draw():
+        if report['coefficients'] is None:
+            plt.title("No GAP statistics, run update_gap_statistics()")
+            return
+        plt.plot(report['gradient'], report['fit'], 'r-', linewidth=2, label='GAP model')
+        plt.fill_between(report['gradient'], report['lower'], report['upper'],
+                         color='r', alpha=0.2, label='95% bootstrap band')
+        plt.xlabel("Gradient (%)")
+        plt.ylabel("Normalized efficiency - 1")
+        plt.title("Grade Adjusted Pace (GAP) Model")
+        plt.legend()
+        plt.grid(True, alpha=0.3)
+    return _render_png(draw)
+
+
+def _json_body(report):
+    return json.dumps(report).encode()
+
+
+# {path: (content type, function returning the body)}
+ROUTES = {
+    '/api/statistics': ('application/json', lambda: _json_body(statistics_report())),
+    '/api/monthly_distance': ('application/json', lambda: _json_body(monthly_distance_report())),
+    '/api/trends': ('application/json', lambda: _json_body(trends_report())),
+    '/api/gap_model': ('application/json', lambda: _json_body(gap_model_report())),
+    '/figures/monthly_distance.png': ('image/png', monthly_distance_figure),
+    '/figures/trends.png': ('image/png', trends_figure),
+    '/figures/gap_model.png': ('image/png', gap_model_figure),
+}
+
+
+# ============================================================================
+# CACHE
+# ============================================================================
+
+def database_version():
+    """Modification time and size of the database and WAL files"""
+    path = database_path()
+    version = []
+    for filename in (path, path + '-wal'):
+        try:
+            status = os.stat(filename)
+        except FileNotFoundError:
+            status = None
+        # An empty WAL is created and deleted with the connections, it holds no change
+        if status is None or status.st_size == 0:
+            version.append(None)
+        else:
+            version.append((status.st_mtime_ns, status.st_size))
+    return tuple(version)
+
+
+def cached_response(path):
+    """
+    Response of a route, from the cache when the database has not changed.
+
+    Returns:
+        Tuple of (etag, content_type, body)
+    """
+    version = database_version()
+    entry = _cache.get(path)
+    if entry is not None and entry[0] == version:
+        return entry[1:]
+
+    content_type, compute = ROUTES[path]
+    with _compute_lock:
+        # Another thread may have computed it while this one was waiting
+        entry = _cache.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1:]
+        try:
+            body = compute()
+        finally:
+            # Request threads are short-lived, do not leave their connections open
+            close_connections()
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    with _cache_lock:
+        _cache[path] = (version, etag, content_type, body)
+    return etag, content_type, body
+
+
+def precompute():
+    """Compute every route for the current database version"""
+    for path in ROUTES:
+        cached_response(path)
+
+
+def refresh_loop(interval=REFRESH_INTERVAL, stop_event=None):
+    """Recompute the reports when the database version changes"""
+    stop_event = stop_event or threading.Event()
+    version = None
+    while not stop_event.is_set():
+        if database_version() != version:
+            version = database_version()
+            try:
+                precompute()
+            except Exception as error:
+                print(f"Report refresh failed: {error!r}")
+        stop_event.wait(interval)
+
+
+# ============================================================================
+# SERVER
+# ============================================================================
+
+class ReportHandler(BaseHTTPRequestHandler):
+    """GET handler of the routes, with ETag and conditional responses"""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            self._send(200, 'application/json', _json_body(sorted(ROUTES)))
+            return
+        if path not in ROUTES:
+            self._send(404, 'application/json', _json_body({'error': f"unknown route {path}"}))
+            return
+        try:
+            etag, content_type, body = cached_response(path)
+        except Exception as error:
+            self._send(500, 'application/json', _json_body({'error': repr(error)}))
+            return
+        if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+            self._send(304, content_type, b'', etag)
+        else:
+            self._send(200, content_type, body, etag)
+
+    def _send(self, status, content_type, body, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, refresh_interval=REFRESH_INTERVAL):
+    """
+    Run the report server until interrupted.
+
+    Args:
+        host: Interface to listen on (local only by default)
+        port: TCP port
+        refresh_interval: Seconds between two checks of the database version
+    """
+    server = ThreadingHTTPServer((host, port), ReportHandler)
+    stop_event = threading.Event()
+    refresher = threading.Thread(target=refresh_loop, args=(refresh_interval, stop_event),
+                                 daemon=True)
+    refresher.start()
+    print(f"Serving the reports on http://{host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the reports as JSON and PNG")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--database", help="SQLite database (default: STRAVA_DATABASE)")
+    parser.add_argument("--refresh-interval", type=float, default=REFRESH_INTERVAL)
+    arguments = parser.parse_args()
+    if arguments.database:
+        set_database(arguments.database)
+    serve(arguments.host, arguments.port, arguments.refresh_interval)
@@ -0,0 +1,331 @@
+"""
+Module for route similarity search over latlng streams.
+Each route is fingerprinted by the set of geohash cells it crosses, summarized
+by a MinHash signature. Signatures are split in LSH bands stored in an indexed
+table, so similar routes are found by bucket lookups instead of comparing
+every pair of activities.
+"""
+
+import numpy as np
+from polyline import decode_polyline
+from instrumentation import profiled
+from database import connection, register_schema
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Geohash precision (characters), 7 gives cells of ~150 m x 150 m
+GEOHASH_PRECISION = 7
+
+# MinHash signature length = LSH_BANDS x LSH_ROWS
+# With 16 bands of 4 rows, routes with Jaccard similarity above ~0.5 share a bucket
+LSH_BANDS = 16
+LSH_ROWS = 4
+N_HASHES = LSH_BANDS * LSH_ROWS
+
+# Estimated Jaccard similarity above which two routes are the same route
+SIMILARITY_THRESHOLD = 0.6
+
+# Fixed random hash parameters (odd multipliers for multiply-shift hashing)
+_rng = np.random.default_rng(20240101)
+_HASH_MULTIPLIERS = _rng.integers(1, 2 ** 63, N_HASHES, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_HASH_OFFSETS = _rng.integers(0, 2 ** 63, N_HASHES, dtype=np.uint64)
+_BAND_MIX = _rng.integers(1, 2 ** 63, LSH_ROWS, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS route_signatures (
+    id INTEGER PRIMARY KEY,
+    n_cells INTEGER,
+    signature BLOB,
+    FOREIGN KEY (id) REFERENCES activity(id)
+);
+""", """
+CREATE TABLE IF NOT EXISTS route_lsh (
+    band INTEGER,
+    bucket INTEGER,
+    id INTEGER,
+    PRIMARY KEY (band, bucket, id)
+) WITHOUT ROWID;
+""", """
+CREATE INDEX IF NOT EXISTS idx_route_lsh_id ON route_lsh(id);
+""")
+
+
+# ============================================================================
+# FINGERPRINTS
+# ============================================================================
+
+def geohash_cells(latlng, precision=GEOHASH_PRECISION):
+    """
+    Integer geohash of every point (bits of longitude and latitude interleaved).
+
+    Args:
+        latlng: (n, 2) array of [lat, lng] in degrees
+        precision: Geohash precision in characters (5 bits each)
+
+    Returns:
+        Array of unique cell integers crossed by the route
+    """
+    latlng = np.asarray(latlng, dtype=float).reshape(-1, 2)
+    n_bits = 5 * precision
+    lng_bits = (n_bits + 1) // 2
+    lat_bits = n_bits // 2
+
+    lat_index = np.floor((latlng[:, 0] + 90) / 180 * 2 ** lat_bits).astype(np.int64)
+    lng_index = np.floor((latlng[:, 1] + 180) / 360 * 2 ** lng_bits).astype(np.int64)
+    lat_index = np.clip(lat_index, 0, 2 ** lat_bits - 1)
+    lng_index = np.clip(lng_index, 0, 2 ** lng_bits - 1)
+
+    # Geohash interleaving: longitude on even bits (from the most significant)
+    cells = np.zeros(len(latlng), dtype=np.int64)
+    for bit in range(n_bits):
+        if bit % 2 == 0:
+            value = (lng_index >> (lng_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_index >> (lat_bits - 1 - bit // 2)) & 1
+        cells = (cells << 1) | value
+    return np.unique(cells)
+
+
+def minhash_signature(cells):
+    """
+    MinHash signature of a set of cells.
+
+    Args:
+        cells: Array of cell integers
+
+    Returns:
+        Array of N_HASHES uint64 (minimum hash of the set for each hash function)
+    """
+    cells = np.asarray(cells).astype(np.uint64)
+    hashes = cells[None, :] * _HASH_MULTIPLIERS[:, None] + _HASH_OFFSETS[:, None]
+    return hashes.min(axis=1)
+
+
+def lsh_buckets(signature):
+    """
+    LSH bucket of each band of a signature.
+
+    Args:
+        signature: MinHash signature
+
+    Returns:
+        Array of LSH_BANDS bucket integers (fit in a SQLite INTEGER)
+    """
+    bands = signature.reshape(LSH_BANDS, LSH_ROWS)
+    return ((bands * _BAND_MIX).sum(axis=1) >> np.uint64(1)).astype(np.int64)
+
+
+def estimated_similarity(signature, other_signatures):
+    """
+    Estimated Jaccard similarity (fraction of equal MinHash values).
+
+    Args:
+        signature: MinHash signature
+        other_signatures: (n, N_HASHES) array of signatures
+
+    Returns:
+        Array of n similarities
+    """
+    return (np.asarray(other_signatures) == signature).mean(axis=1)
+
+
+# ============================================================================
+# STORAGE
+# ============================================================================
+
+def store_route_signature(activity_id, latlng):
+    """
+    Fingerprint a route and store its signature and LSH buckets.
+
+    Args:
+        activity_id: Strava activity ID
+        latlng: (n, 2) array of [lat, lng]
+
+    Returns:
+        The signature, None when the activity has no GPS points
+    """
+    cursor.execute("DELETE FROM route_lsh WHERE id = ?;", (activity_id,))
+    if len(latlng) == 0:
+        cursor.execute("DELETE FROM route_signatures WHERE id = ?;", (activity_id,))
+        return None
+
+    cells = geohash_cells(latlng)
+    signature = minhash_signature(cells)
+    cursor.execute("""
+        INSERT OR REPLACE INTO route_signatures (id, n_cells, signature)
+        VALUES (?, ?, ?);
+    """, (activity_id, len(cells), signature.tobytes()))
+    cursor.executemany("""
+        INSERT OR IGNORE INTO route_lsh (band, bucket, id) VALUES (?, ?, ?);
+    """, [(band, int(bucket), activity_id) for band, bucket in enumerate(lsh_buckets(signature))])
+    return signature
+
+
+@profiled()
+def update_route_signatures():
+    """
+    Fingerprint the activities having a latlng stream but no signature yet.
+
+    Returns:
+        Number of new signatures
+    """
+    rows = conn.cursor().execute("""
+        SELECT s.id, s.stream_value FROM streams s
+        LEFT JOIN route_signatures r ON r.id = s.id
+        WHERE s.stream_type = 'latlng' AND r.id IS NULL
+        AND s.stream_value IS NOT NULL AND s.stream_value != '[]';
+    """).fetchall()
+    for activity_id, stream_value in rows:
+        store_route_signature(activity_id, decode_polyline(stream_value))
+    conn.commit()
+    return len(rows)
+
+
+def _signatures(activity_ids):
+    """Stored signatures of some activities as a {id: signature} dictionary"""
+    signatures = {}
+    activity_ids = list(activity_ids)
+    for start in range(0, len(activity_ids), 500):
+        chunk = activity_ids[start:start + 500]
+        rows = cursor.execute(f"""
+            SELECT id, signature FROM route_signatures
+            WHERE id IN ({','.join('?' for _ in chunk)});
+        """, chunk).fetchall()
+        signatures.update({activity_id: np.frombuffer(signature, dtype=np.uint64)
+                           for activity_id, signature in rows})
+    return signatures
+
+
+# ============================================================================
+# SEARCH
+# ============================================================================
+
+def similar_routes(activity_id, threshold=SIMILARITY_THRESHOLD):
+    """
+    Activities following the same route as an activity.
+    Only activities sharing an LSH bucket are compared.
+
+    Args:
+        activity_id: Strava activity ID (its signature must be stored)
+        threshold: Minimum estimated Jaccard similarity
+
+    Returns:
+        List of (activity_id, similarity) sorted by decreasing similarity
+    """
+    candidates = cursor.execute("""
+        SELECT DISTINCT other.id FROM route_lsh own
+        JOIN route_lsh other ON other.band = own.band AND other.bucket = own.bucket
+        WHERE own.id = ? AND other.id != ?;
+    """, (activity_id, activity_id)).fetchall()
+    candidates = [candidate[0] for candidate in candidates]
+
+    signatures = _signatures(candidates + [activity_id])
+    if activity_id not in signatures or not candidates:
+        return []
+    candidates = [candidate for candidate in candidates if candidate in signatures]
+    similarity = estimated_similarity(signatures[activity_id],
+                                      np.array([signatures[candidate] for candidate in candidates]))
+
+    matches = [(candidate, float(value)) for candidate, value in zip(candidates, similarity)
+               if value >= threshold]
+    return sorted(matches, key=lambda match: -match[1])
+
+
+def group_routes(threshold=SIMILARITY_THRESHOLD, min_group_size=2):
+    """
+    Group the activities running the same route.
+    The members of each shared LSH bucket are compared with one representative
+    (the next unmatched member becomes the representative of the rest), so the
+    work grows linearly with the size of a bucket, and the confirmed matches
+    are merged with a union-find.
+
+    Args:
+        threshold: Minimum estimated Jaccard similarity of a pair
+        min_group_size: Smallest group returned
+
+    Returns:
+        List of groups (lists of activity IDs), largest first
+    """
+    buckets = cursor.execute("""
+        SELECT GROUP_CONCAT(id) FROM route_lsh
+        GROUP BY band, bucket HAVING COUNT(*) > 1;
+    """).fetchall()
+    buckets = [sorted(int(member) for member in members.split(',')) for (members,) in buckets]
+    if not buckets:
+        return []
+    signatures = _signatures({member for members in buckets for member in members})
+
+    # Union-find over the confirmed matches
+    parent = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(a, b):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    for members in buckets:
+        remaining = [member for member in members if member in signatures]
+        while len(remaining) > 1:
+            representative, others = remaining[0], remaining[1:]
+            # Members already grouped with the representative need no comparison
+            root = find(representative)
+            others = [other for other in others if find(other) != root]
+            if not others:
+                break
+            similarity = estimated_similarity(signatures[representative],
+                                              np.array([signatures[other] for other in others]))
+            remaining = []
+            for other, value in zip(others, similarity):
+                if value >= threshold:
+                    union(representative, other)
+                else:
+                    remaining.append(other)
+
+    groups = {}
+    for node in list(parent):
+        groups.setdefault(find(node), []).append(node)
+    groups = [sorted(group) for group in groups.values() if len(group) >= min_group_size]
+    return sorted(groups, key=len, reverse=True)
+
+
+def route_efforts(activity_ids):
+    """
+    Efforts of the activities of one route, to compare them.
+
+    Args:
+        activity_ids: Activity IDs of the route (e.g. one group of group_routes)
+
+    Returns:
+        List of (id, start_date, moving_time, average_speed, average_heartrate) by date
+    """
+    activity_ids = list(activity_ids)
+    return cursor.execute(f"""
+        SELECT id, start_date, moving_time, average_speed, average_heartrate
+        FROM activity WHERE id IN ({','.join('?' for _ in activity_ids)})
+        ORDER BY start_date;
+    """, activity_ids).fetchall()
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"New route signatures: {update_route_signatures()}")
+    for group in group_routes()[:10]:
+        print(f"\nRoute run {len(group)} times:")
+        for effort in route_efforts(group):
+            print(effort)
@@ -3,15 +3,21 @@ Module for specific activity analysis from Strava data.
 Handles time-series analysis, windowing, clustering, and GAP model regression.
 """
 
-from matplotlib import pyplot as plt
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-from sklearn.metrics import r2_score
-import sqlite3
 import json
+import tracemalloc
+from itertools import groupby
 import numpy as np
-import scipy.interpolate as interpolate
 from global_analysis_sql import all_activities_id, dates_from_ids, ids_from_dates
+from stream_decimation import decimate_streams
+from instrumentation import instrument_matplotlib, profiled
+from database import connection
+from polyline import decode_polyline
+from lazy_imports import lazy_import
+
+# Plotting and spline fitting are imported on first use, the windowing, polynomial
+# regression and statistics only need NumPy (scikit-learn is imported in clustering)
+plt = lazy_import('matplotlib.pyplot', on_load=instrument_matplotlib)
+interpolate = lazy_import('scipy.interpolate')
 
 # ============================================================================
 # CONSTANTS
@@ -30,14 +36,54 @@ HR_ZONE_FOOTING = [100, 155]
 HR_ZONE_TEMPO = [155, 180]
 HR_ZONE_VMA = [180, 200]
 
+SPEED_ZONES = {'footing': SPEED_ZONE_FOOTING, 'tempo': SPEED_ZONE_TEMPO,
+               'vma': SPEED_ZONE_VMA, 'sprint': SPEED_ZONE_SPRINT}
+HR_ZONES = {'footing': HR_ZONE_FOOTING, 'tempo': HR_ZONE_TEMPO, 'vma': HR_ZONE_VMA}
+
 # Gradient limit
 GRAD_LIMIT_HIGH=20
 GRAD_LIMIT_LOW=-20
 
+# Gradient bin width (%) of the binned GAP regression
+GAP_BIN_WIDTH = 0.5
+
+# Resampling on a uniform time grid
+RESAMPLING_STEP = 1.0  # Grid spacing (s)
+PAUSE_THRESHOLD = 10  # Gap between two samples considered as a pause (s)
+
+# Maximum number of points of the single activity plots
+PLOT_MAX_POINTS = 2000
+
+# Streams and acceptance limits used for the window features
+WINDOW_STREAMS = ['time', 'heartrate', 'grade_smooth', 'velocity_smooth']
+WINDOW_LIMITS = {'heartrate': (130, 185),
+                 'grade_smooth': (GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH),
+                 'velocity_smooth': (8, 20)}
+WINDOW_FEATURES = ['heartrate', 'gradient', 'speed', 'efficiency']
+
 # Database connection
-conn = sqlite3.connect("sqlite_activity_database.db")
+conn = connection(read_only=True)
 cursor = conn.cursor()
 
+# JSON decoding of the streams (timed when the instrumentation is on)
+_decode_json = profiled('decode_stream')(json.loads)
+
+
+def zone_edges(feature):
+    """
+    Zone names and bin edges of the SPEED_ZONE_* / HR_ZONE_* constants.
+    
+    Args:
+        feature: 'speed' or 'heartrate'
+    
+    Returns:
+        Tuple of (zone_names, edges) for np.digitize
+    """
+    zones = SPEED_ZONES if feature == 'speed' else HR_ZONES
+    names = list(zones)
+    edges = [zones[names[0]][0]] + [zones[name][1] for name in names]
+    return names, np.array(edges, dtype=float)
+
 
 # ============================================================================
 # DATA RETRIEVAL FUNCTIONS
@@ -62,6 +108,19 @@ def ids_restricted(restriction_types):
     return [activity[0] for activity in activities_id]
 
 
+def decode_stream(stream_value):
+    """
+    Decode a stored stream into a float array (missing samples become NaN).
+    
+    Args:
+        stream_value: JSON text of the stream
+    
+    Returns:
+        Numpy array of the stream values
+    """
+    return np.array(_decode_json(stream_value), dtype=float)
+
+
 def activity_stream(activity_id, stream_type):
     """
     Retrieve a specific stream and distance data for an activity.
@@ -72,6 +131,7 @@ def activity_stream(activity_id, stream_type):
     
     Returns:
         Tuple of (stream_data, distance_data) as numpy arrays
+        ('latlng' stream data is a (n, 2) array of [lat, lng])
         Returns ([None], [None]) if data is not available
     """
     stream_query = """
@@ -87,8 +147,10 @@ def activity_stream(activity_id, stream_type):
     distance_result = cursor.execute(distance_query, (activity_id,)).fetchone()
     
     try:
-        stream_data = json.loads(stream_result[0])
-        distance_data = json.loads(distance_result[0])
+        if stream_type == 'latlng' and stream_result[0] != '[]':
+            return decode_polyline(stream_result[0]), np.array(_decode_json(distance_result[0]))
+        stream_data = _decode_json(stream_result[0])
+        distance_data = _decode_json(distance_result[0])
     except (TypeError, AttributeError):
         return np.array([None]), np.array([None])
     
@@ -99,11 +161,92 @@ def activity_stream(activity_id, stream_type):
 # WINDOWING AND PREPROCESSING FUNCTIONS
 # ============================================================================
 
+def resample_stream(time, data, grid_step=RESAMPLING_STEP, pause_threshold=PAUSE_THRESHOLD):
+    """
+    Interpolate a stream onto a uniform time grid and mark pause gaps.
+    Strava smart recording gives irregular time steps, the uniform grid makes
+    fixed-size windows truly fixed in time.
+    
+    Args:
+        time: Time stream (s) of the activity
+        data: Stream values sampled at the time stream
+        grid_step: Spacing of the uniform grid in seconds
+        pause_threshold: Gap (s) between two samples above which the gap is a pause
+    
+    Returns:
+        Tuple of (grid_time, grid_data, pause_mask) as numpy arrays
+        pause_mask is True for grid points falling inside a pause gap
+    """
+    time = np.asarray(time, dtype=float)
+    data = np.asarray(data, dtype=float)
+    
+    if len(time) < 2 or len(time) != len(data) or np.isnan(time).any():
+        return np.array([]), np.array([]), np.array([], dtype=bool)
+    
+    grid_time = np.arange(time[0], time[-1] + grid_step / 2, grid_step)
+    grid_data = np.interp(grid_time, time, data)
+    
+    # A grid point is in a pause if it lies strictly inside a long gap
+    previous_sample = np.searchsorted(time, grid_time, side='right') - 1
+    previous_sample = np.clip(previous_sample, 0, len(time) - 2)
+    gaps = np.diff(time)
+    pause_mask = ((gaps[previous_sample] > pause_threshold)
+                  & (grid_time > time[previous_sample]))
+    
+    return grid_time, grid_data, pause_mask
+
+
+def window_statistics(data, pause_mask, stream_type, data_min, data_max,
+                      std_threshold=5, window_size=60):
+    """
+    Average a uniformly resampled stream over fixed-size windows.
+    All windows are computed at once on a (n_windows, window_size) view.
+    
+    Args:
+        data: Stream values on a uniform grid
+        pause_mask: Pause flags on the same grid
+        stream_type: Type of stream (velocity gets an extra acceleration filter)
+        data_min: Minimum acceptable average value
+        data_max: Maximum acceptable average value
+        std_threshold: Maximum allowed standard deviation within window
+        window_size: Number of grid points per window
+    
+    Returns:
+        Array of averaged values (NaN for rejected or incomplete windows)
+    """
+    n_windows = -(-len(data) // window_size)
+    n_full = len(data) // window_size
+    averaged_data = np.full(n_windows, np.nan)
+    
+    if n_full == 0:
+        return averaged_data
+    
+    windows = data[:n_full * window_size].reshape(n_full, window_size)
+    window_pause = pause_mask[:n_full * window_size].reshape(n_full, window_size)
+    
+    window_avg = windows.mean(axis=1)
+    window_std = windows.std(axis=1)
+    
+    # Filter based on statistical criteria, windows containing a pause are rejected
+    is_valid = ((window_std < std_threshold)
+                & (data_min < window_avg) & (window_avg < data_max)
+                & ~window_pause.any(axis=1))
+    
+    # Additional filter for velocity: reject high acceleration
+    if stream_type == 'velocity_smooth' and window_size > 1:
+        acceleration = np.gradient(windows, axis=1).mean(axis=1)
+        is_valid &= ~(acceleration > 0.5)
+    
+    averaged_data[:n_full] = np.where(is_valid, window_avg, np.nan)
+    return averaged_data
+
+
 def windowed_average(activity_id, stream_type, data_min, data_max, 
-                     std_threshold=5, window_time=60):
+                     std_threshold=5, window_time=60, grid_step=RESAMPLING_STEP):
     """
     Resample activity stream data using window averaging.
-    Filters out windows with high standard deviation or out-of-bounds averages.
+    The stream is first interpolated on a uniform time grid, then
+    filters out windows with high standard deviation, pauses or out-of-bounds averages.
     
     Args:
         activity_id: Strava activity ID
@@ -112,9 +255,10 @@ def windowed_average(activity_id, stream_type, data_min, data_max,
         data_max: Maximum acceptable average value
         std_threshold: Maximum allowed standard deviation within window
         window_time: Window size in seconds
+        grid_step: Spacing of the resampling grid in seconds
     
     Returns:
-        Array of averaged values (None for rejected windows)
+        Array of averaged values (NaN for rejected windows)
     """
     data, _ = activity_stream(activity_id, stream_type)
     time, _ = activity_stream(activity_id, 'time')
@@ -123,80 +267,285 @@ def windowed_average(activity_id, stream_type, data_min, data_max,
     if stream_type == 'velocity_smooth':
         data = np.array([s * 3.6 if s is not None else None for s in data])
     
-    # Calculate window size from time data
-    try:
-        time_step = time[time > time[0]][0] - time[0]
-        window_size = int(window_time / time_step)
-    except (IndexError, ZeroDivisionError):
+    _, data, pause_mask = resample_stream(time, data, grid_step)
+    
+    window_size = int(window_time / grid_step)
+    if len(data) == 0 or window_size < 1:
         return None
     
-    averaged_data = []
+    return window_statistics(data, pause_mask, stream_type, data_min, data_max,
+                             std_threshold, window_size)
+
+
+# ============================================================================
+# STREAMING PIPELINE
+# ============================================================================
+
+class WindowFeatureBuffer:
+    """
+    Preallocated feature buffer growing by doubling its capacity.
+    Appending n windows costs O(n) amortized instead of the O(n^2) of np.append.
+    """
+    
+    def __init__(self, n_columns=len(WINDOW_FEATURES), capacity=4096):
+        self.data = np.empty((capacity, n_columns))
+        self.size = 0
     
-    for i in range(0, len(data), window_size):
-        window = data[i:i + window_size]
-        window = np.array(window)
-        
-        # Check window validity
-        if len(window) != window_size:
-            averaged_data.append(None)
-            continue
+    def extend(self, rows):
+        """Append a (n, n_columns) block of window features"""
+        required = self.size + len(rows)
+        if required > len(self.data):
+            capacity = max(required, 2 * len(self.data))
+            grown = np.empty((capacity, self.data.shape[1]))
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:required] = rows
+        self.size = required
+    
+    def array(self):
+        """View on the filled part of the buffer"""
+        return self.data[:self.size]
+
+
+class WindowFeatureStatistics:
+    """
+    Running statistics over window features, in memory independent of history length.
+    Count, mean and variance are merged block by block (Chan et al. parallel update),
+    the gradient distribution is kept as a fixed-bin histogram.
+    """
+    
+    def __init__(self, gradient_bins=np.arange(GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH + 1, 1.0)):
+        n_columns = len(WINDOW_FEATURES)
+        self.count = np.zeros(n_columns)
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+        self.minimum = np.full(n_columns, np.inf)
+        self.maximum = np.full(n_columns, -np.inf)
+        self.gradient_bins = gradient_bins
+        self.gradient_histogram = np.zeros(len(gradient_bins) - 1, dtype=np.int64)
+        self.n_activities = 0
+    
+    def update(self, features):
+        """Fold a (n, n_features) block of windows into the statistics"""
+        self.n_activities += 1
+        valid = ~np.isnan(features)
+        block_count = valid.sum(axis=0)
+        if not block_count.any():
+            return
         
-        window_avg = np.mean(window)
-        window_std = np.std(window)
+        block_sum = np.where(valid, features, 0).sum(axis=0)
+        block_mean = np.divide(block_sum, block_count,
+                               out=np.zeros_like(block_sum), where=block_count > 0)
+        block_m2 = np.where(valid, (features - block_mean) ** 2, 0).sum(axis=0)
         
-        # Filter based on statistical criteria
-        is_valid = (window_std < std_threshold and 
-                   data_min < window_avg < data_max)
+        total = self.count + block_count
+        delta = block_mean - self.mean
+        ratio = np.divide(block_count, total, out=np.zeros_like(total), where=total > 0)
+        self.mean = self.mean + delta * ratio
+        self.m2 = self.m2 + block_m2 + delta ** 2 * self.count * ratio
+        self.count = total
         
-        # Additional filter for velocity: reject high acceleration
-        if stream_type == 'velocity_smooth' and is_valid:
-            acceleration = np.gradient(window)
-            if np.mean(acceleration) > 0.5:
-                averaged_data.append(None)
-                continue
+        self.minimum = np.fmin(self.minimum, np.nanmin(np.where(valid, features, np.inf), axis=0))
+        self.maximum = np.fmax(self.maximum, np.nanmax(np.where(valid, features, -np.inf), axis=0))
         
-        averaged_data.append(window_avg if is_valid else None)
+        gradient = features[:, WINDOW_FEATURES.index('gradient')]
+        self.gradient_histogram += np.histogram(gradient[~np.isnan(gradient)],
+                                                bins=self.gradient_bins)[0]
+    
+    def std(self):
+        """Standard deviation of each feature"""
+        return np.sqrt(np.divide(self.m2, self.count,
+                                 out=np.full_like(self.m2, np.nan), where=self.count > 0))
     
-    return np.array(averaged_data, dtype=float)
+    def summary(self):
+        """Dictionary of statistics per feature"""
+        std = self.std()
+        return {feature: {'count': int(self.count[i]), 'mean': self.mean[i], 'std': std[i],
+                          'min': self.minimum[i], 'max': self.maximum[i]}
+                for i, feature in enumerate(WINDOW_FEATURES)}
 
 
-def global_windowed_average():
+@profiled()
+def iter_activity_streams(activity_ids, stream_types=WINDOW_STREAMS, require_all=True):
     """
-    Compute windowed averages across all activities for HR, gradient, and speed.
+    Generate the stream bundle of each activity, decoding every stream once.
+    A single query walks the streams table in primary key order.
     
-    Returns:
-        Tuple of (heart_rate, gradient, speed) as concatenated numpy arrays
+    Args:
+        activity_ids: Strava activity IDs to load
+        stream_types: Stream types of the bundle (None for every stored stream)
+        require_all: Skip the activities missing one of the stream types
+    
+    Yields:
+        Tuple of (activity_id, {stream_type: numpy array})
+    """
+    wanted_ids = set(activity_ids)
+    if stream_types is None:
+        query, parameters = "SELECT id, stream_type, stream_value FROM streams ORDER BY id;", []
+        require_all = False
+    else:
+        query = ("SELECT id, stream_type, stream_value FROM streams WHERE stream_type IN ("
+                 + ",".join("?" for _ in stream_types) + ") ORDER BY id;")
+        parameters = list(stream_types)
+    
+    # Dedicated cursor so that other queries do not reset the iteration
+    stream_cursor = conn.cursor()
+    rows = stream_cursor.execute(query, parameters)
+    for activity_id, activity_rows in groupby(rows, key=lambda row: row[0]):
+        if activity_id not in wanted_ids:
+            continue
+        streams = {stream_type: (decode_polyline(stream_value) if stream_type == 'latlng'
+                                 and stream_value != '[]' else decode_stream(stream_value))
+                   for _, stream_type, stream_value in activity_rows
+                   if stream_value is not None}
+        if not require_all or all(stream_type in streams for stream_type in stream_types):
+            yield activity_id, streams
+    stream_cursor.close()
+
+
+@profiled()
+def iter_window_features(stream_bundles, window_time=60, grid_step=RESAMPLING_STEP,
+                         window_limits=WINDOW_LIMITS):
+    """
+    Generate windowed features for each stream bundle.
+    Streams are resampled once on the uniform grid and windowed together.
+    
+    Args:
+        stream_bundles: Iterable of (activity_id, streams) as given by iter_activity_streams
+        window_time: Window size in seconds
+        grid_step: Spacing of the resampling grid in seconds
+        window_limits: Acceptance limits of HR, gradient and speed windows
+    
+    Yields:
+        Tuple of (activity_id, features) where features is a (n_windows, 4) array
+        with columns WINDOW_FEATURES (NaN for rejected windows)
+    """
+    window_size = int(window_time / grid_step)
+    
+    for activity_id, streams in stream_bundles:
+        windows = []
+        for stream_type in ['heartrate', 'grade_smooth', 'velocity_smooth']:
+            data_min, data_max = window_limits[stream_type]
+            data = streams[stream_type]
+            # Convert velocity from m/s to km/h
+            if stream_type == 'velocity_smooth':
+                data = data * 3.6
+            _, data, pause_mask = resample_stream(streams['time'], data, grid_step)
+            windows.append(window_statistics(data, pause_mask, stream_type,
+                                             data_min, data_max, window_size=window_size))
+        
+        if len(windows[0]) == 0:
+            continue
+        window_hr, window_gradient, window_speed = windows
+        
+        # Normalize efficiency by flat terrain efficiency (|gradient| < 5%)
+        window_efficiency = window_hr / window_speed
+        flat_efficiency = window_efficiency[np.abs(window_gradient) < 5]
+        flat_efficiency = flat_efficiency[~np.isnan(flat_efficiency)]
+        average_flat_efficiency = flat_efficiency.mean() if len(flat_efficiency) else np.nan
+        
+        features = np.column_stack([window_hr, window_gradient, window_speed,
+                                    window_efficiency / average_flat_efficiency])
+        yield activity_id, features
+
+
+def _window_pipeline(window_time=60):
+    """Window features generator over all activities with HR, gradient and speed"""
+    activity_ids = ids_restricted(['heartrate', 'grade_smooth', 'velocity_smooth'])
+    return iter_window_features(iter_activity_streams(activity_ids), window_time)
+
+
+def _peak_memory(function, *args, **kwargs):
+    """Run function and print the peak memory traced during the run"""
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+    print(f"Peak memory: {peak / 1e6:.1f} MB")
+    return result
+
+
+@profiled()
+def collect_window_features(window_time=60, report_memory=False, return_activity_ids=False,
+                            return_window_times=False):
     """
-    all_activities = ids_restricted(['heartrate', 'grade_smooth', 'velocity_smooth'])
+    Collect the valid windows (HR, gradient and speed all accepted) of all activities.
     
-    # Collect windowed data for each activity
-    windows_hr = [
-        windowed_average(activity_id, 'heartrate', 130, 185)
-        for activity_id in all_activities
-        if windowed_average(activity_id, 'heartrate', 130, 185) is not None
-    ]
+    Args:
+        window_time: Window size in seconds
+        report_memory: Print the peak memory of the collection
+        return_activity_ids: Also return the activity ID of each window
+        return_window_times: Also return the elapsed time of each window centre (s)
     
-    windows_grad = [
-        windowed_average(activity_id, 'grade_smooth', GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH)
-        for activity_id in all_activities
-        if windowed_average(activity_id, 'grade_smooth', GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH) is not None
-    ]
+    Returns:
+        (n_windows, 4) array with columns WINDOW_FEATURES,
+        followed by the activity IDs and window times when requested
+    """
+    def collect():
+        buffer = WindowFeatureBuffer()
+        id_buffer = WindowFeatureBuffer(n_columns=1)
+        time_buffer = WindowFeatureBuffer(n_columns=1)
+        for activity_id, features in _window_pipeline(window_time):
+            # Remove windows where one of HR, gradient or speed is rejected
+            accepted = ~np.isnan(features[:, :3]).any(axis=1)
+            valid = features[accepted]
+            buffer.extend(valid)
+            if return_activity_ids:
+                id_buffer.extend(np.full((len(valid), 1), activity_id))
+            if return_window_times:
+                window_index = np.flatnonzero(accepted)
+                time_buffer.extend(((window_index + 0.5) * window_time)[:, None])
+        result = [buffer.array()]
+        if return_activity_ids:
+            result.append(id_buffer.array()[:, 0].astype(np.int64))
+        if return_window_times:
+            result.append(time_buffer.array()[:, 0])
+        return result[0] if len(result) == 1 else tuple(result)
     
-    windows_speed = [
-        windowed_average(activity_id, 'velocity_smooth', 8, 20)
-        for activity_id in all_activities
-        if windowed_average(activity_id, 'velocity_smooth', 8, 20) is not None
-    ]
+    if report_memory:
+        return _peak_memory(collect)
+    return collect()
+
+
+@profiled()
+def history_window_statistics(window_time=60, report_memory=True):
+    """
+    Whole-history statistics of the window features.
+    Windows are never stored, memory does not grow with history length.
     
-    # Concatenate all windows
-    all_hr = np.concatenate(windows_hr)
-    all_grad = np.concatenate(windows_grad)
-    all_speed = np.concatenate(windows_speed)
+    Args:
+        window_time: Window size in seconds
+        report_memory: Print the peak memory of the run
     
-    # Remove NaN values
-    mask = ~(np.isnan(all_hr) | np.isnan(all_grad) | np.isnan(all_speed))
+    Returns:
+        WindowFeatureStatistics of all activities
+    """
+    def accumulate():
+        statistics = WindowFeatureStatistics()
+        for _, features in _window_pipeline(window_time):
+            statistics.update(features[~np.isnan(features[:, :3]).any(axis=1)])
+        return statistics
     
-    return all_hr[mask], all_grad[mask], all_speed[mask]
+    if report_memory:
+        return _peak_memory(accumulate)
+    return accumulate()
+
+
+def global_windowed_average():
+    """
+    Compute windowed averages across all activities for HR, gradient, and speed.
+    
+    Returns:
+        Tuple of (heart_rate, gradient, speed) as concatenated numpy arrays
+    """
+    features = collect_window_features()
+    return features[:, 0].copy(), features[:, 1].copy(), features[:, 2].copy()
 
 
 def windowed_normalized_average_efficiency():
@@ -207,36 +556,14 @@ def windowed_normalized_average_efficiency():
     Returns:
         Array of normalized efficiency values
     """
-    normalized_efficiency = np.array([])
-    
-    for activity_id in ids_restricted(['heartrate', 'grade_smooth', 'velocity_smooth']):
-        window_hr = windowed_average(activity_id, 'heartrate', 130, 185)
-        window_speed = windowed_average(activity_id, 'velocity_smooth', 8, 20)
-        window_gradient = windowed_average(activity_id, 'grade_smooth', GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH)
-        
-        # Filter out NaN values
-        mask = ~(np.isnan(window_hr) | np.isnan(window_gradient) | np.isnan(window_speed))
-        clean_hr = window_hr[mask]
-        clean_gradient = window_gradient[mask]
-        clean_speed = window_speed[mask]
-        
-        # Calculate raw efficiency
-        window_efficiency = clean_hr / clean_speed
-        
-        # Normalize by flat terrain efficiency (|gradient| < 5%)
-        flat_mask = np.abs(clean_gradient) < 5
-        
-        average_flat_efficiency = np.mean(window_efficiency[flat_mask])
-        normalized = window_efficiency / average_flat_efficiency
-        normalized_efficiency = np.append(normalized_efficiency, normalized)
-
-    return normalized_efficiency
+    return collect_window_features()[:, 3].copy()
 
 
 # ============================================================================
 # REGRESSION AND MODELING FUNCTIONS
 # ============================================================================
 
+@profiled()
 def efficiency_regression_polynomial(regression_degree,return_true_values=False):
     """
     Compute Grade Adjusted Pace (GAP) model using polynomial regression.
@@ -269,6 +596,7 @@ def efficiency_regression_polynomial(regression_degree,return_true_values=False)
 
 
 
+@profiled()
 def efficiency_regression_spline(return_true_values=False,smoothing=0.0):
     """
     Compute Grade Adjusted Pace (GAP) model using cubic B-spline regression.
@@ -315,6 +643,120 @@ def efficiency_regression_spline(return_true_values=False,smoothing=0.0):
 
 
 
+def bin_efficiency_by_gradient(gradient, efficiency, bin_width=GAP_BIN_WIDTH, min_count=5):
+    """
+    Aggregate efficiency samples into gradient bins.
+    
+    Args:
+        gradient: Gradient of each window (%)
+        efficiency: Normalized efficiency of each window
+        bin_width: Width of the gradient bins (%)
+        min_count: Bins with fewer samples are dropped
+    
+    Returns:
+        Dictionary of arrays, one value per non-empty bin:
+        'gradient' (mean gradient of the bin), 'count', 'mean', 'variance', 'median'
+    """
+    gradient = np.asarray(gradient, dtype=float)
+    efficiency = np.asarray(efficiency, dtype=float)
+    
+    bin_index = np.floor((gradient - GRAD_LIMIT_LOW) / bin_width).astype(np.int64)
+    bin_index -= bin_index.min() if len(bin_index) else 0
+    
+    counts = np.bincount(bin_index)
+    sum_gradient = np.bincount(bin_index, weights=gradient)
+    sum_efficiency = np.bincount(bin_index, weights=efficiency)
+    sum_squares = np.bincount(bin_index, weights=efficiency ** 2)
+    
+    kept = counts >= max(min_count, 1)
+    counts_kept = counts[kept]
+    mean = sum_efficiency[kept] / counts_kept
+    variance = np.maximum(sum_squares[kept] / counts_kept - mean ** 2, 0)
+    
+    # Medians: sort by (bin, efficiency) and take the middle of each bin
+    order = np.lexsort((efficiency, bin_index))
+    sorted_efficiency = efficiency[order]
+    bin_start = np.concatenate([[0], np.cumsum(counts)[:-1]])[kept]
+    low = sorted_efficiency[bin_start + (counts_kept - 1) // 2]
+    high = sorted_efficiency[bin_start + counts_kept // 2]
+    
+    return {'gradient': sum_gradient[kept] / counts_kept,
+            'count': counts_kept,
+            'mean': mean,
+            'variance': variance,
+            'median': (low + high) / 2}
+
+
+@profiled()
+def fit_binned_spline(gradient, efficiency, smoothing=None, bin_width=GAP_BIN_WIDTH,
+                      robust=True, min_count=5, return_bins=False, smoothing_factor=1.0):
+    """
+    Fit a weighted cubic spline on the gradient bins of efficiency samples.
+    
+    Args:
+        gradient: Gradient of each window (%)
+        efficiency: Normalized efficiency of each window
+        smoothing: Smoothing factor of make_splrep, defaults to the number of bins
+            (weights are the inverse standard error of each bin)
+        bin_width: Width of the gradient bins (%)
+        robust: Fit the bin medians instead of the bin means
+        min_count: Bins with fewer windows are dropped
+        return_bins: Also return the bin statistics
+        smoothing_factor: Multiple of the number of bins used when smoothing is not given
+    
+    Returns:
+        B-spline function
+    """
+    bins = bin_efficiency_by_gradient(gradient, efficiency, bin_width, min_count)
+    
+    # Standard error of the bin value (the median is ~1.25 times noisier than the mean)
+    std = np.sqrt(bins['variance'])
+    # Floor only against zero-variance bins, the other bins keep their own variance
+    std = np.maximum(std, np.percentile(std[std > 0], 5) if (std > 0).any() else 1e-6)
+    standard_error = std / np.sqrt(bins['count'])
+    if robust:
+        standard_error *= np.sqrt(np.pi / 2)
+    
+    bin_values = bins['median'] if robust else bins['mean']
+    if smoothing is None:
+        smoothing = smoothing_factor * len(bin_values)
+    
+    bspline = interpolate.make_splrep(bins['gradient'], bin_values,
+                                      w=1 / standard_error, s=smoothing)
+    
+    if not return_bins:
+        return bspline
+    else:
+        return bspline, bins
+
+
+def efficiency_regression_binned_spline(return_true_values=False, smoothing=None,
+                                        bin_width=GAP_BIN_WIDTH, robust=True, min_count=5):
+    """
+    Compute Grade Adjusted Pace (GAP) model using a weighted cubic spline on gradient bins.
+    Every window contributes to its bin, the spline is fitted on the bin statistics
+    so the fit cost depends on the number of bins, not on the number of windows.
+    
+    Args:
+        return_true_values: Also return the bin statistics
+        smoothing: Smoothing factor of make_splrep, defaults to the number of bins
+        bin_width: Width of the gradient bins (%)
+        robust: Fit the bin medians instead of the bin means
+        min_count: Bins with fewer windows are dropped
+    
+    Returns:
+        B-spline function
+    """
+    features = collect_window_features()
+    gradient_data = features[:, 1]
+    efficiency_data = features[:, 3]
+    
+    # Remove NaN values
+    mask = ~(np.isnan(efficiency_data) | np.isnan(gradient_data))
+    return fit_binned_spline(gradient_data[mask], efficiency_data[mask], smoothing,
+                             bin_width, robust, min_count, return_bins=return_true_values)
+
+
 # ============================================================================
 # CLUSTERING FUNCTIONS
 # ============================================================================
@@ -331,7 +773,9 @@ def clustering(data_x, data_y, n_clusters=5):
     Returns:
         Tuple of (labels, centroids)
     """
-    data_points = np.array(list(zip(data_x, data_y)))
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.cluster import KMeans
+    data_points = np.column_stack([data_x, data_y])
     
     # Normalize data for better clustering
     scaler = StandardScaler()
@@ -350,7 +794,7 @@ def clustering(data_x, data_y, n_clusters=5):
     return labels, centroids_original
 
 
-def scatter_centers(data_x, data_y, n_clusters=5):
+def scatter_centers(data_x=None, data_y=None, n_clusters=5, centroids=None):
     """
     Plot cluster centroids on current figure.
     
@@ -358,33 +802,46 @@ def scatter_centers(data_x, data_y, n_clusters=5):
         data_x: First feature
         data_y: Second feature  
         n_clusters: Number of clusters
+        centroids: Already fitted centroids (e.g. ZoneClusteringEngine.centroids()),
+            the clustering is only computed when they are not given
     """
-    _, centroids = clustering(data_x, data_y, n_clusters)
+    if centroids is None:
+        _, centroids = clustering(data_x, data_y, n_clusters)
     
     for i, center in enumerate(centroids):
         plt.scatter(center[0], center[1], 
-                   color=COLORS[i], marker='X', s=200)
+                   color=COLORS[i % len(COLORS)], marker='X', s=200)
         
 # ============================================================================
 # REGRESSION QUALITY
 # ============================================================================
 
+def r2_score(y_true, y_pred):
+    """Coefficient of determination (same value as sklearn.metrics.r2_score)"""
+    y_true = np.asarray(y_true, dtype=float)
+    residual_sum = np.sum((y_true - np.asarray(y_pred, dtype=float)) ** 2)
+    total_sum = np.sum((y_true - y_true.mean()) ** 2)
+    return 1 - residual_sum / total_sum
+
+
 def regression_quality(regression='polynomial',regression_degree=2,smoothing=0.0):
     """
-    Determine quality of the regression using the R squared score
+    Determine quality of the regression using the (in-sample) R squared score
+    See gap_model_selection for cross-validated scores
     
     Args:
         regression: {"polynomial","spline"}, the type of regression
         regression_degree: The number of degree for the polynomial regression 
+        smoothing: Smoothing factor of the spline regression
     """
     if regression=='polynomial':
         f_pred,y_true,x_true=efficiency_regression_polynomial(regression_degree=regression_degree,return_true_values=True)
-        y_pred=np.array([f_pred(x) for x in x_true])
+        y_pred=f_pred(x_true)
         score=r2_score(y_true,y_pred)
         return score
     elif regression=='spline':
-        f_pred,y_true,x_true=efficiency_regression_polynomial(regression_degree=regression_degree,return_true_values=True,smoothing=smoothing)
-        y_pred=np.array([f_pred.__call__(x) for x in x_true])
+        f_pred,y_true,x_true=efficiency_regression_spline(return_true_values=True,smoothing=smoothing)
+        y_pred=f_pred(x_true)
         score=r2_score(y_true,y_pred)
         return score
 
@@ -393,13 +850,18 @@ def regression_quality(regression='polynomial',regression_degree=2,smoothing=0.0
 # MAIN ANALYSIS AND PLOTTING
 # ============================================================================
 
-def plot_specific_activity(activity_id):
+@profiled()
+def plot_specific_activity(activity_id, max_points=PLOT_MAX_POINTS, decimation='lttb',
+                           rasterized=False):
     """
     Create scatter plot of HR vs speed for a specific activity.
+    Long activities are decimated to max_points keeping the HR and speed peaks.
     
     Args:
         activity_id: Strava activity ID
-        date: Date string for title
+        max_points: Target number of plotted points, None to plot every sample
+        decimation: {"lttb","minmax"}, the decimation method
+        rasterized: Rasterize the scatter (lighter vector files)
     """
     bpm, _ = activity_stream(activity_id, 'heartrate')
     speed, _ = activity_stream(activity_id, 'velocity_smooth')
@@ -407,10 +869,16 @@ def plot_specific_activity(activity_id):
     date=dates_from_ids([activity_id])[0]
     
     # Convert speed to km/h
-    speed = speed * 3.6
+    speed = np.asarray(speed, dtype=float) * 3.6
+    bpm = np.asarray(bpm, dtype=float)
+    time = np.asarray(time, dtype=float)
+    
+    if max_points is not None and len(time) > max_points:
+        kept = decimate_streams(time, [bpm, speed], max_points, method=decimation)
+        bpm, speed, time = bpm[kept], speed[kept], time[kept]
     
     plt.figure(figsize=(10, 6))
-    plt.scatter(speed, bpm, c=time, cmap='seismic', alpha=0.6)
+    plt.scatter(speed, bpm, c=time, cmap='seismic', alpha=0.6, rasterized=rasterized)
     plt.xlabel("Speed (km/h)")
     plt.ylabel("Heart rate (bpm)")
     plt.title(f"Heart rate vs Speed for activity of {date}")
@@ -422,9 +890,30 @@ def plot_specific_activity(activity_id):
     print(f"Saved: {filename}")
 
 
-def plot_gap_model(regression='polynomial',smoothing=0):
+def plot_all_activities(max_points=PLOT_MAX_POINTS, decimation='lttb', rasterized=True):
+    """
+    Render the HR vs speed figure of every activity with HR and speed streams.
+    
+    Args:
+        max_points: Target number of plotted points per figure
+        decimation: {"lttb","minmax"}, the decimation method
+        rasterized: Rasterize the scatters
+    """
+    for activity_id in ids_restricted(['heartrate', 'velocity_smooth', 'time']):
+        plot_specific_activity(activity_id, max_points, decimation, rasterized)
+        plt.close()
+
+
+@profiled()
+def plot_gap_model(regression='polynomial',smoothing=0,bands=False,n_replicates=500):
     """
     Create plot showing GAP model regression results.
+    
+    Args:
+        regression: {"polynomial","spline","binned"}, the type of regression
+        smoothing: Smoothing factor of the spline regressions
+        bands: Draw the 95% bootstrap band of the polynomial model (activity-level resampling)
+        n_replicates: Number of bootstrap replicates of the band
     """
     _,gradient_data,_=global_windowed_average()
 
@@ -446,6 +935,13 @@ def plot_gap_model(regression='polynomial',smoothing=0):
         gap_values = [(gap_factor.__call__(grad)/origin_value - 1) for grad in gradient_sorted]
         
 
+    elif regression=='binned':
+        
+        # Weighted spline on the gradient bins
+        spline_function = efficiency_regression_binned_spline(
+            smoothing=smoothing if smoothing else None)
+        gap_values = spline_function(gradient_sorted) / spline_function(0) - 1
+
     elif regression == 'polynomial':
         # Compute regression (degree 2)
         
@@ -464,6 +960,14 @@ def plot_gap_model(regression='polynomial',smoothing=0):
             alpha=0.3, s=10, label='Data points')
     plt.plot(gradient_sorted, gap_values, 
             'r-', linewidth=2, label='GAP model')
+    if bands and regression == 'polynomial':
+        from gap_statistics import bootstrap_gap_bands
+        # Read-only: the bands use the stored power sums, the plot does not update them
+        band = bootstrap_gap_bands(degree=2, n_replicates=n_replicates,
+                                   gradient=np.linspace(gradient_sorted[0], gradient_sorted[-1], 200),
+                                   update=False)
+        plt.fill_between(band['gradient'], band['lower'], band['upper'],
+                         color='r', alpha=0.2, label='95% bootstrap band')
     plt.xlabel("Gradient (%)")
     plt.ylabel("Normalized efficiency - 1")
     plt.title("Grade Adjusted Pace (GAP) Model")
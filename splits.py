@@ -0,0 +1,361 @@
+"""
+Module for the distance splits (per kilometre and per mile) of every activity.
+Split boundaries are located in the cumulative distance stream with one
+np.searchsorted call, and every per-split value comes from cumulative sums
+interpolated at the boundaries, so an activity is split without Python loops.
+The splits are stored in the splits table when the activities are inserted,
+so questions like the fastest 5th km are plain SQL. Each split also keeps the
+distance-weighted moments of its gradient, so the GAP paces of every split are
+recomputed from the table alone whenever the GAP model changes.
+"""
+
+import numpy as np
+from specific_activity_analysis import (iter_activity_streams, PAUSE_THRESHOLD,
+                                        GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH)
+from instrumentation import profiled
+from database import connection, register_schema
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Split lengths (m)
+SPLIT_UNITS = {'km': 1000.0, 'mile': 1609.344}
+
+SPLIT_STREAMS = ['time', 'distance', 'heartrate', 'cadence', 'grade_smooth', 'velocity_smooth']
+
+# Degree of the GAP model (current_gap_polynomial), the splits store the
+# moments Σ distance·gradient^k for k = 0..GAP_DEGREE
+GAP_DEGREE = 2
+MOMENT_COLUMNS = [f'grade_moment_{k}' for k in range(GAP_DEGREE + 1)]
+
+# Relative efficiency floor of a split against a degenerate model
+MIN_RELATIVE_EFFICIENCY = 0.1
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+def _add_moment_columns(schema_cursor):
+    """Splits stored before the gradient moments are dropped to be computed again"""
+    columns = {row[1] for row in schema_cursor.execute("PRAGMA table_info(splits);")}
+    if 'gap_model' not in columns:
+        for column in MOMENT_COLUMNS:
+            schema_cursor.execute(f"ALTER TABLE splits ADD COLUMN {column} REAL;")
+        schema_cursor.execute("ALTER TABLE splits ADD COLUMN gap_model TEXT;")
+        schema_cursor.execute("DELETE FROM splits;")
+
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS splits (
+    id INTEGER,
+    unit TEXT,
+    split INTEGER,
+    distance REAL,
+    complete INTEGER,
+    elapsed_time REAL,
+    moving_time REAL,
+    pace REAL,
+    gap_pace REAL,
+    average_heartrate REAL,
+    average_cadence REAL,
+    average_grade REAL,
+    grade_moment_0 REAL,
+    grade_moment_1 REAL,
+    grade_moment_2 REAL,
+    gap_model TEXT,
+    PRIMARY KEY (id, unit, split),
+    FOREIGN KEY (id) REFERENCES activity(id)
+) WITHOUT ROWID;
+""", _add_moment_columns, """
+CREATE INDEX IF NOT EXISTS idx_splits_pace ON splits(unit, split, complete, pace);
+""", """
+CREATE INDEX IF NOT EXISTS idx_splits_gap_pace ON splits(unit, split, complete, gap_pace);
+""", """
+DROP INDEX IF EXISTS idx_splits_unit_split;
+""")
+
+
+# ============================================================================
+# SPLITS
+# ============================================================================
+
+def _at_distances(boundaries, distance, values):
+    """
+    Values of a cumulative stream at some distances, interpolated between the
+    two samples around each distance (found with searchsorted).
+    """
+    upper = np.clip(np.searchsorted(distance, boundaries, side='left'), 1, len(distance) - 1)
+    lower = upper - 1
+    span = distance[upper] - distance[lower]
+    fraction = np.divide(boundaries - distance[lower], span,
+                         out=np.zeros(len(boundaries)), where=span > 0)
+    return values[lower] + np.clip(fraction, 0, 1) * (values[upper] - values[lower])
+
+
+def _cumulative(weights, values=None):
+    """Cumulative sum starting at 0 of weights (times values, NaN values count as 0)"""
+    terms = weights if values is None else np.where(np.isnan(values), 0.0, values) * weights
+    return np.concatenate([[0.0], np.cumsum(terms)])
+
+
+def activity_splits(streams, split_length=1000.0, gap_polynomial=None):
+    """
+    Splits of one activity.
+
+    Args:
+        streams: Stream bundle {stream_type: array} with 'time' and 'distance'
+        split_length: Split length (m)
+        gap_polynomial: Polynomial GAP model (efficiency vs gradient %), None for no GAP pace
+
+    Returns:
+        Dictionary of arrays with one value per split: 'distance' (m), 'complete',
+        'elapsed_time' and 'moving_time' (s), 'pace' and 'gap_pace' (s/km),
+        'average_heartrate' (bpm), 'average_cadence' (steps/min), 'average_grade' (%),
+        and 'grade_moments' ((n_splits, GAP_DEGREE + 1) array, NaN without gradient).
+        Empty dictionary when the activity cannot be split.
+    """
+    time = np.asarray(streams.get('time', []), dtype=float)
+    distance = np.asarray(streams.get('distance', []), dtype=float)
+    if len(time) < 2 or len(distance) != len(time) or np.isnan(distance).any():
+        return {}
+    # Distance is cumulative, small GPS corrections can make it decrease
+    distance = np.maximum.accumulate(distance)
+    if distance[-1] <= distance[0]:
+        return {}
+
+    # Each sample interval counts for its duration, pauses only in the elapsed time
+    durations = np.diff(time)
+    moving = np.where(durations <= PAUSE_THRESHOLD, durations, 0.0)
+
+    boundaries = np.append(np.arange(distance[0], distance[-1], split_length), distance[-1])
+    if boundaries[-1] - boundaries[-2] < 1e-6:
+        boundaries = boundaries[:-1]
+    if len(boundaries) < 2:
+        return {}
+    split_distance = np.diff(boundaries)
+
+    def split_delta(cumulative):
+        return np.diff(_at_distances(boundaries, distance, cumulative))
+
+    elapsed_time = split_delta(time)
+    moving_time = split_delta(_cumulative(moving))
+    splits = {'distance': split_distance,
+              'complete': (np.abs(split_distance - split_length) < 1e-6).astype(int),
+              'elapsed_time': elapsed_time, 'moving_time': moving_time,
+              'pace': np.divide(moving_time * 1000, split_distance)}
+
+    # Time-weighted averages: integral of the stream over the split / valid time
+    for key, stream_type, factor in [('average_heartrate', 'heartrate', 1.0),
+                                     ('average_cadence', 'cadence', 2.0),
+                                     ('average_grade', 'grade_smooth', 1.0)]:
+        data = streams.get(stream_type)
+        if data is None or len(data) != len(time):
+            splits[key] = np.full(len(split_distance), np.nan)
+            continue
+        data = np.asarray(data, dtype=float)[:-1]
+        valid_time = split_delta(_cumulative(np.where(np.isnan(data), 0.0, moving)))
+        integral = split_delta(_cumulative(moving, data))
+        splits[key] = np.divide(integral * factor, valid_time,
+                                out=np.full(len(split_distance), np.nan), where=valid_time > 0)
+
+    # Moments Σ distance·gradient^k of the split: any polynomial GAP model of
+    # degree <= GAP_DEGREE gives the flat-equivalent distance from them
+    moments = np.full((len(split_distance), GAP_DEGREE + 1), np.nan)
+    grade = streams.get('grade_smooth')
+    if grade is not None and len(grade) == len(time):
+        grade = np.clip(np.nan_to_num(np.asarray(grade, dtype=float)[:-1]),
+                        GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH)
+        step = np.diff(distance)
+        moments = np.column_stack([split_delta(_cumulative(step * grade ** k))
+                                   for k in range(GAP_DEGREE + 1)])
+    splits['grade_moments'] = moments
+    splits['gap_pace'] = gap_paces(moving_time, moments, gap_polynomial)
+    return splits
+
+
+def gap_paces(moving_time, moments, gap_polynomial):
+    """
+    GAP paces of splits: pace of the equivalent flat distance, each sample
+    counting for its distance times the relative efficiency (heart rate / speed,
+    above 1 uphill) at its gradient, as the speed * (1 + gap) adjustment.
+
+    Args:
+        moving_time: Moving time of the splits (s)
+        moments: (n_splits, GAP_DEGREE + 1) gradient moments of the splits
+        gap_polynomial: Polynomial GAP model of degree <= GAP_DEGREE, None for no GAP pace
+
+    Returns:
+        GAP paces (s/km), NaN without model or gradient
+    """
+    moving_time = np.asarray(moving_time, dtype=float)
+    paces = np.full(len(moving_time), np.nan)
+    if gap_polynomial is None or len(moving_time) == 0:
+        return paces
+    if gap_polynomial.order > GAP_DEGREE:
+        raise ValueError(f"GAP model degree must be <= {GAP_DEGREE}")
+    moments = np.asarray(moments, dtype=float)
+    # Coefficients in increasing degree, padded to GAP_DEGREE
+    coefficients = np.zeros(GAP_DEGREE + 1)
+    coefficients[:gap_polynomial.order + 1] = gap_polynomial.coeffs[::-1]
+    flat_distance = moments @ coefficients / gap_polynomial(0)
+    # Floor against a degenerate model at the extreme gradients
+    flat_distance = np.maximum(flat_distance, MIN_RELATIVE_EFFICIENCY * moments[:, 0])
+    return np.divide(moving_time * 1000, flat_distance, out=paces,
+                     where=~np.isnan(flat_distance) & (flat_distance > 0))
+
+
+def current_gap_polynomial():
+    """Polynomial GAP model from the stored power sums, None before any GAP statistics"""
+    from gap_statistics import incremental_gap_polynomial, total_power_sums
+    if len(total_power_sums()[0]) == 0:
+        return None
+    return incremental_gap_polynomial(degree=GAP_DEGREE, update=False)
+
+
+def gap_model_key(gap_polynomial):
+    """Text identifying a GAP model, stored with the GAP paces it computed"""
+    if gap_polynomial is None:
+        return None
+    return ','.join(f'{coefficient:.12g}' for coefficient in gap_polynomial.coeffs)
+
+
+@profiled()
+def update_splits(activity_ids=None, units=SPLIT_UNITS):
+    """
+    Compute and store the splits of the activities not split yet, then
+    recompute the GAP paces of the splits computed with another GAP model.
+
+    Args:
+        activity_ids: Activities to (re)compute, defaults to the new ones
+        units: Dictionary {unit name: split length (m)}
+
+    Returns:
+        Number of split activities
+    """
+    if activity_ids is None:
+        activity_ids = [row[0] for row in cursor.execute("""
+            SELECT DISTINCT s.id FROM streams s
+            WHERE s.stream_type = 'distance'
+            AND NOT EXISTS (SELECT 1 FROM splits p WHERE p.id = s.id);
+        """).fetchall()]
+    gap_polynomial = current_gap_polynomial()
+    model_key = gap_model_key(gap_polynomial)
+    columns = ['distance', 'complete', 'elapsed_time', 'moving_time', 'pace', 'gap_pace',
+               'average_heartrate', 'average_cadence', 'average_grade']
+    n_processed = 0
+    for activity_id, streams in iter_activity_streams(activity_ids, SPLIT_STREAMS,
+                                                      require_all=False):
+        rows = []
+        for unit, split_length in units.items():
+            splits = activity_splits(streams, split_length, gap_polynomial)
+            if not splits:
+                continue
+            table = np.column_stack([splits[column] for column in columns]
+                                    + [splits['grade_moments']])
+            rows.extend((activity_id, unit, split + 1)
+                        + tuple(None if np.isnan(value) else float(value) for value in row)
+                        + (model_key,)
+                        for split, row in enumerate(table))
+        # A split 0 row marks activities that cannot be split (e.g. no distance
+        # covered), they are not reprocessed
+        rows = rows or [(activity_id, '', 0) + (None,) * (len(columns) + len(MOMENT_COLUMNS))
+                        + (model_key,)]
+        cursor.execute("DELETE FROM splits WHERE id = ?;", (activity_id,))
+        cursor.executemany(f"""
+            INSERT INTO splits (id, unit, split, {', '.join(columns + MOMENT_COLUMNS)}, gap_model)
+            VALUES (?, ?, ?, {', '.join('?' for _ in columns + MOMENT_COLUMNS)}, ?);
+        """, rows)
+        n_processed += 1
+    conn.commit()
+    update_gap_paces(gap_polynomial)
+    return n_processed
+
+
+@profiled()
+def update_gap_paces(gap_polynomial=None):
+    """
+    Recompute in one pass the GAP paces of the splits computed with another GAP
+    model, so all the stored GAP paces come from the same model.
+
+    Args:
+        gap_polynomial: Polynomial GAP model, defaults to the current one
+
+    Returns:
+        Number of updated splits
+    """
+    if gap_polynomial is None:
+        gap_polynomial = current_gap_polynomial()
+    model_key = gap_model_key(gap_polynomial)
+    rows = cursor.execute(f"""
+        SELECT id, unit, split, moving_time, {', '.join(MOMENT_COLUMNS)}
+        FROM splits WHERE split > 0 AND gap_model IS NOT ?;
+    """, (model_key,)).fetchall()
+    if not rows:
+        return 0
+    table = np.array([row[3:] for row in rows], dtype=float)
+    paces = gap_paces(table[:, 0], table[:, 1:], gap_polynomial)
+    cursor.executemany("""
+        UPDATE splits SET gap_pace = ?, gap_model = ? WHERE id = ? AND unit = ? AND split = ?;
+    """, [(None if np.isnan(pace) else float(pace), model_key, *row[:3])
+          for pace, row in zip(paces, rows)])
+    conn.commit()
+    return len(rows)
+
+
+# ============================================================================
+# QUERIES
+# ============================================================================
+
+def fastest_splits(split=None, unit='km', limit=10, by='pace'):
+    """
+    Fastest complete splits.
+
+    Args:
+        split: Split number (e.g. 5 for the 5th km), None for any split
+        unit: 'km' or 'mile'
+        limit: Number of splits returned
+        by: 'pace' or 'gap_pace'
+
+    Returns:
+        List of (activity id, split, date, moving time s, pace s/km) rows
+    """
+    if by not in ('pace', 'gap_pace'):
+        raise ValueError("by must be 'pace' or 'gap_pace'")
+    # A fixed split number lets SQLite walk the (unit, split, complete, pace) index in order
+    split_condition = "" if split is None else "AND s.split = ?"
+    parameters = (unit,) + (() if split is None else (split,)) + (limit,)
+    return cursor.execute(f"""
+        SELECT s.id, s.split, date(a.start_date), s.moving_time, s.{by}
+        FROM splits s JOIN activity a ON a.id = s.id
+        WHERE s.unit = ? {split_condition} AND s.complete = 1
+        AND s.{by} IS NOT NULL
+        ORDER BY s.{by}
+        LIMIT ?;
+    """, parameters).fetchall()
+
+
+def activity_split_table(activity_id, unit='km'):
+    """Splits of one activity as a list of (split, distance, moving time, pace, GAP pace, heart rate) rows"""
+    return cursor.execute("""
+        SELECT split, distance, moving_time, pace, gap_pace, average_heartrate
+        FROM splits WHERE id = ? AND unit = ? AND split > 0 ORDER BY split;
+    """, (activity_id, unit)).fetchall()
+
+
+def format_pace(seconds_per_km):
+    """Pace as min:s"""
+    if seconds_per_km is None:
+        return '-'
+    minutes, seconds = divmod(int(round(seconds_per_km)), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"Split activities: {update_splits()}")
+    for activity_id, split, date, moving_time, pace in fastest_splits(split=5):
+        print(f"{date} ({activity_id}) km {split}: {format_pace(pace)} /km")
@@ -0,0 +1,284 @@
+"""
+Module of SQLite functions on the stored streams.
+The functions decode a stream_value (JSON text) inside the query, so stream
+conditions are written in SQL and only the matching activities reach Python.
+They are registered on the analysis connections by global_analysis_sql.py
+(add_connection_hook(register_stream_functions)).
+
+Scalar functions (NULL when the stream is empty or not a JSON stream):
+    stream_mean(stream), stream_std(stream), stream_max(stream)
+    stream_percentile(stream, q)                   q in [0, 100]
+    stream_time_above(stream, time, threshold)     moving seconds above threshold
+    stream_longest_above(stream, time, threshold)  longest continuous seconds above threshold
+    stream_rolling_max(stream, time, window)       best average over window seconds of moving time
+Aggregate functions (over the samples of all the rows):
+    stream_pooled_mean(stream), stream_pooled_std(stream), stream_pooled_percentile(stream, q)
+
+Example (runs with a heart rate above 170 bpm for 5 minutes in a row,
+with activities_where of global_analysis_sql.py):
+    activities_where("stream_longest_above(heartrate, time, 170) >= 300",
+                     ['heartrate', 'time'])
+"""
+
+import functools
+import json
+import numpy as np
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Gap between two samples considered as a pause (s), as in specific_activity_analysis
+PAUSE_THRESHOLD = 10
+
+# Spacing of the time grid of stream_rolling_max (s)
+GRID_STEP = 1.0
+
+
+# ============================================================================
+# DECODING
+# ============================================================================
+
+@functools.lru_cache(maxsize=32)
+def _decode(stream_value):
+    """Decoded stream (read-only, cached as one query often uses a stream several times)"""
+    try:
+        data = np.array(json.loads(stream_value), dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if data.ndim != 1 or len(data) == 0:
+        return None
+    data.flags.writeable = False
+    return data
+
+
+def _decode_pair(stream_value, time_value):
+    """Stream and time stream of an activity, None if they cannot be aligned"""
+    data, time = _decode(stream_value), _decode(time_value)
+    if data is None or time is None or len(data) != len(time):
+        return None, None
+    return data, time
+
+
+def _moving_durations(time):
+    """Duration of every sample (until the next one), 0 for the pauses and the last sample"""
+    durations = np.append(np.diff(time), 0.0)
+    durations[durations > PAUSE_THRESHOLD] = 0.0
+    return durations
+
+
+def _nan_to_none(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+# ============================================================================
+# SCALAR FUNCTIONS
+# ============================================================================
+
+def stream_mean(stream_value):
+    data = _decode(stream_value)
+    return None if data is None or np.isnan(data).all() else _nan_to_none(np.nanmean(data))
+
+
+def stream_std(stream_value):
+    data = _decode(stream_value)
+    return None if data is None or np.isnan(data).all() else _nan_to_none(np.nanstd(data))
+
+
+def stream_max(stream_value):
+    data = _decode(stream_value)
+    return None if data is None or np.isnan(data).all() else _nan_to_none(np.nanmax(data))
+
+
+def stream_percentile(stream_value, q):
+    data = _decode(stream_value)
+    if data is None or q is None or np.isnan(data).all():
+        return None
+    return _nan_to_none(np.nanpercentile(data, q))
+
+
+def stream_time_above(stream_value, time_value, threshold):
+    data, time = _decode_pair(stream_value, time_value)
+    if data is None or threshold is None:
+        return None
+    return float(_moving_durations(time)[data > threshold].sum())
+
+
+def stream_longest_above(stream_value, time_value, threshold):
+    data, time = _decode_pair(stream_value, time_value)
+    if data is None or threshold is None:
+        return None
+    durations = _moving_durations(time)
+    # A run above the threshold ends at a sample below it or at a pause
+    above = (data > threshold) & (durations > 0)
+    if not above.any():
+        return 0.0
+    cumulative = np.concatenate([[0.0], np.cumsum(np.where(above, durations, 0.0))])
+    edges = np.diff(np.concatenate([[0], above.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return float((cumulative[ends] - cumulative[starts]).max())
+
+
+def stream_rolling_max(stream_value, time_value, window):
+    data, time = _decode_pair(stream_value, time_value)
+    if data is None or window is None or len(time) < 2 or np.isnan(time).any():
+        return None
+    # Moving time grid: interpolate on a uniform grid and drop the pause points
+    grid_time = np.arange(time[0], time[-1] + GRID_STEP / 2, GRID_STEP)
+    previous_sample = np.clip(np.searchsorted(time, grid_time, side='right') - 1, 0, len(time) - 2)
+    pause_mask = (np.diff(time)[previous_sample] > PAUSE_THRESHOLD) & (grid_time > time[previous_sample])
+    values = np.interp(grid_time, time, data)[~pause_mask]
+
+    size = int(round(window / GRID_STEP))
+    if size < 1 or size > len(values):
+        return None
+    missing = np.isnan(values)
+    cumulative = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, values))])
+    cumulative_missing = np.concatenate([[0], np.cumsum(missing)])
+    complete = (cumulative_missing[size:] - cumulative_missing[:-size]) == 0
+    if not complete.any():
+        return None
+    return float((cumulative[size:] - cumulative[:-size])[complete].max() / size)
+
+
+# ============================================================================
+# AGGREGATE FUNCTIONS
+# ============================================================================
+
+class StreamPooledMean:
+    """Mean of the samples of all the rows"""
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def step(self, stream_value):
+        data = _decode(stream_value)
+        if data is not None:
+            valid = data[~np.isnan(data)]
+            self.total += valid.sum()
+            self.count += len(valid)
+
+    def finalize(self):
+        return self.total / self.count if self.count else None
+
+
+class StreamPooledStd(StreamPooledMean):
+    """Standard deviation of the samples of all the rows"""
+
+    def __init__(self):
+        super().__init__()
+        self.total_squares = 0.0
+
+    def step(self, stream_value):
+        data = _decode(stream_value)
+        if data is not None:
+            valid = data[~np.isnan(data)]
+            self.total += valid.sum()
+            self.total_squares += (valid ** 2).sum()
+            self.count += len(valid)
+
+    def finalize(self):
+        if not self.count:
+            return None
+        mean = self.total / self.count
+        return float(np.sqrt(max(self.total_squares / self.count - mean ** 2, 0.0)))
+
+
+class StreamPooledPercentile:
+    """Percentile of the samples of all the rows"""
+
+    def __init__(self):
+        self.arrays = []
+        self.q = None
+
+    def step(self, stream_value, q):
+        data = _decode(stream_value)
+        self.q = q
+        if data is not None:
+            self.arrays.append(data[~np.isnan(data)])
+
+    def finalize(self):
+        if not self.arrays or self.q is None:
+            return None
+        samples = np.concatenate(self.arrays)
+        return float(np.percentile(samples, self.q)) if len(samples) else None
+
+
+# ============================================================================
+# REGISTRATION
+# ============================================================================
+
+SCALAR_FUNCTIONS = {
+    'stream_mean': (stream_mean, 1),
+    'stream_std': (stream_std, 1),
+    'stream_max': (stream_max, 1),
+    'stream_percentile': (stream_percentile, 2),
+    'stream_time_above': (stream_time_above, 3),
+    'stream_longest_above': (stream_longest_above, 3),
+    'stream_rolling_max': (stream_rolling_max, 3),
+}
+
+AGGREGATE_FUNCTIONS = {
+    'stream_pooled_mean': (StreamPooledMean, 1),
+    'stream_pooled_std': (StreamPooledStd, 1),
+    'stream_pooled_percentile': (StreamPooledPercentile, 2),
+}
+
+
+def register_stream_functions(connection):
+    """Register the stream functions on a sqlite3 connection"""
+    for name, (function, n_arguments) in SCALAR_FUNCTIONS.items():
+        connection.create_function(name, n_arguments, function, deterministic=True)
+    for name, (aggregate, n_arguments) in AGGREGATE_FUNCTIONS.items():
+        connection.create_aggregate(name, n_arguments, aggregate)
+
+
+# ============================================================================
+# QUERIES
+# ============================================================================
+
+def streams_query(stream_types):
+    """
+    SQL query with one row per activity having all the stream types, and one
+    column per stream type (named after it) holding its stream_value.
+
+    Args:
+        stream_types: Stream types, e.g. ['heartrate', 'time']
+
+    Returns:
+        SQL text usable as a subquery
+    """
+    for stream_type in stream_types:
+        if not stream_type.isidentifier():
+            raise ValueError(f"Invalid stream type: {stream_type!r}")
+    first = stream_types[0]
+    columns = ", ".join(f"s{i}.stream_value AS {stream_type}"
+                        for i, stream_type in enumerate(stream_types))
+    joins = " ".join(f"JOIN streams s{i} ON s{i}.id = s0.id AND s{i}.stream_type = '{stream_type}'"
+                     for i, stream_type in enumerate(stream_types) if i > 0)
+    return f"SELECT s0.id AS id, {columns} FROM streams s0 {joins} WHERE s0.stream_type = '{first}'"
+
+
+def select_streams(cursor, select, stream_types, where=None, parameters=()):
+    """
+    Run a query on the streams of every activity.
+
+    Example:
+        select_streams(cursor, "id, stream_percentile(heartrate, 90)", ['heartrate'])
+
+    Args:
+        cursor: Cursor of a connection with the stream functions
+        select: Selected expressions, the stream types are columns
+        stream_types: Stream types used by the expressions
+        where: Optional condition
+        parameters: Parameters of the ? placeholders
+
+    Returns:
+        List of rows
+    """
+    query = f"SELECT {select} FROM ({streams_query(stream_types)})"
+    if where:
+        query += f" WHERE {where}"
+    return cursor.execute(query + ";", parameters).fetchall()
@@ -0,0 +1,241 @@
+"""
+Module for chunked storage of the activity streams.
+Every stream is also stored in chunks of CHUNK_SIZE samples. The stream_chunk_index
+table keeps the time and distance range of each chunk, so a range read only
+fetches and decodes the chunks overlapping the requested interval
+(e.g. the last 10 minutes of a long run or one interval rep).
+The streams table keeps the full streams for the whole-activity analysis.
+"""
+
+import json
+import numpy as np
+from specific_activity_analysis import iter_activity_streams
+from polyline import encode_polyline, decode_polyline
+from instrumentation import profiled
+from database import connection, register_schema
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Samples per chunk (~5 min at 1 Hz)
+CHUNK_SIZE = 300
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS stream_chunk_index (
+    id INTEGER,
+    chunk INTEGER,
+    start_index INTEGER,
+    n_samples INTEGER,
+    time_min REAL,
+    time_max REAL,
+    distance_min REAL,
+    distance_max REAL,
+    PRIMARY KEY (id, chunk),
+    FOREIGN KEY (id) REFERENCES activity(id)
+) WITHOUT ROWID;
+""", """
+CREATE TABLE IF NOT EXISTS stream_chunks (
+    id INTEGER,
+    stream_type TEXT,
+    chunk INTEGER,
+    chunk_value TEXT,
+    PRIMARY KEY (id, stream_type, chunk),
+    FOREIGN KEY (id) REFERENCES activity(id)
+) WITHOUT ROWID;
+""")
+
+
+# ============================================================================
+# ENCODING
+# ============================================================================
+
+def encode_chunk(stream_type, data):
+    """Encode a chunk like the streams table (polyline for latlng, JSON otherwise)"""
+    if stream_type == 'latlng':
+        return encode_polyline(data)
+    data = np.asarray(data, dtype=float)
+    return json.dumps(np.where(np.isnan(data), None, data).tolist())
+
+
+def decode_chunk(stream_type, chunk_value):
+    """Decode a chunk into a float array ((n, 2) array for latlng)"""
+    if stream_type == 'latlng':
+        return decode_polyline(chunk_value)
+    return np.array(json.loads(chunk_value), dtype=float)
+
+
+def chunk_rows(activity_id, streams, chunk_size=CHUNK_SIZE):
+    """
+    Split the streams of an activity into chunks.
+
+    Args:
+        activity_id: Strava activity ID
+        streams: Stream bundle {stream_type: array}, must contain 'time'
+        chunk_size: Samples per chunk
+
+    Returns:
+        Tuple of (index rows, chunk rows) for stream_chunk_index and stream_chunks
+    """
+    time = streams['time']
+    n_samples = len(time)
+    distance = streams.get('distance')
+    if distance is not None and len(distance) != n_samples:
+        distance = None
+
+    starts = np.arange(0, n_samples, chunk_size)
+    ends = np.minimum(starts + chunk_size, n_samples)
+    # Streams are monotonic, the bounds of a chunk are its first and last samples
+    index_rows = [(activity_id, chunk, int(start), int(end - start),
+                   float(time[start]), float(time[end - 1]),
+                   None if distance is None else float(distance[start]),
+                   None if distance is None else float(distance[end - 1]))
+                  for chunk, (start, end) in enumerate(zip(starts, ends))]
+
+    rows = [(activity_id, stream_type, chunk, encode_chunk(stream_type, data[start:end]))
+            for stream_type, data in streams.items() if len(data) == n_samples
+            for chunk, (start, end) in enumerate(zip(starts, ends))]
+    return index_rows, rows
+
+
+@profiled()
+def update_stream_chunks(activity_ids=None, chunk_size=CHUNK_SIZE):
+    """
+    Chunk the streams of the activities not chunked yet.
+
+    Args:
+        activity_ids: Activities to (re)chunk, defaults to the new ones
+        chunk_size: Samples per chunk
+
+    Returns:
+        Number of chunked activities
+    """
+    if activity_ids is None:
+        activity_ids = [row[0] for row in cursor.execute("""
+            SELECT DISTINCT s.id FROM streams s
+            WHERE s.stream_type = 'time'
+            AND NOT EXISTS (SELECT 1 FROM stream_chunk_index c WHERE c.id = s.id);
+        """).fetchall()]
+    if not activity_ids:
+        return 0
+
+    n_processed = 0
+    for activity_id, streams in iter_activity_streams(activity_ids, stream_types=None):
+        if len(streams.get('time', [])) == 0:
+            continue
+        index_rows, rows = chunk_rows(activity_id, streams, chunk_size)
+        cursor.execute("DELETE FROM stream_chunk_index WHERE id = ?;", (activity_id,))
+        cursor.execute("DELETE FROM stream_chunks WHERE id = ?;", (activity_id,))
+        cursor.executemany("""
+            INSERT INTO stream_chunk_index
+            (id, chunk, start_index, n_samples, time_min, time_max, distance_min, distance_max)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+        """, index_rows)
+        cursor.executemany("""
+            INSERT INTO stream_chunks (id, stream_type, chunk, chunk_value)
+            VALUES (?, ?, ?, ?);
+        """, rows)
+        n_processed += 1
+    conn.commit()
+    return n_processed
+
+
+# ============================================================================
+# RANGE READS
+# ============================================================================
+
+def read_stream_range(activity_id, stream_types, start=None, end=None, by='time'):
+    """
+    Read the part of some streams between two times or distances.
+    Only the chunks overlapping [start, end] are fetched and decoded.
+
+    Args:
+        activity_id: Strava activity ID
+        stream_types: Stream types to read
+        start: Start of the interval (s or m), None for the start of the activity
+        end: End of the interval (s or m), None for the end of the activity
+        by: 'time' or 'distance'
+
+    Returns:
+        Dictionary {stream_type: array} of the samples in [start, end]
+        (also containing the 'time' or 'distance' key stream), empty if nothing is stored
+    """
+    if by not in ('time', 'distance'):
+        raise ValueError("by must be 'time' or 'distance'")
+    start = -np.inf if start is None else start
+    end = np.inf if end is None else end
+
+    chunks = cursor.execute(f"""
+        SELECT MIN(chunk), MAX(chunk) FROM stream_chunk_index
+        WHERE id = ? AND {by}_max >= ? AND {by}_min <= ?;
+    """, (activity_id, start, end)).fetchone()
+    if chunks[0] is None:
+        return {}
+
+    stream_types = list(dict.fromkeys([by] + list(stream_types)))
+    rows = cursor.execute(f"""
+        SELECT stream_type, chunk_value FROM stream_chunks
+        WHERE id = ? AND chunk BETWEEN ? AND ?
+        AND stream_type IN ({','.join('?' for _ in stream_types)})
+        ORDER BY stream_type, chunk;
+    """, (activity_id, chunks[0], chunks[1], *stream_types)).fetchall()
+
+    pieces = {}
+    for stream_type, chunk_value in rows:
+        pieces.setdefault(stream_type, []).append(decode_chunk(stream_type, chunk_value))
+    if by not in pieces:
+        return {}
+
+    streams = {stream_type: np.concatenate(values) for stream_type, values in pieces.items()}
+    inside = (streams[by] >= start) & (streams[by] <= end)
+    return {stream_type: data[inside] for stream_type, data in streams.items()}
+
+
+def read_last_seconds(activity_id, stream_types, seconds):
+    """
+    Read the last seconds of some streams (see read_stream_range).
+
+    Args:
+        activity_id: Strava activity ID
+        stream_types: Stream types to read
+        seconds: Length of the end segment (s)
+    """
+    time_max = cursor.execute("""
+        SELECT MAX(time_max) FROM stream_chunk_index WHERE id = ?;
+    """, (activity_id,)).fetchone()[0]
+    if time_max is None:
+        return {}
+    return read_stream_range(activity_id, stream_types, time_max - seconds, time_max)
+
+
+def segment_stream(activity_id, stream_type, start, end, by='time'):
+    """
+    Segment of one stream with its distance, like activity_stream.
+
+    Args:
+        activity_id: Strava activity ID
+        stream_type: Type of stream to retrieve
+        start: Start of the segment (s or m)
+        end: End of the segment (s or m)
+        by: 'time' or 'distance'
+
+    Returns:
+        Tuple of (stream_data, distance_data) as numpy arrays
+        Returns ([None], [None]) if data is not available
+    """
+    streams = read_stream_range(activity_id, [stream_type, 'distance'], start, end, by)
+    if stream_type not in streams or 'distance' not in streams:
+        return [None], [None]
+    return streams[stream_type], streams['distance']
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"Chunked activities: {update_stream_chunks()}")
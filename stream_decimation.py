@@ -0,0 +1,106 @@
+"""
+Module for the decimation of activity streams before plotting.
+Functions return the indices of the kept samples, so that every stream of
+an activity (time, heart rate, speed...) can be decimated consistently.
+"""
+
+import numpy as np
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Keeps the first and last samples and, in each bucket, the sample forming the
+    largest triangle with the previous kept sample and the next bucket average.
+
+    Args:
+        x: Abscissa (e.g. time), increasing
+        y: Values to preserve visually
+        n_out: Target number of points
+
+    Returns:
+        Sorted array of kept indices
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Bucket edges of the n - 2 inner points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = end, edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[next_start:next_end].mean()
+        next_y = np.nanmean(y[next_start:next_end]) if next_end > next_start else y[-1]
+
+        # Twice the triangle area for every candidate of the bucket
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        area = np.nan_to_num(area, nan=-1)
+        previous = start + int(np.argmax(area))
+        kept[i + 1] = previous
+
+    return kept
+
+
+def minmax_indices(y, n_out):
+    """
+    Min/max-per-bucket downsampling: keeps the minimum and maximum of each bucket.
+
+    Args:
+        y: Values to preserve
+        n_out: Target number of points (two per bucket)
+
+    Returns:
+        Sorted array of kept indices
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    n_buckets = max(n_out // 2, 1)
+    if n_out >= n:
+        return np.arange(n)
+
+    # Equal buckets on a NaN-padded (n_buckets, bucket_size) view
+    bucket_size = -(-n // n_buckets)
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:n] = y
+    buckets = padded.reshape(n_buckets, bucket_size)
+
+    filled = ~np.isnan(buckets).all(axis=1)
+    offsets = np.arange(n_buckets)[filled] * bucket_size
+    buckets = buckets[filled]
+    minimum = offsets + np.nanargmin(buckets, axis=1)
+    maximum = offsets + np.nanargmax(buckets, axis=1)
+
+    return np.unique(np.concatenate([[0, n - 1], minimum, maximum]))
+
+
+def decimate_streams(time, streams, n_out, method='lttb'):
+    """
+    Indices preserving the peaks of several streams sharing the same time axis.
+    The budget is shared between streams and the kept indices are merged.
+
+    Args:
+        time: Time stream (s)
+        streams: List of streams to preserve
+        n_out: Target number of points
+        method: {"lttb","minmax"}
+
+    Returns:
+        Sorted array of kept indices
+    """
+    n_per_stream = max(n_out // max(len(streams), 1), 3)
+    if method == 'lttb':
+        indices = [lttb_indices(time, stream, n_per_stream) for stream in streams]
+    elif method == 'minmax':
+        indices = [minmax_indices(stream, n_per_stream) for stream in streams]
+    else:
+        raise ValueError(f"Unknown decimation method: {method}")
+    return np.unique(np.concatenate(indices))
@@ -0,0 +1,274 @@
+"""
+Module generating a synthetic activity database.
+Builds the same activity and streams tables as create_sqlite_database.py,
+filled with plausible runs, so the analysis can be run and benchmarked
+without a personal Strava database.
+"""
+
+import argparse
+import datetime
+import json
+import numpy as np
+from create_sqlite_database import (create_schema, encode_stream, store_activity_location,
+                                    STREAM_TYPES)
+from database import DATABASE_FILE, open_connection
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Weight used for the synthetic power stream (kg)
+WEIGHT = 64
+
+# Synthetic runs start around this point (lat, lng)
+HOME_LATLNG = (45.188, 5.724)
+
+# Number of routes run repeatedly, and probability of running one of them
+N_ROUTES = 8
+REPEATED_ROUTE_PROBABILITY = 0.6
+
+# Time steps (s) drawn for the smart recording
+RECORDING_STEPS = [1, 1, 1, 1, 1, 2, 3, 5]
+
+# First synthetic activity date
+FIRST_DATE = datetime.datetime(2020, 1, 1, 7, 0, tzinfo=datetime.timezone.utc)
+
+# Decimals kept in the stored streams, as in Strava streams
+METERS_PER_DEGREE = 111320
+
+STREAM_DECIMALS = {'time': 0, 'distance': 1, 'heartrate': 0, 'altitude': 1,
+                   'cadence': 0, 'grade_smooth': 1, 'velocity_smooth': 3, 'watts': 0}
+
+
+# ============================================================================
+# STREAM GENERATION
+# ============================================================================
+
+def _smooth(values, width):
+    """Moving average keeping the length of the array"""
+    kernel = np.ones(width) / width
+    padded = np.pad(values, (width // 2, width - width // 2 - 1), mode='edge')
+    return np.convolve(padded, kernel, mode='valid')
+
+
+def _lag(values, tau):
+    """First order lag (exponential kernel of time constant tau samples)"""
+    kernel = np.exp(-np.arange(5 * tau) / tau)
+    kernel /= kernel.sum()
+    padded = np.concatenate([np.full(len(kernel) - 1, values[0]), values])
+    return np.convolve(padded, kernel, mode='valid')
+
+
+def synthetic_streams(rng, duration):
+    """
+    Streams of one synthetic run.
+
+    Args:
+        rng: numpy random Generator
+        duration: Approximate moving time in seconds
+
+    Returns:
+        Dictionary {stream_type: numpy array}
+    """
+    n = max(int(duration / np.mean(RECORDING_STEPS)), 120)
+
+    # Smart recording: mostly 1 s steps, sometimes longer, sometimes a pause
+    steps = rng.choice(RECORDING_STEPS, size=n)
+    steps[0] = 0
+    if rng.random() < 0.5:
+        steps[rng.integers(n // 4, 3 * n // 4)] += rng.integers(30, 300)
+    time = np.cumsum(steps)
+
+    # Terrain: smooth random walk of the altitude
+    altitude = 100 + np.cumsum(_smooth(rng.normal(0, 0.25, n), 60))
+    base_speed = rng.uniform(2.6, 3.6)
+    approximate_distance = np.maximum(base_speed * time, 1e-3)
+    grade = np.clip(np.gradient(altitude, approximate_distance) * 100, -25, 25)
+    grade = np.nan_to_num(grade)
+
+    # Intensity: easy run, possibly with intervals
+    intensity = np.ones(n)
+    if rng.random() < 0.3:
+        period = int(rng.integers(120, 600))
+        intensity += 0.3 * ((np.arange(n) // period) % 2 == 1)
+
+    # Slower uphill, a bit faster downhill
+    grade_factor = np.where(grade > 0, 1 - 0.03 * grade, 1 - 0.012 * grade)
+    speed = base_speed * intensity * np.clip(grade_factor, 0.4, 1.3)
+    speed = np.maximum(_smooth(speed + rng.normal(0, 0.08, n), 5), 0.5)
+
+    time_delta = np.diff(time, prepend=time[0])
+    moving_delta = np.minimum(time_delta, 5)
+    distance = np.cumsum(speed * moving_delta)
+    grade_smooth = np.clip(np.nan_to_num(np.gradient(altitude, np.maximum(distance, 1e-3)) * 100),
+                           -40, 40)
+
+    # Heart rate follows the effort with a lag, plus cardiac drift
+    effort = speed / base_speed * (1 + 0.04 * np.maximum(grade_smooth, 0))
+    resting = rng.uniform(128, 140)
+    heartrate = _lag(resting + 28 * (effort - 1) + 10 * (intensity - 1) / 0.3, 30)
+    heartrate += 4 * time / 3600 + rng.normal(0, 1.5, n)
+    heartrate = np.clip(heartrate, 90, 200)
+
+    cadence = 82 + 4 * (speed - 3) + rng.normal(0, 1.5, n)
+    watts = 1.04 * WEIGHT * speed * (1 + 0.045 * grade_smooth) + rng.normal(0, 8, n)
+    watts = np.maximum(watts, 0)
+
+    return {'time': time, 'distance': distance, 'heartrate': heartrate,
+            'altitude': altitude, 'cadence': cadence, 'grade_smooth': grade_smooth,
+            'velocity_smooth': speed, 'watts': watts}
+
+
+def random_route(rng):
+    """
+    Random loop around home: a perturbed ellipse.
+
+    Returns:
+        Dictionary with the route center, radii (m), perimeter (m) and shape parameters
+    """
+    center = np.array(HOME_LATLNG) + rng.normal(0, 0.03, 2)
+    radius = rng.uniform(500, 2000, 2)
+    perimeter = np.pi * (3 * radius.sum() - np.sqrt((3 * radius[0] + radius[1])
+                                                     * (radius[0] + 3 * radius[1])))
+    return {'center': center, 'radius': radius, 'perimeter': perimeter,
+            'wobble': rng.uniform(0, 0.2), 'phase': rng.uniform(0, 2 * np.pi)}
+
+
+def route_latlng(rng, route, distance):
+    """
+    Positions along a route (laps repeat the loop), with GPS noise.
+
+    Args:
+        rng: numpy random Generator
+        route: Route dictionary of random_route
+        distance: Distance stream (m)
+
+    Returns:
+        (n, 2) array of [lat, lng]
+    """
+    angle = 2 * np.pi * distance / route['perimeter']
+    scale = 1 + route['wobble'] * np.sin(3 * angle + route['phase'])
+    north = route['radius'][0] * scale * np.sin(angle) + rng.normal(0, 3, len(distance))
+    east = route['radius'][1] * scale * (np.cos(angle) - 1) + rng.normal(0, 3, len(distance))
+    lat = route['center'][0] + north / METERS_PER_DEGREE
+    lng = route['center'][1] + east / (METERS_PER_DEGREE * np.cos(np.radians(route['center'][0])))
+    return np.column_stack([lat, lng])
+
+
+def activity_summary(streams):
+    """
+    Activity table columns computed from the streams.
+
+    Args:
+        streams: Dictionary {stream_type: numpy array}
+
+    Returns:
+        Dictionary {column: value}
+    """
+    time = streams['time']
+    moving_time = np.minimum(np.diff(time), 5).sum()
+    altitude = streams['altitude']
+    return {
+        'distance': float(streams['distance'][-1]),
+        'moving_time': float(moving_time),
+        'total_elevation_gain': float(np.maximum(np.diff(altitude), 0).sum()),
+        'average_speed': float(streams['distance'][-1] / moving_time),
+        'max_speed': float(streams['velocity_smooth'].max()),
+        'average_cadence': float(streams['cadence'].mean()),
+        'average_watts': float(streams['watts'].mean()),
+        'kilojoules': float(streams['watts'].mean() * moving_time / 1000),
+        'has_heartrate': 1.0,
+        'average_heartrate': float(streams['heartrate'].mean()),
+        'max_heartrate': float(streams['heartrate'].max()),
+        'elev_high': float(altitude.max()),
+        'elev_low': float(altitude.min()),
+    }
+
+
+def _encode_stream(stream_type, values):
+    """Stored text of a stream, rounded as Strava streams"""
+    if stream_type == 'latlng':
+        return encode_stream(stream_type, values)
+    decimals = STREAM_DECIMALS.get(stream_type, 3)
+    if decimals == 0:
+        return json.dumps(np.rint(values).astype(np.int64).tolist())
+    return json.dumps(np.round(values, decimals).tolist())
+
+
+# ============================================================================
+# DATABASE GENERATION
+# ============================================================================
+
+def generate_database(filename=DATABASE_FILE, n_activities=100, duration=3600, seed=0):
+    """
+    Build a synthetic activity database.
+
+    Args:
+        filename: SQLite database file (tables are created if needed)
+        n_activities: Number of activities
+        duration: Mean moving time of an activity in seconds
+        seed: Seed of the random generator
+
+    Returns:
+        List of generated activity IDs
+    """
+    rng = np.random.default_rng(seed)
+    database = open_connection(path=filename)
+    database_cursor = database.cursor()
+    create_schema(database_cursor)
+
+    first_id = (database_cursor.execute("SELECT MAX(id) FROM activity;").fetchone()[0]
+                or 10 ** 10)
+    start_date = FIRST_DATE
+    activity_ids = []
+    routes = [random_route(rng) for _ in range(N_ROUTES)]
+
+    for i in range(n_activities):
+        activity_id = first_id + i + 1
+        streams = synthetic_streams(rng, duration * rng.uniform(0.5, 1.5))
+        route = (routes[rng.integers(N_ROUTES)] if rng.random() < REPEATED_ROUTE_PROBABILITY
+                 else random_route(rng))
+        streams['latlng'] = route_latlng(rng, route, streams['distance'])
+        summary = activity_summary(streams)
+        start_date += datetime.timedelta(days=int(rng.integers(1, 4)),
+                                         minutes=int(rng.integers(-90, 90)))
+        sport_type = 'TrailRun' if summary['total_elevation_gain'] > 300 else 'Run'
+
+        columns = ['id', 'sport_type', 'name', 'start_date', 'start_date_local'] + list(summary)
+        values = [activity_id, sport_type, f"Synthetic run {i + 1}",
+                  str(start_date), str(start_date)] + list(summary.values())
+        database_cursor.execute(f"""
+            INSERT OR REPLACE INTO activity ({', '.join(columns)})
+            VALUES ({', '.join('?' for _ in columns)});
+        """, values)
+
+        store_activity_location(activity_id, streams['latlng'][0].tolist(),
+                                streams['latlng'][-1].tolist(), location_cursor=database_cursor)
+
+        database_cursor.executemany("""
+            INSERT OR REPLACE INTO streams (id, stream_type, stream_value)
+            VALUES (?, ?, ?);
+        """, [(activity_id, stream_type, _encode_stream(stream_type, streams[stream_type]))
+              for stream_type in STREAM_TYPES if stream_type in streams])
+        activity_ids.append(activity_id)
+
+    database.commit()
+    database.close()
+    return activity_ids
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic activity database")
+    parser.add_argument("--output", default=DATABASE_FILE)
+    parser.add_argument("--activities", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=3600,
+                        help="mean moving time of an activity (s)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ids = generate_database(args.output, args.activities, args.duration, args.seed)
+    print(f"{len(ids)} synthetic activities written to {args.output}")
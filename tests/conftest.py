@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# The modules open their database at import, point them at a throwaway one
+os.environ.setdefault("STRAVA_DATABASE", os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import numpy as np
+from splits import activity_splits
+
+# Efficiency (heart rate / speed) relative to flat: 1.2 at +5 %
+GAP_POLYNOMIAL = np.poly1d([0.002, 0.03, 1.0])
+
+
+def two_km_streams():
+    """A flat km at 4 m/s then a +5 % km at 3 m/s, sampled every second"""
+    time = np.arange(0, 250 + 335)
+    speed = np.where(time < 250, 4.0, 3.0)
+    distance = np.concatenate([[0.0], np.cumsum(speed[:-1])])
+    grade = np.where(distance < 1000, 0.0, 5.0)
+    return {'time': time.astype(float), 'distance': distance, 'grade_smooth': grade}
+
+
+def test_uphill_gap_pace_is_faster_than_pace():
+    splits = activity_splits(two_km_streams(), 1000.0, GAP_POLYNOMIAL)
+    assert splits['complete'][0] == 1 and splits['complete'][1] == 1
+    # Flat km: no adjustment
+    assert np.isclose(splits['gap_pace'][0], splits['pace'][0], rtol=1e-2)
+    # Uphill km: the flat-equivalent pace is faster
+    assert splits['gap_pace'][1] < splits['pace'][1]
+    assert np.isclose(splits['gap_pace'][1], splits['pace'][1] / 1.2, rtol=2e-2)
+
+
+def test_no_gap_pace_without_model():
+    splits = activity_splits(two_km_streams(), 1000.0)
+    assert np.isnan(splits['gap_pace']).all()
+
+
+def test_unsplittable_activity_is_marked_once():
+    import create_sqlite_database  # streams table
+    from create_sqlite_database import encode_stream
+    import splits
+    treadmill_id = 101
+    splits.cursor.execute("INSERT OR IGNORE INTO activity (id, sport_type) VALUES (?, 'Run');",
+                          (treadmill_id,))
+    for stream_type, data in [('time', list(range(600))), ('distance', [0.0] * 600)]:
+        splits.cursor.execute("INSERT OR REPLACE INTO streams (id, stream_type, stream_value) "
+                              "VALUES (?, ?, ?);", (treadmill_id, stream_type,
+                                                    encode_stream(stream_type, data)))
+    splits.conn.commit()
+    assert splits.update_splits([treadmill_id]) == 1
+    assert splits.activity_split_table(treadmill_id) == []
+    # The marker row keeps it out of the next syncs
+    assert splits.update_splits() == 0
+
+
+def test_gap_paces_follow_the_current_model():
+    import splits
+    streams = two_km_streams()
+    split_table = activity_splits(streams, 1000.0)
+    rows = [(202, 'km', split + 1, float(split_table['moving_time'][split]),
+             *map(float, split_table['grade_moments'][split]))
+            for split in range(2)]
+    splits.cursor.executemany(f"""
+        INSERT OR REPLACE INTO splits (id, unit, split, moving_time, {', '.join(splits.MOMENT_COLUMNS)},
+                                       gap_model)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'older model');
+    """, rows)
+    splits.conn.commit()
+    assert splits.update_gap_paces(GAP_POLYNOMIAL) == 2
+    stored = [row[4] for row in splits.activity_split_table(202)]
+    expected = activity_splits(streams, 1000.0, GAP_POLYNOMIAL)['gap_pace'][:2]
+    assert np.allclose(stored, expected)
+    # Already computed with this model: nothing to update
+    assert splits.update_gap_paces(GAP_POLYNOMIAL) == 0
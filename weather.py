@@ -0,0 +1,375 @@
+"""
+Module for weather data.
+Hourly observations are bulk-loaded from local files (CSV exports of
+Meteostat / Open-Meteo, or ERA5-like NetCDF files) into the indexed weather
+table. Activities and analysis windows get their temperature, humidity and
+wind speed with one vectorized searchsorted interpolation over the whole
+history instead of one query per activity.
+"""
+
+import csv
+from datetime import datetime, timezone
+import numpy as np
+from specific_activity_analysis import collect_window_features, bin_efficiency_by_gradient
+from instrumentation import profiled
+from database import connection, register_schema, current_database
+from lazy_imports import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+WEATHER_FIELDS = ['temperature', 'humidity', 'wind_speed']
+WEATHER_UNITS = {'temperature': '°C', 'humidity': '%', 'wind_speed': 'km/h'}
+
+# Accepted CSV column names (lower case, units in parentheses are ignored)
+CSV_COLUMNS = {'time': ['time', 'timestamp', 'date', 'datetime'],
+               'temperature': ['temperature', 'temperature_2m', 'temp'],
+               'humidity': ['humidity', 'relative_humidity', 'relative_humidity_2m', 'rhum'],
+               'wind_speed': ['wind_speed', 'wind_speed_10m', 'wspd']}
+
+# Default station name (a single weather series around home)
+DEFAULT_STATION = 'local'
+
+# Longest interval between two observations that is interpolated (s)
+MAX_OBSERVATION_GAP = 3 * 3600
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS weather (
+    station TEXT,
+    time INTEGER,
+    temperature REAL,
+    humidity REAL,
+    wind_speed REAL,
+    PRIMARY KEY (station, time)
+) WITHOUT ROWID;
+""", """
+CREATE TABLE IF NOT EXISTS activity_weather (
+    id INTEGER PRIMARY KEY,
+    station TEXT,
+    temperature REAL,
+    humidity REAL,
+    wind_speed REAL,
+    FOREIGN KEY (id) REFERENCES activity(id)
+);
+""")
+
+# {(database, station): (times, values)} loaded observations
+_observations = {}
+
+
+# ============================================================================
+# IMPORT
+# ============================================================================
+
+def _parse_time(value):
+    """UTC epoch seconds of an ISO date (with its offset, UTC without one) or epoch string"""
+    value = value.strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+    if value[-1:] in ('Z', 'z'):
+        value = value[:-1] + '+00:00'
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+def _parse_times(values):
+    """UTC epoch seconds of ISO dates or epoch strings"""
+    return np.array([_parse_time(value) for value in values], dtype=np.int64)
+
+
+def _parse_value(text):
+    """Float of a cell, NaN when it is empty or not a number (e.g. 'M', 'NA', '---')"""
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+
+def _column_name(header):
+    """Column name without unit, e.g. 'temperature_2m (°C)' -> 'temperature_2m'"""
+    return header.split('(')[0].strip().lower()
+
+
+def store_observations(times, values, station=DEFAULT_STATION):
+    """
+    Store hourly observations (existing observations at the same time are replaced).
+
+    Args:
+        times: UTC epoch seconds
+        values: (n, 3) array with columns WEATHER_FIELDS (NaN for missing values)
+        station: Station name
+
+    Returns:
+        Number of stored observations
+    """
+    values = np.asarray(values, dtype=float)
+    rows = [(station, int(time), *(None if np.isnan(value) else float(value) for value in row))
+            for time, row in zip(times, values)]
+    cursor.executemany("""
+        INSERT OR REPLACE INTO weather (station, time, temperature, humidity, wind_speed)
+        VALUES (?, ?, ?, ?, ?);
+    """, rows)
+    conn.commit()
+    _observations.pop((current_database(), station), None)
+    return len(rows)
+
+
+@profiled()
+def import_weather_csv(filename, station=DEFAULT_STATION):
+    """
+    Import hourly observations from a CSV file.
+    The header line is the first line with a time column, metadata lines above
+    it are skipped. Times are ISO dates (converted to UTC from their offset, UTC
+    without one) or epoch seconds.
+
+    Args:
+        filename: CSV file
+        station: Station name
+
+    Returns:
+        Number of stored observations
+    """
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        for header in reader:
+            names = [_column_name(name) for name in header]
+            if any(name in CSV_COLUMNS['time'] for name in names):
+                break
+        else:
+            raise ValueError(f"No time column in {filename}")
+        rows = [row for row in reader if row]
+
+    columns = {}
+    for field, aliases in CSV_COLUMNS.items():
+        matches = [i for i, name in enumerate(names) if name in aliases]
+        columns[field] = matches[0] if matches else None
+
+    times = _parse_times([row[columns['time']] for row in rows])
+    values = np.full((len(rows), len(WEATHER_FIELDS)), np.nan)
+    for j, field in enumerate(WEATHER_FIELDS):
+        if columns[field] is not None:
+            values[:, j] = [_parse_value(row[columns[field]]) for row in rows]
+    return store_observations(times, values, station)
+
+
+@profiled()
+def import_weather_netcdf(filename, station=DEFAULT_STATION, latitude=None, longitude=None):
+    """
+    Import hourly observations from a NetCDF file (requires xarray).
+    ERA5 variables (t2m, d2m, u10, v10) are converted to temperature, relative
+    humidity and wind speed, otherwise variables named like WEATHER_FIELDS are read.
+
+    Args:
+        filename: NetCDF file
+        station: Station name
+        latitude: Latitude of the grid point to read (nearest), None for single-point files
+        longitude: Longitude of the grid point to read (nearest)
+
+    Returns:
+        Number of stored observations
+    """
+    try:
+        import xarray
+    except ImportError:
+        raise ImportError("NetCDF import requires xarray (pip install xarray netCDF4)")
+
+    with xarray.open_dataset(filename) as dataset:
+        time_name = 'valid_time' if 'valid_time' in dataset.coords else 'time'
+        if latitude is not None and longitude is not None:
+            dataset = dataset.sel(latitude=latitude, longitude=longitude, method='nearest')
+        dataset = dataset.squeeze(drop=True)
+        times = dataset[time_name].values.astype('datetime64[s]').astype(np.int64)
+
+        if {'t2m', 'd2m', 'u10', 'v10'} <= set(dataset.data_vars):
+            temperature = dataset['t2m'].values - 273.15
+            dew_point = dataset['d2m'].values - 273.15
+            # Magnus formula
+            humidity = 100 * np.exp(17.625 * dew_point / (243.04 + dew_point)
+                                    - 17.625 * temperature / (243.04 + temperature))
+            wind_speed = np.hypot(dataset['u10'].values, dataset['v10'].values) * 3.6
+            values = np.column_stack([temperature, humidity, wind_speed])
+        else:
+            values = np.column_stack([dataset[field].values if field in dataset.data_vars
+                                      else np.full(len(times), np.nan)
+                                      for field in WEATHER_FIELDS])
+    return store_observations(times, values, station)
+
+
+# ============================================================================
+# TIME JOIN
+# ============================================================================
+
+def load_observations(station=DEFAULT_STATION):
+    """
+    Observations of a station sorted by time, loaded once per process.
+
+    Returns:
+        Tuple of (times, values) with values a (n, 3) array with columns WEATHER_FIELDS
+    """
+    key = (current_database(), station)
+    if key not in _observations:
+        rows = cursor.execute("""
+            SELECT time, temperature, humidity, wind_speed FROM weather
+            WHERE station = ? ORDER BY time;
+        """, (station,)).fetchall()
+        table = np.array(rows, dtype=float).reshape(-1, 1 + len(WEATHER_FIELDS))
+        _observations[key] = (table[:, 0], table[:, 1:])
+    return _observations[key]
+
+
+def interpolate_weather(times, station=DEFAULT_STATION, max_gap=MAX_OBSERVATION_GAP):
+    """
+    Weather at any times, linearly interpolated between observations.
+
+    Args:
+        times: UTC epoch seconds (any shape flattened, any order)
+        station: Station name
+        max_gap: Longest interval between observations that is interpolated (s)
+
+    Returns:
+        (n, 3) array with columns WEATHER_FIELDS, NaN outside the observed period
+    """
+    times = np.asarray(times, dtype=float).ravel()
+    observation_times, values = load_observations(station)
+    weather = np.full((len(times), len(WEATHER_FIELDS)), np.nan)
+    if len(observation_times) < 2:
+        return weather
+
+    right = np.clip(np.searchsorted(observation_times, times, side='right'),
+                    1, len(observation_times) - 1)
+    left = right - 1
+    gap = observation_times[right] - observation_times[left]
+    weight = ((times - observation_times[left]) / gap)[:, None]
+    interpolated = values[left] * (1 - weight) + values[right] * weight
+
+    valid = ((times >= observation_times[0]) & (times <= observation_times[-1])
+             & (gap <= max_gap))
+    weather[valid] = interpolated[valid]
+    return weather
+
+
+def _activity_times(activity_ids=None):
+    """Activity IDs with their start epoch and moving time, sorted by ID"""
+    query = """
+        SELECT id, CAST(strftime('%s', start_date) AS INTEGER), COALESCE(moving_time, 0)
+        FROM activity WHERE start_date IS NOT NULL
+    """
+    parameters = []
+    if activity_ids is not None:
+        activity_ids = list(activity_ids)
+        query += f" AND id IN ({','.join('?' for _ in activity_ids)})"
+        parameters = activity_ids
+    rows = cursor.execute(query + " ORDER BY id;", parameters).fetchall()
+    table = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return table[:, 0], table[:, 1], table[:, 2]
+
+
+@profiled()
+@profiled()
+def update_activity_weather(station=DEFAULT_STATION, missing_only=False):
+    """
+    Attach the weather to every activity (at its middle) in one join.
+
+    Args:
+        station: Station name
+        missing_only: Only the activities without weather row yet (new activities of a sync)
+
+    Returns:
+        Number of activities with weather data
+    """
+    activity_ids, start_times, moving_times = _activity_times()
+    if missing_only:
+        stored = [row[0] for row in cursor.execute("SELECT id FROM activity_weather;")]
+        missing = ~np.isin(activity_ids, stored)
+        activity_ids, start_times, moving_times = (activity_ids[missing], start_times[missing],
+                                                   moving_times[missing])
+    weather = interpolate_weather(start_times + moving_times / 2, station)
+    rows = [(int(activity_id), station,
+             *(None if np.isnan(value) else float(value) for value in row))
+            for activity_id, row in zip(activity_ids, weather)]
+    cursor.executemany("""
+        INSERT OR REPLACE INTO activity_weather (id, station, temperature, humidity, wind_speed)
+        VALUES (?, ?, ?, ?, ?);
+    """, rows)
+    conn.commit()
+    return int((~np.isnan(weather).all(axis=1)).sum())
+
+
+def window_weather(window_time=60, station=DEFAULT_STATION):
+    """
+    Window features of all activities with the weather of each window.
+
+    Args:
+        window_time: Window size in seconds
+        station: Station name
+
+    Returns:
+        Tuple of (features, weather): (n_windows, 4) array with columns WINDOW_FEATURES
+        and (n_windows, 3) array with columns WEATHER_FIELDS
+    """
+    features, window_ids, window_times = collect_window_features(
+        window_time, return_activity_ids=True, return_window_times=True)
+    activity_ids, start_times, _ = _activity_times(np.unique(window_ids).tolist())
+    if len(activity_ids) == 0:
+        return features, np.full((len(features), len(WEATHER_FIELDS)), np.nan)
+
+    # Start time of the activity of each window (IDs are sorted)
+    position = np.clip(np.searchsorted(activity_ids, window_ids), 0, len(activity_ids) - 1)
+    known = activity_ids[position] == window_ids
+    times = np.where(known, start_times[position] + window_times, np.nan)
+    return features, interpolate_weather(times, station)
+
+
+def efficiency_by_temperature(window_time=60, bin_width=2.0, station=DEFAULT_STATION):
+    """
+    Normalized efficiency of the flat windows per temperature bin.
+
+    Returns:
+        Dictionary of bin statistics (see bin_efficiency_by_gradient), keyed by temperature
+    """
+    features, weather = window_weather(window_time, station)
+    flat = (np.abs(features[:, 1]) < 2) & ~np.isnan(weather[:, 0]) & ~np.isnan(features[:, 3])
+    bins = bin_efficiency_by_gradient(weather[flat, 0], features[flat, 3], bin_width)
+    bins['temperature'] = bins.pop('gradient')
+    return bins
+
+
+def plot_efficiency_by_temperature(window_time=60, bin_width=2.0, save=False):
+    """Normalized efficiency (HR/speed) of flat windows against temperature"""
+    bins = efficiency_by_temperature(window_time, bin_width)
+    plt.errorbar(bins['temperature'], bins['mean'], yerr=np.sqrt(bins['variance'] / bins['count']),
+                 fmt='o', color='#FC4C02')
+    plt.xlabel(f"Temperature ({WEATHER_UNITS['temperature']})")
+    plt.ylabel("Normalized efficiency (HR/speed)")
+    plt.title("Efficiency of flat windows against temperature")
+    plt.grid(True, alpha=0.3)
+    if save:
+        plt.savefig("./Results/efficiency_by_temperature.png", dpi=300)
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Import hourly weather observations")
+    parser.add_argument("files", nargs="+", help="CSV or NetCDF files")
+    parser.add_argument("--station", default=DEFAULT_STATION)
+    arguments = parser.parse_args()
+    for filename in arguments.files:
+        if filename.endswith(('.nc', '.nc4', '.netcdf')):
+            count = import_weather_netcdf(filename, arguments.station)
+        else:
+            count = import_weather_csv(filename, arguments.station)
+        print(f"{filename}: {count} observations")
+    print(f"Activities with weather: {update_activity_weather(arguments.station)}")
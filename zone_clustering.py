@@ -0,0 +1,292 @@
+"""
+Module for training zone clustering on Strava streams.
+Fits a mini-batch K-means over streamed window features, persists the fitted
+scaler and centroids, and assigns new windows to zones without refitting.
+"""
+
+import json
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+from specific_activity_analysis import (ids_restricted, iter_activity_streams,
+                                        iter_window_features, WINDOW_FEATURES,
+                                        GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH,
+                                        zone_edges)
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Default model file
+ZONE_MODEL_FILE = "zone_clustering_model.json"
+
+# Window size (s), 1 s clusters the per-second data
+ZONE_WINDOW_TIME = 1
+
+# Wide acceptance limits: zones must also cover easy runs and sprints
+ZONE_WINDOW_LIMITS = {'heartrate': (60, 220),
+                      'grade_smooth': (GRAD_LIMIT_LOW, GRAD_LIMIT_HIGH),
+                      'velocity_smooth': (3, 30)}
+
+
+# ============================================================================
+# FEATURE STREAMING
+# ============================================================================
+
+def zone_feature_blocks(features=('speed', 'heartrate'), window_time=ZONE_WINDOW_TIME):
+    """
+    Generate the clustering features of each activity.
+
+    Args:
+        features: Names of the WINDOW_FEATURES columns to cluster
+        window_time: Window size in seconds
+
+    Yields:
+        (n_windows, len(features)) arrays without rejected windows
+    """
+    columns = [WINDOW_FEATURES.index(feature) for feature in features]
+    activity_ids = ids_restricted(['heartrate', 'grade_smooth', 'velocity_smooth'])
+
+    for _, window_features in iter_window_features(iter_activity_streams(activity_ids),
+                                                   window_time,
+                                                   window_limits=ZONE_WINDOW_LIMITS):
+        block = window_features[:, columns]
+        yield block[~np.isnan(block).any(axis=1)]
+
+
+def rebatch(blocks, batch_size):
+    """
+    Regroup blocks of rows into batches of batch_size rows (the last one may be smaller).
+
+    Args:
+        blocks: Iterable of 2D arrays with the same number of columns
+        batch_size: Number of rows per batch
+
+    Yields:
+        2D arrays of batch_size rows
+    """
+    pending = []
+    pending_size = 0
+    for block in blocks:
+        pending.append(block)
+        pending_size += len(block)
+        if pending_size < batch_size:
+            continue
+        rows = np.concatenate(pending)
+        n_full = len(rows) // batch_size * batch_size
+        for start in range(0, n_full, batch_size):
+            yield rows[start:start + batch_size]
+        pending = [rows[n_full:]]
+        pending_size = len(pending[0])
+    if pending_size:
+        yield np.concatenate(pending)
+
+
+# ============================================================================
+# ZONE CLUSTERING ENGINE
+# ============================================================================
+
+class ZoneClusteringEngine:
+    """
+    Incremental K-means clustering of training zones.
+    The scaler and the centroids are fitted with partial_fit on batches,
+    so the full data set never has to be in memory. Once fitted, new windows
+    are assigned or folded in with the stored centroids only.
+    """
+
+    def __init__(self, n_clusters=5, features=('speed', 'heartrate'),
+                 batch_size=4096, random_state=42):
+        self.n_clusters = n_clusters
+        self.features = list(features)
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.scaler = StandardScaler()
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                                      random_state=random_state, n_init=3)
+        self.cluster_centers = None
+        self.counts = None
+
+    def fit(self, make_blocks=None, n_epochs=1):
+        """
+        Fit the scaler then the centroids over streamed feature blocks.
+
+        Args:
+            make_blocks: Callable returning a fresh iterable of feature blocks,
+                defaults to zone_feature_blocks over all activities
+            n_epochs: Number of passes of mini-batch updates
+
+        Returns:
+            self
+        """
+        if make_blocks is None:
+            make_blocks = lambda: zone_feature_blocks(self.features)
+
+        # First pass: mean and variance of the features
+        for batch in rebatch(make_blocks(), self.batch_size):
+            self.scaler.partial_fit(batch)
+
+        # Next passes: mini-batch updates of the centroids
+        for _ in range(n_epochs):
+            for batch in rebatch(make_blocks(), self.batch_size):
+                if len(batch) < self.n_clusters:
+                    continue
+                self.kmeans.partial_fit(self.scaler.transform(batch))
+        self.cluster_centers = self.kmeans.cluster_centers_.copy()
+
+        # Number of windows per zone, weights of the centroids for later updates
+        self.counts = np.zeros(self.n_clusters)
+        for batch in rebatch(make_blocks(), self.batch_size):
+            self.counts += np.bincount(self.predict(batch), minlength=self.n_clusters)
+        return self
+
+    def partial_fit(self, batch):
+        """
+        Fold one batch of new windows into a fitted model without refitting.
+        Each centroid moves towards its new windows with a step 1 / (windows seen),
+        as in a mini-batch K-means update.
+
+        Args:
+            batch: (n, n_features) array of window features
+
+        Returns:
+            self
+        """
+        batch = np.asarray(batch, dtype=float)
+        scaled = self.scaler.transform(batch)
+        labels = self.predict(batch)
+
+        batch_counts = np.bincount(labels, minlength=self.n_clusters)
+        batch_sums = np.zeros_like(self.cluster_centers)
+        np.add.at(batch_sums, labels, scaled)
+
+        self.counts = self.counts + batch_counts
+        updated = batch_counts > 0
+        self.cluster_centers[updated] += ((batch_sums[updated]
+                                           - batch_counts[updated, None]
+                                           * self.cluster_centers[updated])
+                                          / self.counts[updated, None])
+        return self
+
+    def predict(self, batch):
+        """
+        Assign windows to the nearest zone without refitting.
+
+        Args:
+            batch: (n, n_features) array of window features
+
+        Returns:
+            Array of zone labels
+        """
+        scaled = self.scaler.transform(np.asarray(batch, dtype=float))
+        distances = ((scaled[:, None, :] - self.cluster_centers[None, :, :]) ** 2).sum(axis=2)
+        return distances.argmin(axis=1)
+
+    def centroids(self):
+        """Centroids in the original feature scale"""
+        return self.scaler.inverse_transform(self.cluster_centers)
+
+    def save(self, filename=ZONE_MODEL_FILE):
+        """Persist the fitted scaler and centroids to a JSON file"""
+        model = {
+            'n_clusters': self.n_clusters,
+            'features': self.features,
+            'scaler_mean': self.scaler.mean_.tolist(),
+            'scaler_scale': self.scaler.scale_.tolist(),
+            'scaler_var': self.scaler.var_.tolist(),
+            'n_samples_seen': int(self.scaler.n_samples_seen_),
+            'cluster_centers': self.cluster_centers.tolist(),
+            'counts': self.counts.tolist(),
+        }
+        with open(filename, "w") as f:
+            json.dump(model, f, indent=4)
+
+    @classmethod
+    def load(cls, filename=ZONE_MODEL_FILE):
+        """Load a model saved with save()"""
+        with open(filename, "r") as f:
+            model = json.load(f)
+
+        engine = cls(n_clusters=model['n_clusters'], features=model['features'])
+        engine.scaler.mean_ = np.array(model['scaler_mean'])
+        engine.scaler.scale_ = np.array(model['scaler_scale'])
+        engine.scaler.var_ = np.array(model['scaler_var'])
+        engine.scaler.n_samples_seen_ = model['n_samples_seen']
+        engine.scaler.n_features_in_ = len(model['features'])
+        engine.cluster_centers = np.array(model['cluster_centers'])
+        engine.counts = np.array(model['counts'])
+        return engine
+
+
+# ============================================================================
+# COMPARISON WITH THE REFERENCE ZONES
+# ============================================================================
+
+def compare_with_reference_zones(engine, make_blocks=None):
+    """
+    Compare the learned zones with the reference speed and heart rate zones.
+
+    Args:
+        engine: Fitted ZoneClusteringEngine
+        make_blocks: Callable returning a fresh iterable of feature blocks,
+            defaults to zone_feature_blocks over all activities
+
+    Returns:
+        Dictionary with, for each reference feature, the reference zone of each
+        centroid and the contingency table (learned zone x reference zone,
+        the last reference column counts windows outside the reference zones)
+    """
+    if make_blocks is None:
+        make_blocks = lambda: zone_feature_blocks(engine.features)
+
+    reference_features = [feature for feature in ('speed', 'heartrate')
+                          if feature in engine.features]
+    edges = {feature: zone_edges(feature) for feature in reference_features}
+    contingency = {feature: np.zeros((engine.n_clusters, len(edges[feature][0]) + 1),
+                                     dtype=np.int64)
+                   for feature in reference_features}
+
+    for block in make_blocks():
+        if len(block) == 0:
+            continue
+        labels = engine.predict(block)
+        for feature in reference_features:
+            names, feature_edges = edges[feature]
+            zone = _reference_zone_index(block[:, engine.features.index(feature)],
+                                         feature_edges)
+            np.add.at(contingency[feature], (labels, zone), 1)
+
+    centroids = engine.centroids()
+    comparison = {}
+    for feature in reference_features:
+        names, feature_edges = edges[feature]
+        centroid_zone = _reference_zone_index(centroids[:, engine.features.index(feature)],
+                                              feature_edges)
+        comparison[feature] = {
+            'reference_zones': names,
+            'centroid_zones': [names[i] if i < len(names) else None for i in centroid_zone],
+            'contingency': contingency[feature],
+        }
+    return comparison
+
+
+def _reference_zone_index(values, edges):
+    """Reference zone index of each value, len(edges) - 1 when outside all zones"""
+    zone = np.digitize(values, edges) - 1
+    zone[(zone < 0) | (zone >= len(edges) - 1)] = len(edges) - 1
+    return zone
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    engine = ZoneClusteringEngine(n_clusters=5).fit()
+    engine.save()
+    print("Centroids (speed km/h, heart rate bpm):")
+    print(engine.centroids())
+
+    comparison = compare_with_reference_zones(engine)
+    for feature, result in comparison.items():
+        print(f"\n{feature}: centroid zones {result['centroid_zones']}")
+        print(result['contingency'])
@@ -0,0 +1,182 @@
+"""
+Module for time-in-zone histograms of every activity.
+Heart rate and speed streams are digitized into the HR_ZONE_* / SPEED_ZONE_*
+zones and weighted by the real time step of each sample. Histograms are stored
+in the zone_time table so that weekly and monthly reports aggregate in SQL.
+"""
+
+import numpy as np
+from specific_activity_analysis import (iter_activity_streams, zone_edges, PAUSE_THRESHOLD,
+                                        COLORS)
+from instrumentation import profiled
+from database import connection, register_schema
+from lazy_imports import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')
+
+# ============================================================================
+# CONSTANTS
+# ============================================================================
+
+# Stream of each zone feature and conversion factor to the zone unit
+ZONE_STREAMS = {'heartrate': ('heartrate', 1.0),
+                'speed': ('velocity_smooth', 3.6)}
+
+# Database connection
+conn = connection()
+cursor = conn.cursor()
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS zone_time (
+    id INTEGER,
+    feature TEXT,
+    zone TEXT,
+    seconds REAL,
+    PRIMARY KEY (id, feature, zone),
+    FOREIGN KEY (id) REFERENCES activity(id)
+);
+""")
+
+
+# ============================================================================
+# HISTOGRAMS
+# ============================================================================
+
+def zone_names(feature):
+    """Zone names of a feature, with the 'below' and 'above' out-of-zone bins"""
+    names, _ = zone_edges(feature)
+    return ['below'] + names + ['above']
+
+
+def time_in_zones(time, values, feature, pause_threshold=PAUSE_THRESHOLD):
+    """
+    Seconds spent in each zone.
+    Each sample is weighted by the time step to the next sample,
+    steps longer than pause_threshold are pauses and are not counted.
+
+    Args:
+        time: Time stream (s)
+        values: Stream in the zone unit (bpm or km/h)
+        feature: 'heartrate' or 'speed'
+        pause_threshold: Longest time step counted (s)
+
+    Returns:
+        Array of seconds per zone (same order as zone_names(feature))
+    """
+    _, edges = zone_edges(feature)
+    n_bins = len(edges) + 1
+    time = np.asarray(time, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if len(time) < 2 or len(time) != len(values):
+        return np.zeros(n_bins)
+
+    time_step = np.diff(time)
+    time_step[time_step > pause_threshold] = 0
+    values = values[:-1]
+    valid = ~np.isnan(values)
+
+    zone = np.digitize(values[valid], edges)
+    return np.bincount(zone, weights=time_step[valid], minlength=n_bins)
+
+
+@profiled()
+def update_zone_histograms(activity_ids=None):
+    """
+    Compute and store the zone histograms of the activities not processed yet.
+
+    Args:
+        activity_ids: Activities to (re)compute, defaults to the new ones
+
+    Returns:
+        Number of processed activities
+    """
+    if activity_ids is None:
+        activity_ids = [row[0] for row in cursor.execute("""
+            SELECT DISTINCT s.id FROM streams s
+            WHERE s.stream_type = 'time'
+            AND NOT EXISTS (SELECT 1 FROM zone_time z WHERE z.id = s.id);
+        """).fetchall()]
+    if not activity_ids:
+        return 0
+
+    stream_types = ['time'] + [stream_type for stream_type, _ in ZONE_STREAMS.values()]
+    n_processed = 0
+    for activity_id, streams in iter_activity_streams(activity_ids, stream_types,
+                                                      require_all=False):
+        rows = []
+        for feature, (stream_type, factor) in ZONE_STREAMS.items():
+            values = streams.get(stream_type, np.array([]))
+            seconds = time_in_zones(streams.get('time', np.array([])), values * factor, feature)
+            rows += [(activity_id, feature, zone, float(value))
+                     for zone, value in zip(zone_names(feature), seconds)]
+        cursor.executemany("""
+            INSERT OR REPLACE INTO zone_time (id, feature, zone, seconds)
+            VALUES (?, ?, ?, ?);
+        """, rows)
+        n_processed += 1
+    conn.commit()
+    return n_processed
+
+
+# ============================================================================
+# REPORTS
+# ============================================================================
+
+def time_in_zone_report(feature='heartrate', period='month'):
+    """
+    Hours in each zone per week or month, aggregated in SQL.
+
+    Args:
+        feature: 'heartrate' or 'speed'
+        period: 'week' or 'month'
+
+    Returns:
+        Tuple of (periods, zones, hours) where hours is a (n_periods, n_zones) array
+    """
+    period_format = '%Y-%W' if period == 'week' else '%Y-%m'
+    result = cursor.execute("""
+        SELECT strftime(?, a.start_date) AS period, z.zone, SUM(z.seconds) / 3600.0
+        FROM zone_time z JOIN activity a ON a.id = z.id
+        WHERE z.feature = ?
+        GROUP BY period, z.zone
+        ORDER BY period;
+    """, (period_format, feature)).fetchall()
+
+    zones = zone_names(feature)
+    periods = sorted({row[0] for row in result if row[0] is not None})
+    period_index = {value: i for i, value in enumerate(periods)}
+    hours = np.zeros((len(periods), len(zones)))
+    for period_value, zone, value in result:
+        if period_value is not None:
+            hours[period_index[period_value], zones.index(zone)] = value
+    return periods, zones, hours
+
+
+def plot_time_in_zone(feature='heartrate', period='month', save=False):
+    """Stacked bars of the hours spent in each zone per period"""
+    periods, zones, hours = time_in_zone_report(feature, period)
+    bottom = np.zeros(len(periods))
+    for i, zone in enumerate(zones):
+        plt.bar(periods, hours[:, i], bottom=bottom, label=zone, color=COLORS[i % len(COLORS)])
+        bottom += hours[:, i]
+    plt.xticks(rotation=90, size=8)
+    plt.xlabel(period)
+    plt.ylabel("Time (h)")
+    plt.title(f"Time in {feature} zones per {period}")
+    plt.legend()
+    plt.tight_layout()
+    if save:
+        plt.savefig(f"./Results/time_in_{feature}_zones_per_{period}.png", dpi=300)
+
+
+# ============================================================================
+# SCRIPT EXECUTION
+# ============================================================================
+
+if __name__ == "__main__":
+    print(f"Processed activities: {update_zone_histograms()}")
+    plt.figure()
+    plot_time_in_zone('heartrate', 'month', save=True)
+    plt.figure()
+    plot_time_in_zone('speed', 'month', save=True)
+    plt.show()